@@ -4,25 +4,169 @@ class APIClient {
 
   constructor(receivers) {
     this.clients = {};
+    this.vol_pct_channels = {};
+
+    // The ETags of the latest data we got, for conditional requests: if the data didn't change since, the server
+    // replies 304 Not Modified, without the data.
+    this.receiver_data_etags = {};
+    this.receivers_data_etag = null;
+
+    // The controller, which serves the web app, aggregates the receivers' APIs.
+    this.controller_client = axios.create({
+      json: true
+    });
     receivers.forEach(function (receiver, index) {
       this.clients[receiver] = axios.create({
-        baseURL: "//" + receiver + ':8080',
+        baseURL: this.getBaseURL(receiver),
         json: true
       });
     }.bind(this));
   }
 
+  getBaseURL(receiver) {
+    return "//" + receiver + ':8080';
+  }
+
+  // Returns a promise of the receiver's data, or of null if it didn't change since the last call.
   getReceiverData(receiver) {
-    return this.perform(receiver, 'get', '/receiver_data');
+    return this.getIfModified(
+      this.clients[receiver], '/receiver_data', this.receiver_data_etags[receiver],
+      (etag) => { this.receiver_data_etags[receiver] = etag; }
+    );
+  }
+
+  // Get the data of all receivers in a single request to the controller. Returns a promise of e.g.:
+  //   {receivers: {'192.168.0.2': {success: true, latency_ms: 12.3, data: {...}}, ...}, success: true}
+  // or of null if no receiver's data changed since the last call.
+  getReceiversData() {
+    return this.getIfModified(
+      this.controller_client, '/api/receivers', this.receivers_data_etag,
+      (etag) => { this.receivers_data_etag = etag; }
+    );
+  }
+
+  // Make a conditional GET request. Returns a promise of the response data, or of null if the server replied 304 Not
+  // Modified, i.e. the data we have, identified by etag, is current. setEtag is called with the response's ETag.
+  getIfModified(client, url, etag, setEtag) {
+    return client.get(url, {
+      headers: etag ? {'If-None-Match': etag} : {},
+      validateStatus: (status) => status === 200 || status === 304
+    }).then(resp => {
+      setEtag(resp.headers['etag'] || (resp.status === 304 ? etag : null));
+      return resp.status === 304 ? null : resp.data;
+    });
+  }
+
+  // Subscribe to a stream of the receiver's data. onState is called with the full receiver data when the stream
+  // connects, and onDelta is called with just the keys that changed whenever the receiver data changes.
+  // Returns the EventSource, which the caller should close when it is done with it.
+  subscribeToReceiverEvents(receiver, onState, onDelta, onError) {
+    var event_source = new EventSource(this.getBaseURL(receiver) + '/receiver_events');
+    event_source.addEventListener('state', (event) => onState(JSON.parse(event.data)));
+    event_source.addEventListener('delta', (event) => onDelta(JSON.parse(event.data)));
+    event_source.onerror = onError;
+    return event_source;
   }
 
+  // Sends the volume over the receiver's volume channel (a WebSocket) if possible, else via a regular request.
+  // Returns a promise of the receiver's response, e.g.: {vol_pct: 50, success: true}
   setVolPct(receiver, vol_pct, set_airplay_client_vol) {
-    return this.perform(receiver, 'post', '/vol_pct', {
-      vol_pct: vol_pct,
-      set_airplay_client_vol: set_airplay_client_vol
+    var channel = this.getVolPctChannel(receiver);
+    if (!channel) {
+      return this.perform(receiver, 'post', '/vol_pct', {
+        vol_pct: vol_pct,
+        set_airplay_client_vol: set_airplay_client_vol
+      });
+    }
+
+    channel.seq += 1;
+    channel.last_message = {seq: channel.seq, vol_pct: vol_pct, set_airplay_client_vol: set_airplay_client_vol};
+    if (channel.socket.readyState === WebSocket.OPEN) {
+      channel.socket.send(JSON.stringify(channel.last_message));
+    } else {
+      // Still connecting. Only the latest volume matters: it will be sent once we're connected.
+      channel.unsent_message = channel.last_message;
+    }
+    return new Promise((resolve) => {
+      channel.pending_acks.push({seq: channel.seq, resolve: resolve});
     });
   }
 
+  // Open the receiver's volume channel ahead of a burst of volume changes, e.g. when the user starts dragging
+  // the volume slider.
+  openVolPctChannel(receiver) {
+    this.getVolPctChannel(receiver);
+  }
+
+  // Returns the receiver's volume channel, opening it if necessary, or null if WebSockets are unsupported.
+  //
+  // Each volume sent over the channel has a sequence number. The receiver acks the volumes it applies with their
+  // sequence number, and skips volumes that are older than one it already applied. So a volume's promise resolves
+  // with the ack of the first volume at least as new as it.
+  getVolPctChannel(receiver) {
+    if (typeof WebSocket === 'undefined') {
+      return null;
+    }
+    if (receiver in this.vol_pct_channels) {
+      return this.vol_pct_channels[receiver];
+    }
+
+    var protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+    var channel = {
+      socket: new WebSocket(protocol + this.getBaseURL(receiver) + '/vol_pct_ws'),
+      seq: 0,
+      pending_acks: [],
+      last_message: null,
+      unsent_message: null,
+    };
+    channel.socket.onopen = () => {
+      if (channel.unsent_message) {
+        channel.socket.send(JSON.stringify(channel.unsent_message));
+        channel.unsent_message = null;
+      }
+    };
+    channel.socket.onmessage = (event) => {
+      var ack = JSON.parse(event.data);
+      channel.pending_acks = channel.pending_acks.filter((pending_ack) => {
+        if (pending_ack.seq <= ack.seq) {
+          pending_ack.resolve(ack);
+          return false;
+        }
+        return true;
+      });
+    };
+    channel.socket.onclose = () => {
+      delete this.vol_pct_channels[receiver];
+      if (channel.pending_acks.length === 0) {
+        return;
+      }
+
+      // We don't know whether the latest volume was applied: send it via a regular request instead.
+      var pending_acks = channel.pending_acks;
+      channel.pending_acks = [];
+      this.perform(receiver, 'post', '/vol_pct', {
+        vol_pct: channel.last_message.vol_pct,
+        set_airplay_client_vol: channel.last_message.set_airplay_client_vol
+      }).then(
+        (data) => pending_acks.forEach((pending_ack) => pending_ack.resolve(data)),
+        () => pending_acks.forEach((pending_ack) => pending_ack.resolve({success: false}))
+      );
+    };
+    this.vol_pct_channels[receiver] = channel;
+    return channel;
+  }
+
+  // Send a command to all receivers of a group at once, via the controller. command is one of 'vol_pct',
+  // 'make_bt_discoverable', or 'disconnect_clients'. Returns a promise of each receiver's result, e.g.:
+  //   {receivers: {'192.168.0.2': {success: true, latency_ms: 12.3, data: {...}}, ...}, success: true}
+  groupCommand(group, command, data = {}) {
+    return this.controller_client.post('/api/group_command', {
+      group: group,
+      command: command,
+      data: data
+    }).then(resp => resp.data);
+  }
+
   makeBtDiscoverable(receiver) {
     return this.perform(receiver, 'post', '/make_bt_discoverable', {});
   }
@@ -5,18 +5,26 @@ import config from 'config.json';
 
 import './app.css';
 import Receiver from '../receiver/receiver';
+import ReceiverGroup from '../receivergroup/receivergroup';
 
 class App extends React.Component {
 
   static RECEIVER_POLL_INTERVAL_MS = 1000;
 
+  // If a receiver's event stream fails, we poll the receiver instead, and retry the stream after this long.
+  static RECEIVER_EVENTS_RETRY_INTERVAL_MS = 10000;
+
+  static RECEIVER_DATA_KEYS = [
+    'vol_pct', 'hostname', 'bt_discoverable', 'bt_discoverable_job', 'shairport_sync_client_name',
+    'shairport_sync_player_state'
+  ];
+
   constructor(props) {
     super(props);
 
     var receivers = {};
     config.receivers.forEach(function (receiver, index) {
       receivers[receiver] = {};
-      receivers[receiver]['is_poll_in_progress'] = false;
       receivers[receiver]['vol_pct'] = undefined;
     });
 
@@ -26,14 +34,29 @@ class App extends React.Component {
 
     this.apiClient = new APIClient(config.receivers);
     this.setVolPct = this.setVolPct.bind(this);
+    this.openVolPctChannel = this.openVolPctChannel.bind(this);
     this.makeBtDiscoverable = this.makeBtDiscoverable.bind(this);
     this.disconnectClients = this.disconnectClients.bind(this);
-    this.receiver_poll_timeout = {};
+    this.groupCommand = this.groupCommand.bind(this);
+    this.receivers_poll_timeout = null;
+    this.is_receivers_poll_in_progress = false;
+    this.receiver_event_sources = {};
+    this.receiver_events_retry_timeout = {};
   }
 
   componentDidMount() {
     for (var receiver in this.state.receivers) {
-      this.getReceiverData(receiver);
+      this.subscribeToReceiverEvents(receiver);
+    }
+  }
+
+  componentWillUnmount() {
+    clearTimeout(this.receivers_poll_timeout);
+    for (var receiver in this.state.receivers) {
+      clearTimeout(this.receiver_events_retry_timeout[receiver]);
+      if (receiver in this.receiver_event_sources) {
+        this.receiver_event_sources[receiver].close();
+      }
     }
   }
 
@@ -49,13 +72,22 @@ class App extends React.Component {
               hostname = {this.state.receivers[receiver]['hostname']}
               vol_pct = {this.state.receivers[receiver]['vol_pct']}
               setVolPct = {this.setVolPct}
+              openVolPctChannel = {this.openVolPctChannel}
               makeBtDiscoverable = {this.makeBtDiscoverable}
               bt_discoverable = {this.state.receivers[receiver]['bt_discoverable']}
+              bt_discoverable_job = {this.state.receivers[receiver]['bt_discoverable_job']}
               shairport_sync_client_name = {this.state.receivers[receiver]['shairport_sync_client_name']}
               shairport_sync_player_state = {this.state.receivers[receiver]['shairport_sync_player_state']}
               disconnectClients = {this.disconnectClients}
             />
           }.bind(this))}
+          {Object.keys(config.receiver_groups || {}).map(function(group, index) {
+            return <ReceiverGroup
+              key = {index}
+              group = {group}
+              groupCommand = {this.groupCommand}
+            />
+          }.bind(this))}
         </div>
       </div>
     );
@@ -65,6 +97,10 @@ class App extends React.Component {
     return this.apiClient.setVolPct(receiver, vol_pct, set_airplay_client_vol)
   }
 
+  openVolPctChannel(receiver) {
+    this.apiClient.openVolPctChannel(receiver);
+  }
+
   makeBtDiscoverable(receiver) {
     return this.apiClient.makeBtDiscoverable(receiver);
   }
@@ -73,47 +109,103 @@ class App extends React.Component {
     return this.apiClient.disconnectClients(receiver);
   }
 
-  cancelReceiverPoll(receiver) {
-    if (receiver in this.receiver_poll_timeout) {
-      clearTimeout(this.receiver_poll_timeout[receiver]);
-    }
+  // The receivers' new state reaches us via their event streams, or the next poll.
+  groupCommand(group, command, data = {}) {
+    return this.apiClient.groupCommand(group, command, data);
   }
 
-  getReceiverData(receiver) {
-    if (this.state.receivers[receiver]['is_poll_in_progress']) {
-      this.cancelReceiverPoll(receiver);
-      this.receiver_poll_timeout[receiver] = setTimeout(this.getReceiverData.bind(this, receiver), App.RECEIVER_POLL_INTERVAL_MS);
+  // Receive the receiver's data as it changes, via its event stream. If the stream is unavailable, fall back to
+  // polling.
+  //
+  // Event streams are opened to each receiver directly, rather than through the controller like polls: an idle
+  // stream costs no requests or CORS preflights, so there is little to gain from aggregating them, and the
+  // controller would have to hold a connection per receiver for every client. See ControllerAPI.
+  subscribeToReceiverEvents(receiver) {
+    if (typeof EventSource === 'undefined') {
+      this.pollReceivers();
       return;
     }
 
+    this.receiver_event_sources[receiver] = this.apiClient.subscribeToReceiverEvents(
+      receiver,
+      (data) => this.updateReceiver(receiver, data),
+      (changes) => this.updateReceiver(receiver, changes),
+      () => this.onReceiverEventsError(receiver)
+    );
+  }
 
-    var new_receivers = this.cloneReceivers();
-    new_receivers[receiver]['is_poll_in_progress'] = true;
-    this.setState({receivers: new_receivers});
+  onReceiverEventsError(receiver) {
+    // Stop the EventSource from reconnecting on its own: poll instead until we retry the stream.
+    this.receiver_event_sources[receiver].close();
+    delete this.receiver_event_sources[receiver];
+    this.pollReceivers();
 
-    var response = null;
+    clearTimeout(this.receiver_events_retry_timeout[receiver]);
+    this.receiver_events_retry_timeout[receiver] = setTimeout(
+      this.subscribeToReceiverEvents.bind(this, receiver), App.RECEIVER_EVENTS_RETRY_INTERVAL_MS
+    );
+  }
+
+  isReceiverStreaming(receiver) {
+    return receiver in this.receiver_event_sources &&
+      this.receiver_event_sources[receiver].readyState === EventSource.OPEN;
+  }
+
+  // Poll the receivers that aren't streaming their data, via a single request to the controller for all
+  // receivers. Polling stops once every receiver is streaming.
+  pollReceivers() {
+    var polled_receivers = Object.keys(this.state.receivers).filter(
+      (receiver) => !this.isReceiverStreaming(receiver)
+    );
+    if (polled_receivers.length === 0 || this.is_receivers_poll_in_progress) {
+      return;
+    }
+
+    clearTimeout(this.receivers_poll_timeout);
+    this.is_receivers_poll_in_progress = true;
     return this.apiClient
-      .getReceiverData(receiver)
+      .getReceiversData()
       .then((data) => {
-        if (data.success) {
-          data.vol_pct = +(data.vol_pct.toFixed(0));
-          response = data;
+        // Nothing changed since the last poll: skip re-rendering
+        if (data === null) {
+          return;
         }
+        var data_by_receiver = {};
+        polled_receivers.forEach((receiver) => {
+          var result = data.receivers[receiver];
+          if (result && result.success && result.data.success && !this.isReceiverStreaming(receiver)) {
+            data_by_receiver[receiver] = result.data;
+          }
+        });
+        this.updateReceivers(data_by_receiver);
       })
+      .catch(() => {})
       .finally(() => {
-        this.receiver_poll_timeout[receiver] = setTimeout(this.getReceiverData.bind(this, receiver), App.RECEIVER_POLL_INTERVAL_MS);
-
-        var new_receivers = this.cloneReceivers()
-        if (response.success) {
-          new_receivers[receiver]['vol_pct'] = response.vol_pct;
-          new_receivers[receiver]['hostname'] = response.hostname;
-          new_receivers[receiver]['bt_discoverable'] = response.bt_discoverable;
-          new_receivers[receiver]['shairport_sync_client_name'] = response.shairport_sync_client_name;
-          new_receivers[receiver]['shairport_sync_player_state'] = response.shairport_sync_player_state;
+        this.is_receivers_poll_in_progress = false;
+        this.receivers_poll_timeout = setTimeout(this.pollReceivers.bind(this), App.RECEIVER_POLL_INTERVAL_MS);
+      });
+  }
+
+  // data: the full receiver data, or just the keys of it that changed
+  updateReceiver(receiver, data) {
+    this.updateReceivers({[receiver]: data});
+  }
+
+  // data_by_receiver: the data of each receiver to update, as in updateReceiver
+  updateReceivers(data_by_receiver) {
+    var new_receivers = this.cloneReceivers();
+    for (var receiver in data_by_receiver) {
+      var data = data_by_receiver[receiver];
+      App.RECEIVER_DATA_KEYS.forEach(function (key) {
+        if (key in data) {
+          new_receivers[receiver][key] = data[key];
         }
-        new_receivers[receiver]['is_poll_in_progress'] = false;
-        this.setState({receivers: new_receivers});
       });
+      if ('vol_pct' in data) {
+        new_receivers[receiver]['vol_pct'] = +(data.vol_pct.toFixed(0));
+      }
+    }
+    this.setState({receivers: new_receivers});
   }
 
   cloneReceivers() {
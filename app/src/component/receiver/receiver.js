@@ -20,7 +20,13 @@ class Receiver extends React.Component {
   }
 
   render() {
-    var bluetooth_class = (this.props.bt_discoverable ? 'bt-discoverable' : 'bt-not-discoverable') + ' bi bi-bluetooth clickable receiver-icon';
+    var bluetooth_class = 'bt-not-discoverable';
+    if (this.props.bt_discoverable) {
+      bluetooth_class = 'bt-discoverable';
+    } else if (this.isBtDiscoverableJobRunning()) {
+      bluetooth_class = 'bt-discoverable-pending';
+    }
+    bluetooth_class += ' bi bi-bluetooth clickable receiver-icon';
     var connected_client_elements = '';
     if (this.props.shairport_sync_client_name) {
       connected_client_elements = <span className="text-subtle"><span style={{"margin-left":0,"margin-right":"4px",}} className='glyphicon glyphicon-link receiver-icon' aria-hidden='true' /><span>{this.props.shairport_sync_client_name}</span></span>;
@@ -54,12 +60,18 @@ class Receiver extends React.Component {
   }
 
   handleBluetoothClick = () => {
-    if (this.props.bt_discoverable) {
+    if (this.props.bt_discoverable || this.isBtDiscoverableJobRunning()) {
       return;
     }
     this.props.makeBtDiscoverable(this.props.receiver)
   };
 
+  // Making bluetooth discoverable takes a few seconds. The receiver reports the job's phase as it goes.
+  isBtDiscoverableJobRunning() {
+    var job = this.props.bt_discoverable_job;
+    return !!job && job.phase !== 'done' && job.phase !== 'failed';
+  }
+
   handleDisconnectClick = () => {
     this.props.disconnectClients(this.props.receiver)
   };
@@ -70,6 +82,8 @@ class Receiver extends React.Component {
   };
 
   grabVolMutex = () => {
+    // Get the volume channel ready for the volume changes that the slider drag is about to send
+    this.props.openVolPctChannel(this.props.receiver);
     this.setState({
       is_vol_locked: true,
       is_vol_lock_releasable: false
@@ -0,0 +1,42 @@
+import React from 'react';
+import '../receiver/receiver.css';
+
+// Controls for all receivers of a group at once. Each command is sent to the controller, which forwards it to the
+// group's receivers in parallel.
+class ReceiverGroup extends React.Component {
+
+  static VOL_PCT_INC = 5;
+
+  render() {
+    return (
+      <div className='receiver'>
+        <h6>
+          {this.props.group}
+          <span onClick={this.handleVolDownClick} className='glyphicon glyphicon-volume-down clickable receiver-icon' aria-hidden='true' />
+          <span onClick={this.handleVolUpClick} className='glyphicon glyphicon-volume-up clickable receiver-icon' aria-hidden='true' />
+          <svg onClick={this.handleBluetoothClick} xmlns="http://www.w3.org/2000/svg" fill="currentColor" className='bt-not-discoverable bi bi-bluetooth clickable receiver-icon' viewBox="0 0 16 16"><path fillRule="evenodd" d="m8.543 3.948 1.316 1.316L8.543 6.58V3.948Zm0 8.104 1.316-1.316L8.543 9.42v2.632Zm-1.41-4.043L4.275 5.133l.827-.827L7.377 6.58V1.128l4.137 4.136L8.787 8.01l2.745 2.745-4.136 4.137V9.42l-2.294 2.274-.827-.827L7.133 8.01ZM7.903 16c3.498 0 5.904-1.655 5.904-8.01 0-6.335-2.406-7.99-5.903-7.99C4.407 0 2 1.655 2 8.01 2 14.344 4.407 16 7.904 16Z"/></svg>
+          <span onClick={this.handleDisconnectClick} style={{color: "#d94848"}} className='glyphicon glyphicon-remove clickable receiver-icon' aria-hidden='true' />
+        </h6>
+      </div>
+    );
+  }
+
+  handleVolDownClick = () => {
+    this.props.groupCommand(this.props.group, 'vol_pct', {vol_pct_inc: -ReceiverGroup.VOL_PCT_INC, set_airplay_client_vol: false});
+  };
+
+  handleVolUpClick = () => {
+    this.props.groupCommand(this.props.group, 'vol_pct', {vol_pct_inc: ReceiverGroup.VOL_PCT_INC, set_airplay_client_vol: false});
+  };
+
+  handleBluetoothClick = () => {
+    this.props.groupCommand(this.props.group, 'make_bt_discoverable');
+  };
+
+  handleDisconnectClick = () => {
+    this.props.groupCommand(this.props.group, 'disconnect_clients');
+  };
+
+}
+
+export default ReceiverGroup;
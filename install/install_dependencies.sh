@@ -68,7 +68,7 @@ updateAndInstallPackages(){
     sudo apt -y install git python3-pip libasound2-dev
     sudo apt -y full-upgrade
 
-    sudo python3 -m pip install --upgrade pytz simpleaudio pyjson5
+    sudo python3 -m pip install --upgrade simpleaudio pyjson5 jeepney brotli
 }
 
 installNode(){
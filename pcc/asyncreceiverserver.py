@@ -0,0 +1,371 @@
+import asyncio
+import json
+import threading
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from pcc.config import Config
+from pcc.logger import Logger
+from pcc.receiverserver import PccReceiverServerRequestHandler, ReceiverAPI
+from pcc.requestdispatcher import RequestDispatcher
+from pcc.spans import Spans
+from pcc.websocket import WebSocket
+
+# Serves the receiver API (see ReceiverAPI) from a single asyncio event loop, which reads requests from all connections.
+# Selected via the `receiver.server_engine` config setting, see ReceiverServer.
+#
+# Idle keep-alive connections and event streams (/receiver_events) are coroutines, so they cost almost nothing
+# while they wait. Requests to the JSON API routes run on a small pool of worker threads, because the API's calls
+# may block: shelling out to systemctl, waiting for a volume to be written, etc. Most requests are served from
+# memory and return right away.
+#
+# Volume channels (/vol_pct_ws) each run in their own thread, reusing the same WebSocket code as the threading
+# engine. There are few of them: one per web app client, up to `receiver.max_streams`.
+#
+# Like the threading engine (see PccReceiverThreadingHTTPServer), POST requests run on workers of their own, so that
+# they aren't stuck behind polls, and requests are rejected with a 503 once too many are waiting for a worker.
+#
+# Only the subset of HTTP/1.1 that our clients use is supported: requests must not have a chunked body.
+class AsyncReceiverServer:
+
+    # See PccReceiverServerRequestHandler
+    __IDLE_TIMEOUT_S = PccReceiverServerRequestHandler.timeout
+    __EVENT_STREAM_KEEPALIVE_INTERVAL_S = 15
+
+    __MAX_NUM_HEADERS = 100
+    __MAX_BODY_SIZE = 64 * 1024
+
+    # api: a ReceiverAPI
+    # server_address: a tuple of (host, port)
+    def __init__(self, api, server_address):
+        self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__api = api
+        self.__server_address = server_address
+        num_workers = Config.get('receiver.asyncio_worker_threads', 4)
+        max_queued_requests = Config.get('receiver.max_queued_requests', 32)
+
+        # The same lanes as the threading engine, see RequestDispatcher
+        num_workers_by_lane = {
+            RequestDispatcher.LANE_NORMAL: num_workers,
+            RequestDispatcher.LANE_PRIORITY: max(1, Config.get('receiver.priority_worker_threads', 2)),
+            RequestDispatcher.LANE_SLOW: max(1, Config.get('receiver.slow_worker_threads', 1)),
+        }
+        self.__executors = {
+            lane: ThreadPoolExecutor(
+                max_workers = num_lane_workers, thread_name_prefix = f'ReceiverAPIWorker-{lane}'
+            )
+            for lane, num_lane_workers in num_workers_by_lane.items()
+        }
+        self.__retry_after_s = Config.get('receiver.retry_after_s', 1)
+
+        # Keyed by lane. Only touched from the event loop's thread.
+        self.__max_pending_requests = {
+            lane: num_lane_workers + max_queued_requests for lane, num_lane_workers in num_workers_by_lane.items()
+        }
+        self.__num_pending_requests = {lane: 0 for lane in num_workers_by_lane}
+
+        self.__max_vol_pct_channels = Config.get('receiver.max_streams', 32)
+        self.__num_vol_pct_channels = 0
+
+    def serve_forever(self):
+        asyncio.run(self.__serve_forever())
+
+    async def __serve_forever(self):
+        server = await asyncio.start_server(
+            self.__handle_connection, self.__server_address[0], self.__server_address[1], backlog = 128
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def __handle_connection(self, reader, writer):
+        client_ip = writer.get_extra_info('peername')[0]
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self.__read_request(reader), timeout = self.__IDLE_TIMEOUT_S)
+                except ValueError as e:
+                    self.__logger.warning(f'{client_ip} - - Bad request: {e}')
+                    await self.__write_response(writer, HTTPStatus.BAD_REQUEST, keep_alive = False)
+                    return
+                if request is None:
+                    return
+                request['received_at'] = time.perf_counter()
+                keep_alive = await self.__handle_request(client_ip, request, reader, writer)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            # The connection was idle for too long, or the client went away
+            pass
+        except Exception:
+            self.__logger.error(f'{client_ip} - - Exception: {traceback.format_exc()}')
+        finally:
+            writer.close()
+
+    # Returns a dict describing the request, or None if the client closed the connection. Raises ValueError if the
+    # request is malformed.
+    async def __read_request(self, reader):
+        request_line = b''
+        while not request_line.strip():
+            request_line = await reader.readline()
+            if not request_line:
+                return None
+        request_line = request_line.decode('latin-1').rstrip('\r\n')
+        parts = request_line.split()
+        if len(parts) != 3:
+            raise ValueError(f'Invalid request line: {request_line}')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= self.__MAX_NUM_HEADERS:
+                raise ValueError('Too many headers.')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'transfer-encoding' in headers:
+            raise ValueError('Chunked request bodies are not supported.')
+        content_length = int(headers.get('content-length', 0))
+        if content_length < 0 or content_length > self.__MAX_BODY_SIZE:
+            raise ValueError(f'Invalid Content-Length: {content_length}')
+        body = await reader.readexactly(content_length) if content_length else b''
+
+        method, target, version = parts
+        return {
+            'request_line': request_line,
+            'method': method,
+            'target': target,
+            'version': version,
+            'headers': headers,
+            'body': body,
+        }
+
+    # Returns whether the connection may be used for another request.
+    async def __handle_request(self, client_ip, request, reader, writer):
+        method = request['method']
+        parsed_path = urllib.parse.urlparse(request['target'])
+        keep_alive = request['version'] == 'HTTP/1.1' and request['headers'].get('connection', '').lower() != 'close'
+
+        if method == 'OPTIONS':
+            status = HTTPStatus.OK
+            await self.__write_response(writer, status, {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'X-Requested-With, Content-Type, If-None-Match',
+                'Access-Control-Max-Age': str(PccReceiverServerRequestHandler.CORS_MAX_AGE_S),
+            }, keep_alive = keep_alive)
+            self.__log_request(client_ip, request, status)
+            return keep_alive
+
+        if method == 'GET' and parsed_path.path == '/receiver_events':
+            self.__log_request(client_ip, request, HTTPStatus.OK)
+            await self.__stream_receiver_events(writer)
+            return False
+
+        if method == 'GET' and parsed_path.path == '/vol_pct_ws':
+            await self.__serve_vol_pct_websocket(client_ip, request, reader, writer)
+            return False
+
+        if method not in ('GET', 'POST'):
+            status = HTTPStatus.NOT_IMPLEMENTED
+            await self.__write_response(writer, status, keep_alive = keep_alive)
+            self.__log_request(client_ip, request, status)
+            return keep_alive
+
+        if method == 'GET':
+            data = urllib.parse.unquote(parsed_path.query)
+        else:
+            data = request['body'].decode('utf-8')
+        data = json.loads(data) if data else None
+
+        lane = RequestDispatcher.get_lane(request['request_line'].encode('latin-1'))
+        if self.__num_pending_requests[lane] >= self.__max_pending_requests[lane]:
+            await self.__write_unavailable(client_ip, request, writer)
+            return False
+
+        self.__num_pending_requests[lane] += 1
+        try:
+            response, spans = await asyncio.get_running_loop().run_in_executor(
+                self.__executors[lane], self.__handle_api_request, method, parsed_path.path, data,
+                request['headers'].get('if-none-match')
+            )
+        except Exception:
+            # Like the threading engine, close the connection without a response.
+            self.__logger.error(f'{client_ip} - - Exception: {traceback.format_exc()}')
+            return False
+        finally:
+            self.__num_pending_requests[lane] -= 1
+
+        server_timing = None
+        if response is None:
+            status = HTTPStatus.NOT_FOUND
+            await self.__write_response(writer, status, keep_alive = keep_alive)
+        else:
+            status, headers, body = ReceiverAPI.encode_response(response, spans)
+            spans.add('total', time.perf_counter() - request['received_at'])
+            server_timing = spans.to_server_timing()
+            await self.__write_response(writer, status, {
+                'Access-Control-Allow-Origin': '*',
+                **headers,
+                'Server-Timing': server_timing,
+                'Timing-Allow-Origin': '*',
+            }, body, keep_alive = keep_alive)
+        self.__log_request(client_ip, request, status, server_timing)
+        return keep_alive
+
+    # Runs on a worker thread. Returns a tuple of the response, and a SpanRecorder of the spans recorded while handling
+    # the request. See ReceiverAPI.handle_request.
+    def __handle_api_request(self, method, path, data, if_none_match):
+        with Spans.record() as spans:
+            return self.__api.handle_request(method, path, data, if_none_match), spans
+
+    # See PccReceiverServerRequestHandler.__stream_receiver_events
+    async def __stream_receiver_events(self, writer):
+        loop = asyncio.get_running_loop()
+        has_changes = asyncio.Event()
+        subscription = self.__api.subscribe_to_receiver_data(
+            on_publish = lambda: loop.call_soon_threadsafe(has_changes.set)
+        )
+        try:
+            state = await loop.run_in_executor(self.__executors[RequestDispatcher.LANE_NORMAL], self.__api.get_receiver_data)
+            self.__write_head(writer, HTTPStatus.OK, {
+                'Access-Control-Allow-Origin': '*',
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+                # The stream has no Content-Length: it ends when the connection is closed
+                'Connection': 'close',
+            })
+            await self.__write_event(writer, 'state', state)
+
+            while True:
+                try:
+                    await asyncio.wait_for(has_changes.wait(), timeout = self.__EVENT_STREAM_KEEPALIVE_INTERVAL_S)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                    await writer.drain()
+                    continue
+
+                has_changes.clear()
+                changes = subscription.get_changes(timeout = 0)
+                if changes:
+                    await self.__write_event(writer, 'delta', changes)
+        finally:
+            self.__api.unsubscribe_from_receiver_data(subscription)
+
+    async def __write_event(self, writer, event, data):
+        writer.write(bytes(f'event: {event}\ndata: {json.dumps(data)}\n\n', 'utf-8'))
+        await writer.drain()
+
+    # See ReceiverAPI.serve_vol_pct_channel
+    async def __serve_vol_pct_websocket(self, client_ip, request, reader, writer):
+        key = request['headers'].get('sec-websocket-key')
+        if request['headers'].get('upgrade', '').lower() != 'websocket' or not key:
+            status = HTTPStatus.BAD_REQUEST
+            await self.__write_response(writer, status, keep_alive = False)
+            self.__log_request(client_ip, request, status)
+            return
+
+        if self.__num_vol_pct_channels >= self.__max_vol_pct_channels:
+            await self.__write_unavailable(client_ip, request, writer)
+            return
+
+        status = HTTPStatus.SWITCHING_PROTOCOLS
+        self.__write_head(writer, status, {
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-WebSocket-Accept': WebSocket.make_accept_key(key),
+        })
+        await writer.drain()
+        self.__log_request(client_ip, request, status)
+
+        loop = asyncio.get_running_loop()
+        is_done = loop.create_future()
+        stream = BlockingStreamAdapter(loop, reader, writer)
+
+        def serve_vol_pct_channel():
+            try:
+                self.__api.serve_vol_pct_channel(WebSocket(stream, stream))
+            except Exception:
+                self.__logger.error(f'{client_ip} - - Exception: {traceback.format_exc()}')
+            finally:
+                loop.call_soon_threadsafe(is_done.set_result, None)
+
+        self.__num_vol_pct_channels += 1
+        try:
+            threading.Thread(target = serve_vol_pct_channel, name = 'VolPctChannel', daemon = True).start()
+            await is_done
+        finally:
+            self.__num_vol_pct_channels -= 1
+
+    # Shed load: reject the request, and ask the client to retry later. See `receiver.max_queued_requests`.
+    async def __write_unavailable(self, client_ip, request, writer):
+        status = HTTPStatus.SERVICE_UNAVAILABLE
+        await self.__write_response(writer, status, {
+            'Access-Control-Allow-Origin': '*',
+            'Retry-After': str(self.__retry_after_s),
+        }, keep_alive = False)
+        self.__log_request(client_ip, request, status)
+
+    async def __write_response(self, writer, status, headers = {}, body = b'', keep_alive = True):
+        headers = dict(headers)
+        # A 304 response has no body, and its Content-Length would be taken as that of the client's copy.
+        if status != HTTPStatus.NOT_MODIFIED:
+            headers['Content-Length'] = str(len(body))
+        if not keep_alive:
+            headers['Connection'] = 'close'
+        self.__write_head(writer, status, headers)
+        writer.write(body)
+        await writer.drain()
+
+    def __write_head(self, writer, status, headers):
+        head = f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+        for name, value in headers.items():
+            head += f'{name}: {value}\r\n'
+        writer.write(bytes(head + '\r\n', 'latin-1'))
+
+    # Also records the request in the metrics, see ReceiverAPI.observe_request
+    # server_timing: the response's Server-Timing header, if any. Logged if `receiver.log_server_timing` is set.
+    def __log_request(self, client_ip, request, status, server_timing = None):
+        self.__api.observe_request(
+            request['method'], urllib.parse.urlparse(request['target']).path, status.value,
+            time.perf_counter() - request['received_at']
+        )
+        if server_timing and Config.get('receiver.log_server_timing', False):
+            self.__logger.info(
+                f'{client_ip} - - [REQUEST] "{request["request_line"]}" {status.value} timing="{server_timing}"'
+            )
+        else:
+            self.__logger.info(f'{client_ip} - - [REQUEST] "{request["request_line"]}" {status.value}')
+
+# Gives blocking, file-like access to an asyncio connection, for code that runs in another thread, e.g. the
+# WebSocket class. Must not be used from the event loop's thread.
+class BlockingStreamAdapter:
+
+    def __init__(self, loop, reader, writer):
+        self.__loop = loop
+        self.__reader = reader
+        self.__writer = writer
+
+    # Like a file's read: returns fewer than num_bytes bytes only if the connection was closed.
+    def read(self, num_bytes):
+        return asyncio.run_coroutine_threadsafe(self.__read(num_bytes), self.__loop).result()
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self.__write(data), self.__loop).result()
+
+    # Writes are flushed as they are made
+    def flush(self):
+        pass
+
+    async def __read(self, num_bytes):
+        try:
+            return await self.__reader.readexactly(num_bytes)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def __write(self, data):
+        self.__writer.write(data)
+        await self.__writer.drain()
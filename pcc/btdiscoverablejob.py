@@ -0,0 +1,75 @@
+import threading
+import time
+import uuid
+
+# The progress of making bluetooth discoverable, which runs in the background because it takes several seconds.
+# See ReceiverAPI.make_bt_discoverable.
+class BtDiscoverableJob:
+
+    # Ensure only one process makes bluetooth (un)discoverable at a time
+    LOCK_FILE = '/tmp/pcc_bt_discoverable_lock_file'
+
+    # The mtime of this file (if it exists) represents when we last made bluetooth discoverable
+    SUCCESS_FILE = '/tmp/pcc_bt_discoverable_success_file'
+
+    # The phases a job goes through, in order. A job ends in either PHASE_DONE or PHASE_FAILED.
+    PHASE_PENDING = 'pending'
+    PHASE_RESTARTING_SERVICES = 'restarting_services'
+    PHASE_WAITING_FOR_ADAPTER = 'waiting_for_adapter'
+    PHASE_MAKING_DISCOVERABLE = 'making_discoverable'
+    PHASE_DONE = 'done'
+    PHASE_FAILED = 'failed'
+
+    # on_phase_change: optional function to call, without arguments, whenever the job enters a new phase
+    def __init__(self, on_phase_change = None):
+        self.job_id = uuid.uuid4().hex
+        self.__on_phase_change = on_phase_change
+        self.__lock = threading.Lock()
+        self.__start = time.monotonic()
+        self.__phases = []
+        self.__error = None
+        self.set_phase(self.PHASE_PENDING)
+
+    def set_phase(self, phase, error = None):
+        with self.__lock:
+            self.__phases.append((phase, time.monotonic()))
+            if error is not None:
+                self.__error = error
+        if self.__on_phase_change is not None:
+            self.__on_phase_change()
+
+    def fail(self, error):
+        self.set_phase(self.PHASE_FAILED, error)
+
+    def is_finished(self):
+        return self.get_phase() in (self.PHASE_DONE, self.PHASE_FAILED)
+
+    def get_phase(self):
+        with self.__lock:
+            return self.__phases[-1][0]
+
+    # Returns e.g.:
+    #   {
+    #       "job_id": "9f1c...",
+    #       "phase": "waiting_for_adapter",
+    #       "is_finished": false,
+    #       "error": null,
+    #       "elapsed_s": 1.52,
+    #       "phases": [{"phase": "pending", "elapsed_s": 0}, {"phase": "restarting_services", "elapsed_s": 0.001}, ...]
+    #   }
+    # where each phase's elapsed_s is when the job entered it, relative to when the job was created.
+    def to_dict(self):
+        with self.__lock:
+            phase = self.__phases[-1][0]
+            end = self.__phases[-1][1] if phase in (self.PHASE_DONE, self.PHASE_FAILED) else time.monotonic()
+            return {
+                'job_id': self.job_id,
+                'phase': phase,
+                'is_finished': phase in (self.PHASE_DONE, self.PHASE_FAILED),
+                'error': self.__error,
+                'elapsed_s': round(end - self.__start, 3),
+                'phases': [
+                    {'phase': phase, 'elapsed_s': round(entered_at - self.__start, 3)}
+                    for phase, entered_at in self.__phases
+                ],
+            }
@@ -0,0 +1,106 @@
+import atexit
+import threading
+
+# Writes log lines in batches from a background thread, rather than with a `write` syscall per line. See
+# Logger.set_mode.
+#
+# Lines are buffered in memory until either:
+# * flush_interval_s seconds have passed since the first buffered line
+# * batch_size lines are buffered
+# * a line is written with `flush = True`, e.g. a warning or error. It is flushed before `write` returns.
+# * the process exits
+#
+# The buffer is bounded: if it holds max_buffered_lines lines, the writer flushes it itself, so that logging can't
+# use unbounded memory, nor lose lines.
+#
+# Lines are written in the order they were logged, even across files (e.g. stdout and stderr).
+#
+# Once the writer is no longer needed, close it, which flushes it and stops its thread.
+class BufferedLogWriter:
+
+    def __init__(self, flush_interval_s = 0.5, batch_size = 256, max_buffered_lines = 4096):
+        self.__flush_interval_s = flush_interval_s
+        self.__batch_size = batch_size
+        self.__max_buffered_lines = max_buffered_lines
+
+        # A list of (file, line) tuples
+        self.__lines = []
+        self.__lock = threading.Lock()
+        self.__has_lines = threading.Condition(self.__lock)
+
+        # Held while writing a batch, so that batches are written in order
+        self.__write_lock = threading.Lock()
+        self.__is_closed = False
+
+        threading.Thread(target = self.__write_batches, name = 'BufferedLogWriter', daemon = True).start()
+        atexit.register(self.flush)
+
+    def write(self, file, line, flush = False):
+        with self.__lock:
+            self.__lines.append((file, line))
+            if self.__is_closed:
+                # A line logged by a thread that got hold of the writer just before it was closed: there is no thread
+                # left to write it, so write it now.
+                flush = True
+            num_lines = len(self.__lines)
+            if num_lines == 1 or num_lines == self.__batch_size:
+                self.__has_lines.notify()
+        if flush or num_lines >= self.__max_buffered_lines:
+            self.flush()
+
+    # Write all buffered lines, and flush the files they were written to.
+    def flush(self):
+        with self.__write_lock:
+            with self.__lock:
+                lines = self.__lines
+                self.__lines = []
+            if not lines:
+                return
+
+            # Write consecutive lines to the same file with a single call
+            files = []
+            run_file = lines[0][0]
+            run = []
+            for file, line in lines:
+                if file is not run_file:
+                    self.__write_run(run_file, run, files)
+                    run_file = file
+                    run = []
+                run.append(line)
+            self.__write_run(run_file, run, files)
+
+            for file in files:
+                try:
+                    file.flush()
+                except (OSError, ValueError):
+                    pass
+
+    # Flush the buffered lines and stop the writer's thread. Lines written afterwards are written right away.
+    def close(self):
+        with self.__lock:
+            self.__is_closed = True
+            self.__has_lines.notify()
+        atexit.unregister(self.flush)
+        self.flush()
+
+    def __write_run(self, file, run, files):
+        try:
+            file.write('\n'.join(run) + '\n')
+        except (OSError, ValueError):
+            # e.g. the file was closed. There is nowhere left to log this.
+            return
+        if file not in files:
+            files.append(file)
+
+    def __write_batches(self):
+        while True:
+            with self.__lock:
+                while not self.__lines and not self.__is_closed:
+                    self.__has_lines.wait()
+                if self.__is_closed:
+                    return
+
+                # Give more lines a chance to arrive, unless the batch is already full
+                if len(self.__lines) < self.__batch_size:
+                    self.__has_lines.wait(timeout = self.__flush_interval_s)
+            self.flush()
@@ -1,5 +1,10 @@
+import json
 import os
-import pyjson5
+import threading
+import time
+import traceback
+import types
+from pcc.inotify import Inotify
 from pcc.logger import Logger
 from pcc.directoryutils import DirectoryUtils
 
@@ -8,26 +13,119 @@ class Config:
     CONFIG_PATH = DirectoryUtils().root_dir + '/config.json'
     __DEFAULT_CONFIG_PATH = DirectoryUtils().root_dir + '/default_config.json'
 
+    # The merged config, as plain JSON, along with the identity (mtime, size, inode) of the config files it was
+    # merged from. Parsing JSON5 is slow on a pi, so we only do it when the config files changed. See
+    # __read_config. It is kept next to CONFIG_PATH.
+    __MERGED_CONFIG_CACHE_FILE_NAME = '.merged_config_cache.json'
+
+    # Part of the cache's key. Bump it whenever the way the config files are merged changes, so that configs merged
+    # the old way aren't used. Version 1 dropped every override in config.json.
+    __MERGED_CONFIG_CACHE_VERSION = 2
+
     __is_loaded = False
     __config = {}
     __logger = Logger().set_namespace('Config')
     __PATH_SEP = '.'
 
+    # A read-only lookup table of every dotted path in the config, e.g. "foo", "foo.bar", and "foo.bar.baz", to
+    # its value. This saves splitting the key and walking the nested dicts on every lookup. Rebuilt whenever the
+    # config changes.
+    __flat_config = types.MappingProxyType({})
+
+    # Incremented whenever the config changes, so that ConfigValues know to look their value up again.
+    __generation = 0
+
+    __MISSING = object()
+
+    # Functions to call when the config changes, see subscribe
+    __subscribers = []
+
+    # Held while changing the config, so that concurrent changes don't undo each other
+    __write_lock = threading.RLock()
+
+    __should_set_log_level = True
+    __is_watching = False
+
+    # After a config file changes, wait until it has been quiet for this long before reloading, because editors
+    # may save a file in several steps.
+    __WATCH_DEBOUNCE_S = 0.2
+
+    # If the config files can't be watched, try again after this long.
+    __WATCH_RETRY_INTERVAL_S = 10
+
     # Get a key from config using dot notation: "foo.bar.baz"
     @staticmethod
     def get(key, default = None):
+        if not Config.__is_loaded:
+            Config.load_config_if_not_loaded()
+        if isinstance(key, str):
+            return Config.__flat_config.get(key, default)
         return Config.__get(key, should_throw = False, default = default)
 
     @staticmethod
     def get_or_throw(key):
+        if not Config.__is_loaded:
+            Config.load_config_if_not_loaded()
+        if isinstance(key, str):
+            value = Config.__flat_config.get(key, Config.__MISSING)
+            if value is Config.__MISSING:
+                raise KeyError(f"{key}")
+            return value
         return Config.__get(key, should_throw = True, default = None)
 
+    # Returns a ConfigValue for the key: a function that returns the key's current value. For hot code, which
+    # may bind it once, e.g. as a class attribute, and call it many times. See ConfigValue.
+    @staticmethod
+    def bind(key, default = None, type = None):
+        return ConfigValue(key, default, type)
+
+    # Returns a number that changes whenever the config does.
+    @staticmethod
+    def get_generation():
+        return Config.__generation
+
     @staticmethod
     def set(key, value):
         Config.load_config_if_not_loaded()
 
-        new_config = Config.__set_nested(key.split(Config.__PATH_SEP), value, Config.__config)
-        Config.__config = new_config
+        with Config.__write_lock:
+            old_flat_config = Config.__flat_config
+            new_config = Config.__set_nested(key.split(Config.__PATH_SEP), value, Config.__config)
+            Config.__config = new_config
+            Config.__build_flat_config()
+            Config.__notify_subscribers(old_flat_config)
+
+    # Call `on_change(changed_keys)` whenever the config changes, either via `set` or because the config files
+    # changed while we were watching them (see `watch_config`). changed_keys is a set of the dotted paths whose
+    # values changed, e.g. {"sound", "sound.card"}. Called from the thread that changed the config.
+    @staticmethod
+    def subscribe(on_change):
+        with Config.__write_lock:
+            Config.__subscribers = Config.__subscribers + [on_change]
+
+    # Re-read the config files. If the new config is invalid, the current config is kept. Returns whether the
+    # config was reloaded.
+    #
+    # Readers keep seeing the current config until the new one has been fully merged and validated, at which point
+    # it replaces the current config all at once. Changes made via `set` are lost.
+    @staticmethod
+    def reload():
+        try:
+            config = Config.__read_config()
+            Config.__validate(config)
+        except Exception as e:
+            Config.__logger.error(f"Not reloading the config, because it is invalid: {e}")
+            return False
+
+        with Config.__write_lock:
+            old_flat_config = Config.__flat_config
+            Config.__config = config
+            Config.__build_flat_config()
+            Config.__is_loaded = True
+            Config.__apply_log_settings()
+            Config.__logger.info(f"Reloaded config: {Config.__config}.")
+            Config.__notify_subscribers(old_flat_config)
+        return True
 
     """
     Merges the config located at __DEFAULT_CONFIG_PATH with the config located at CONFIG_PATH.
@@ -83,20 +181,91 @@ class Config:
         if Config.__is_loaded:
             return
 
+        with Config.__write_lock:
+            if Config.__is_loaded:
+                return
+
+            Config.__should_set_log_level = should_set_log_level
+            Config.__config = Config.__read_config(should_log = True)
+            Config.__apply_log_settings()
+            Config.__logger.info(f"Loaded config: {Config.__config}.")
+
+            Config.__build_flat_config()
+            Config.__is_loaded = True
+
+        if Config.__config.get('watch_config', False):
+            Config.watch_config()
+
+    # Reload the config whenever default_config.json or config.json change, from a background thread. See reload.
+    @staticmethod
+    def watch_config():
+        with Config.__write_lock:
+            if Config.__is_watching:
+                return
+            Config.__is_watching = True
+        threading.Thread(target = Config.__watch_config, name = 'ConfigWatcher', daemon = True).start()
+
+    # Returns the merged config, from the cache if the config files haven't changed since it was written, see
+    # __MERGED_CONFIG_CACHE_FILE_NAME.
+    @staticmethod
+    def __read_config(should_log = False):
+        cache_path = os.path.join(os.path.dirname(Config.CONFIG_PATH), Config.__MERGED_CONFIG_CACHE_FILE_NAME)
+        cache_key = [
+            Config.__MERGED_CONFIG_CACHE_VERSION, Config.__get_file_identity(Config.__DEFAULT_CONFIG_PATH),
+            Config.__get_file_identity(Config.CONFIG_PATH)
+        ]
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+            if cache['key'] == cache_key:
+                if should_log:
+                    Config.__logger.info(f"Using the cached merged config at: {cache_path}.")
+                return cache['config']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        config = Config.__read_config_files(should_log)
+        try:
+            # Write to a temporary file first, so that other processes never read a partially written cache
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'key': cache_key, 'config': config}, cache_file)
+            os.replace(tmp_path, cache_path)
+        except (OSError, TypeError, ValueError) as e:
+            Config.__logger.warning(f"Unable to cache the merged config at {cache_path}: {e}")
+        return config
+
+    # Returns a list of [mtime, size, inode] of the file, or None if it doesn't exist.
+    @staticmethod
+    def __get_file_identity(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+    # Returns the merged config, freshly read from the config files.
+    @staticmethod
+    def __read_config_files(should_log = False):
+        # This import takes a while on a pi, and is only needed when the config files changed
+        import pyjson5
+
         if os.path.exists(Config.__DEFAULT_CONFIG_PATH):
-            Config.__logger.info(f"Found config file at: {Config.__DEFAULT_CONFIG_PATH}.")
+            if should_log:
+                Config.__logger.info(f"Found config file at: {Config.__DEFAULT_CONFIG_PATH}.")
         else:
             raise Exception(f"No config file found at: {Config.__DEFAULT_CONFIG_PATH}.")
 
         do_config_overrides_exist = False
         if os.path.exists(Config.CONFIG_PATH):
             do_config_overrides_exist = True
-            Config.__logger.info(f"Found overrides config file at: {Config.CONFIG_PATH}.")
-        else:
+            if should_log:
+                Config.__logger.info(f"Found overrides config file at: {Config.CONFIG_PATH}.")
+        elif should_log:
             Config.__logger.info(f"No overrides config file found at: {Config.CONFIG_PATH}.")
 
         with open(Config.__DEFAULT_CONFIG_PATH) as default_config_json:
-            Config.__config = pyjson5.decode(default_config_json.read())
+            config = pyjson5.decode(default_config_json.read())
 
         if do_config_overrides_exist:
             with open(Config.CONFIG_PATH) as config_json:
@@ -114,14 +283,112 @@ class Config:
                             new_key.append(nested_key)
                             key_stack.append(new_key)
                     else:
-                        Config.__set_nested(key, value, Config.__config)
+                        config = Config.__set_nested(key, value, config)
+        return config
+
+    # Raises if the config is invalid: if a setting has a different type than its default, or the log settings are
+    # invalid.
+    @staticmethod
+    def __validate(config):
+        if not isinstance(config, dict):
+            raise Exception("The config must be an object.")
+
+        import pyjson5
+        with open(Config.__DEFAULT_CONFIG_PATH) as default_config_json:
+            default_flat_config = {}
+            Config.__flatten(pyjson5.decode(default_config_json.read()), '', default_flat_config)
+        flat_config = {}
+        Config.__flatten(config, '', flat_config)
+        for key, default_value in default_flat_config.items():
+            value = flat_config.get(key)
+            if default_value is None or value is None:
+                continue
+            if isinstance(default_value, (int, float)) and not isinstance(default_value, bool):
+                is_valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+            else:
+                is_valid = isinstance(value, type(default_value))
+            if not is_valid:
+                raise Exception(f"{key} must be of type {type(default_value).__name__}, got: {value!r}.")
+
+        if 'log_level' in config:
+            level = config['log_level']
+            if (level.lower() if isinstance(level, str) else level) not in (
+                list(Logger.STR_TO_LEVEL.keys()) + list(Logger.STR_TO_LEVEL.values())
+            ):
+                raise Exception(f"Invalid log_level: {level!r}.")
+        if config.get('log_mode', Logger.MODE_SYNC) not in (Logger.MODE_SYNC, Logger.MODE_BUFFERED):
+            raise Exception(f"Invalid log_mode: {config['log_mode']!r}.")
 
-        if 'log_level' in Config.__config and should_set_log_level:
+    @staticmethod
+    def __apply_log_settings():
+        if 'log_level' in Config.__config and Config.__should_set_log_level:
             Logger.set_level(Config.__config['log_level'])
+        if 'log_mode' in Config.__config:
+            Logger.set_mode(Config.__config['log_mode'])
+
+    @staticmethod
+    def __notify_subscribers(old_flat_config):
+        new_flat_config = Config.__flat_config
+        changed_keys = {
+            key for key in set(old_flat_config.keys()).union(new_flat_config.keys())
+            if old_flat_config.get(key, Config.__MISSING) != new_flat_config.get(key, Config.__MISSING)
+        }
+        if not changed_keys:
+            return
+        for on_change in Config.__subscribers:
+            try:
+                on_change(changed_keys)
+            except Exception:
+                Config.__logger.error(f"Error in config change subscriber: {traceback.format_exc()}")
+
+    @staticmethod
+    def __watch_config():
+        # Watch the directory rather than the files, because editors often replace a file rather than write to it.
+        config_dir = os.path.dirname(Config.CONFIG_PATH)
+        file_names = {os.path.basename(Config.CONFIG_PATH), os.path.basename(Config.__DEFAULT_CONFIG_PATH)}
+        while True:
+            inotify = None
+            try:
+                inotify = Inotify()
+                inotify.add_watch(
+                    config_dir,
+                    Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_MOVED_FROM | Inotify.IN_CREATE |
+                        Inotify.IN_DELETE | Inotify.IN_ONLYDIR
+                )
+                Config.__logger.info(f"Watching {', '.join(sorted(file_names))} in {config_dir} for changes.")
+                while True:
+                    events = inotify.read_events()
+                    if not any(name in file_names for wd, mask, cookie, name in events):
+                        continue
 
-        Config.__logger.info(f"Loaded config: {Config.__config}.")
+                    # Wait for the changes to settle
+                    while events:
+                        events = inotify.read_events(timeout_s = Config.__WATCH_DEBOUNCE_S)
+                    Config.reload()
+            except Exception as e:
+                Config.__logger.warning(f"Error while watching the config files for changes: {e}")
+            finally:
+                if inotify is not None:
+                    inotify.close()
+            time.sleep(Config.__WATCH_RETRY_INTERVAL_S)
 
-        Config.__is_loaded = True
+    @staticmethod
+    def __build_flat_config():
+        flat_config = {}
+        Config.__flatten(Config.__config, '', flat_config)
+        Config.__flat_config = types.MappingProxyType(flat_config)
+        Config.__generation += 1
+
+    @staticmethod
+    def __flatten(config, prefix, flat_config):
+        for key, value in config.items():
+            # Keys that contain the separator can't be looked up in dot notation, see __get
+            if not isinstance(key, str) or Config.__PATH_SEP in key:
+                continue
+            path = prefix + key
+            flat_config[path] = value
+            if isinstance(value, dict):
+                Config.__flatten(value, path + Config.__PATH_SEP, flat_config)
 
     # Returns the value of `key` from `config`.
     # `key`: may be expressed be in dot notation, e.g. "foo.bar.baz"
@@ -152,10 +419,11 @@ class Config:
     """
     keys: list of string keys
     value: any value
-    my_dict: a dict in which to set the nested list of keys to the given value
+    my_dict: a dict in which to set the nested list of keys to the given value. It is not modified: callers must
+        use the returned dict.
 
-    returns: a dict identical to my_dict, except with the nested dict element identified
-        by the list of keys set to the given value
+    returns: a copy of my_dict, except with the nested dict element identified by the list of keys set to the
+        given value
 
     Ex:
         >>> __set_nested(['foo'], 1, {})
@@ -169,6 +437,12 @@ class Config:
 
         >>> __set_nested(['foo', 'bar'], 1, {'foo': {'baz': 2}})
         {'foo': {'baz': 2, 'bar': 1}}
+
+        >>> my_dict = {'foo': {'baz': 2}}
+        >>> __set_nested(['foo', 'bar'], 1, my_dict)
+        {'foo': {'baz': 2, 'bar': 1}}
+        >>> my_dict
+        {'foo': {'baz': 2}}
     """
     @staticmethod
     def __set_nested(keys, value, my_dict):
@@ -183,7 +457,39 @@ class Config:
                 new_config = {}
             return {**my_dict, **{key: Config.__set_nested(keys[1:], value, new_config)}}
         elif len(keys) == 1:
-            my_dict[keys[0]] = value
-            return my_dict
+            # Copy rather than modify the dict: it is part of the current config, which readers may still be using,
+            # and which subscribers' changed_keys are computed against.
+            return {**my_dict, keys[0]: value}
         else:
             raise Exception("No keys were given.")
+
+# A config key bound for fast, repeated lookups, see Config.bind. Call it to get the key's value:
+#   card = Config.bind('sound.card', 0, int)
+#   ...
+#   card()
+#
+# The value is looked up once, and again only after the config changes.
+# default: returned if the key is missing or null
+# type: optional function to convert the value with, e.g. int. Not applied to the default.
+class ConfigValue:
+
+    def __init__(self, key, default = None, type = None):
+        self.__key = key
+        self.__default = default
+        self.__type = type
+        self.__generation = None
+        self.__value = None
+
+    def __call__(self):
+        if self.__generation != Config.get_generation():
+            # Read the generation first: if the config changes while we look the value up, we'll look it up again
+            # next time.
+            generation = Config.get_generation()
+            value = Config.get(self.__key)
+            if value is None:
+                value = self.__default
+            elif self.__type is not None:
+                value = self.__type(value)
+            self.__value = value
+            self.__generation = generation
+        return self.__value
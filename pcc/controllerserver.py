@@ -1,13 +1,216 @@
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import hashlib
+import json
+import math
+import threading
+import time
 import traceback
+import urllib.parse
 from urllib.parse import urlparse
+from pcc.config import Config
 from pcc.logger import Logger
 from pcc.directoryutils import DirectoryUtils
+from pcc.etag import ETag
+from pcc.receiverclient import ReceiverClient
+from pcc.samplingprofiler import SamplingProfiler
+from pcc.staticassetcache import StaticAssetCache
+
+# Aggregates the receivers' APIs, so that the web app can talk to all receivers through the controller with a
+# single request, rather than to each receiver separately.
+#
+# The exception is the receivers' event streams (/receiver_events), which the web app still opens to each receiver.
+# An idle event stream costs no requests or CORS preflights, and relaying it through the controller would cost a
+# thread per receiver per client here, plus a hop of latency for every change. The web app only falls back to
+# polling get_receivers_data for receivers whose event stream is unavailable.
+class ControllerAPI():
+
+    # The receiver API endpoints that may be sent to a group of receivers, see group_command.
+    GROUP_COMMANDS = ('vol_pct', 'make_bt_discoverable', 'disconnect_clients')
+
+    def __init__(self):
+        self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__receivers = Config.get('receivers', [])
+        self.__receiver_groups = Config.get('receiver_groups', {})
+        self.__receiver_client = ReceiverClient()
+
+        # (receiver, path) -> (etag, response): the latest response to a GET request to a receiver, for conditional
+        # requests. See ReceiverClient.get_if_modified.
+        self.__cached_responses = {}
+        self.__cached_responses_lock = threading.Lock()
+
+        # Leave room for requests that are still running after we gave up on them. Group commands have their own
+        # executor, so that polls stuck on an unresponsive receiver don't delay them, and vice versa.
+        num_receivers = len(set(self.__receivers).union(*self.__receiver_groups.values()))
+        self.__poll_executor = ThreadPoolExecutor(
+            max_workers = max(1, 2 * num_receivers), thread_name_prefix = 'ReceiverPoll'
+        )
+        self.__group_command_executor = ThreadPoolExecutor(
+            max_workers = max(1, 2 * num_receivers), thread_name_prefix = 'ReceiverGroupCommand'
+        )
+
+    # Queries all receivers concurrently. Returns a tuple of (data, etag), where data is e.g.:
+    #   {
+    #       "receivers": {
+    #           "192.168.0.2": {
+    #               "success": true, "latency_ms": 12.3, "etag": "W/\"1a2b3c4d-42\"",
+    #               "data": {...the receiver's /receiver_data}
+    #           },
+    #           "192.168.0.3": {"success": false, "latency_ms": 2000.4, "error": "timed out"}
+    #       },
+    #       "success": true
+    #   }
+    #
+    # Receivers are asked for their data with conditional requests, so a receiver whose data didn't change since we
+    # last asked replies with a 304 Not Modified, and we reuse the data we have. etag identifies the data of all the
+    # receivers, ignoring latency_ms, so that clients may make conditional requests too. It is None if a receiver
+    # doesn't support conditional requests.
+    def get_receivers_data(self):
+        results = self.__fan_out(self.__poll_executor, 'GET', '/receiver_data')
+        data = {
+            'receivers': results,
+            'success': True,
+        }
+        return data, self.__get_receivers_data_etag(results)
+
+    def __get_receivers_data_etag(self, results):
+        tags = []
+        for receiver, result in sorted(results.items()):
+            if result['success']:
+                if 'etag' not in result:
+                    return None
+                tags.append(f"{receiver}={result['etag']}")
+            else:
+                tags.append(f"{receiver}!{result['error']}")
+        return ETag.weak(hashlib.sha1('\n'.join(tags).encode('utf-8')).hexdigest()[:16])
+
+    # Send a command to all receivers of a group concurrently. post_data should contain:
+    #   `group`: the name of a group in the `receiver_groups` config
+    #   `command`: one of GROUP_COMMANDS
+    #   `data`: optional, the data to POST to each receiver's endpoint for the command. E.g. for 'vol_pct':
+    #     {"vol_pct_inc": 5, "set_airplay_client_vol": false} to turn every receiver up by 5%, relative to its
+    #     current volume. See ReceiverAPI.set_vol_pct.
+    #   `deadline_s`: optional, how long to wait for the receivers to respond, a positive number of seconds.
+    #     Defaults to `controller.group_command_deadline_s`, and is capped at
+    #     `controller.max_group_command_deadline_s`.
+    #
+    # Returns a tuple of (response, status). The response has each receiver's result, as in get_receivers_data, and
+    # whether the command succeeded on all of them. If the request is invalid, e.g. the group doesn't exist, the status
+    # is 400 and the response has the error instead.
+    def group_command(self, post_data):
+        post_data = post_data if isinstance(post_data, dict) else {}
+        group = post_data.get('group')
+        command = post_data.get('command')
+        deadline_s = post_data.get('deadline_s', Config.get('controller.group_command_deadline_s', 10))
+        error = None
+        if not isinstance(group, str) or group not in self.__receiver_groups:
+            error = f'Unknown receiver group: {group}.'
+        elif not isinstance(command, str) or command not in self.GROUP_COMMANDS:
+            error = f'Unknown group command: {command}.'
+        elif (
+            not isinstance(deadline_s, (int, float)) or isinstance(deadline_s, bool) or
+            not math.isfinite(deadline_s) or deadline_s <= 0
+        ):
+            error = f'Invalid deadline_s: {deadline_s}. It must be a positive number of seconds.'
+        if error is not None:
+            return {'error': error, 'success': False}, HTTPStatus.BAD_REQUEST
+
+        # Requests still running after the deadline keep holding a thread of the executor, so don't let clients
+        # wait for arbitrarily long.
+        deadline_s = min(deadline_s, Config.get('controller.max_group_command_deadline_s', 60))
+        self.__logger.info(f'Sending {command} to receiver group {group}...')
+        results = self.__fan_out(
+            self.__group_command_executor, 'POST', '/' + command, post_data.get('data', {}), receivers = self.__receiver_groups[group],
+            timeout_s = deadline_s
+        )
+        return {
+            'receivers': results,
+            'success': all(result['success'] and result['data'].get('success') for result in results.values()),
+        }, HTTPStatus.OK
+
+    # Make the same request to every receiver concurrently. Returns a dict of each receiver's result. A receiver
+    # that doesn't respond within `timeout_s` seconds is reported as failed.
+    # executor: the ThreadPoolExecutor to make the requests on
+    # receivers: defaults to all receivers
+    # timeout_s: defaults to `controller.receiver_timeout_s`
+    def __fan_out(self, executor, method, path, data = None, receivers = None, timeout_s = None):
+        if receivers is None:
+            receivers = self.__receivers
+        if timeout_s is None:
+            timeout_s = Config.get('controller.receiver_timeout_s', 2)
+        start = time.monotonic()
+        futures = {
+            receiver: executor.submit(self.__request_receiver, receiver, method, path, data, timeout_s)
+            for receiver in receivers
+        }
+
+        results = {}
+        deadline = start + timeout_s
+        for receiver, future in futures.items():
+            try:
+                results[receiver] = future.result(timeout = max(0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                results[receiver] = {
+                    'success': False,
+                    'latency_ms': round((time.monotonic() - start) * 1000, 1),
+                    'error': 'timed out',
+                }
+        return results
+
+    def __request_receiver(self, receiver, method, path, data, timeout_s):
+        start = time.monotonic()
+        etag = None
+        try:
+            if method == 'GET':
+                response, etag = self.__get_receiver_if_modified(receiver, path, timeout_s)
+            else:
+                response = self.__receiver_client.request(receiver, method, path, data, timeout_s = timeout_s)
+        except Exception as e:
+            self.__logger.warning(f'Request {method} {path} to receiver {receiver} failed: {e}')
+            return {
+                'success': False,
+                'latency_ms': round((time.monotonic() - start) * 1000, 1),
+                'error': str(e),
+            }
+        result = {
+            'success': True,
+            'latency_ms': round((time.monotonic() - start) * 1000, 1),
+            'data': response,
+        }
+        if etag is not None:
+            result['etag'] = etag
+        return result
+
+    # Returns a tuple of (response, etag). Uses the response we have if it is still current.
+    def __get_receiver_if_modified(self, receiver, path, timeout_s):
+        key = (receiver, path)
+        with self.__cached_responses_lock:
+            cached_etag, cached_response = self.__cached_responses.get(key, (None, None))
+
+        response, etag = self.__receiver_client.get_if_modified(receiver, path, cached_etag, timeout_s = timeout_s)
+        if response is None:
+            if cached_response is None:
+                raise Exception(f'Got HTTP status 304 from {receiver} for GET {path} without a cached response.')
+            return cached_response, cached_etag
+
+        with self.__cached_responses_lock:
+            if etag is None:
+                self.__cached_responses.pop(key, None)
+            else:
+                self.__cached_responses[key] = (etag, response)
+        return response, etag
 
 class PccControllerServerRequestHandler(BaseHTTPRequestHandler):
 
+    # See PccReceiverServerRequestHandler
+    protocol_version = 'HTTP/1.1'
+    timeout = 60
+    CORS_MAX_AGE_S = 86400
+
     def __init__(self, request, client_address, server):
-        self.__root_dir = DirectoryUtils().root_dir + "/app/build"
+        self.__static_asset_cache = server.static_asset_cache
+        self.__api = server.controller_api
         self.__logger = Logger().set_namespace(self.__class__.__name__)
         BaseHTTPRequestHandler.__init__(self, request, client_address, server)
 
@@ -17,48 +220,145 @@ class PccControllerServerRequestHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header("Access-Control-Allow-Headers", "X-Requested-With")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Max-Age", str(self.CORS_MAX_AGE_S))
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
         try:
+            path = urlparse(self.path).path
+            if path == '/api/receivers':
+                return self.__send_receivers_data()
+            elif path == '/api/profile':
+                return self.__send_profile()
             return self.__serve_static_asset()
         except Exception:
+            # We may not have sent a complete response: close the connection, so the client doesn't wait for one.
+            self.close_connection = True
             self.log_error('Exception: {}'.format(traceback.format_exc()))
 
+    def do_POST(self):
+        try:
+            content_length = int(self.headers['Content-Length'])
+
+            post_data = None
+            if content_length > 0:
+                body = self.rfile.read(content_length)
+                post_data = json.loads(body.decode("utf-8"))
+
+            path = urlparse(self.path).path
+            if path == '/api/group_command':
+                response, status = self.__api.group_command(post_data)
+            else:
+                self.__do_404()
+                return
+
+            self.__send_json(response, status)
+        except Exception:
+            self.close_connection = True
+            self.log_error('Exception: {}'.format(traceback.format_exc()))
+
+    def __send_json(self, response, status = HTTPStatus.OK):
+        body = bytes(json.dumps(response), 'utf-8')
+        self.send_response(status)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Answers conditional requests, see ControllerAPI.get_receivers_data
+    def __send_receivers_data(self):
+        data, etag = self.__api.get_receivers_data()
+        if etag is None:
+            return self.__send_json(data)
+
+        if ETag.matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            return
+
+        body = bytes(json.dumps(data), 'utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        # Don't let browsers serve their cached copy without asking us first: the receivers' data changes all the time.
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Profile the controller, like the receiver's /profile route. See ReceiverAPI.profile. e.g.:
+    #   curl 'http://controller/api/profile?{"duration_s":30}' > controller.folded
+    def __send_profile(self):
+        data = urllib.parse.unquote(urlparse(self.path).query)
+        data = json.loads(data) if data else {}
+        profile = SamplingProfiler.profile(data.get('duration_s', 10), data.get('interval_s', 0.01))
+        if profile is None:
+            return self.__send_json({'error': 'A profile is already running.', 'success': False})
+
+        body = bytes(profile, 'utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def __do_404(self):
         self.send_response(404)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
+    # Serves assets from memory, see StaticAssetCache
     def __serve_static_asset(self):
-        self.path = urlparse(self.path).path # get rid of query parameters e.g. `?foo=bar&baz=1`
-        if self.path == '/':
-            self.path = self.__root_dir + '/index.html'
-        else:
-            self.path = self.__root_dir + self.path
+        path = urlparse(self.path).path # get rid of query parameters e.g. `?foo=bar&baz=1`
+        asset = self.__static_asset_cache.get(path)
+        if asset is None:
+            self.log_error(f'Static asset not found: {path}')
+            self.__do_404()
+            return
 
+        variant = asset.get_variant(self.headers.get('Accept-Encoding'))
+        if variant.matches(self.headers.get('If-None-Match')):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.__send_static_asset_headers(asset, variant)
+            self.end_headers()
+            return
+
+        # Open large files before sending the headers, in case they've been deleted or changed since the cache was
+        # loaded.
+        file = None
+        if variant.body is None:
+            file = variant.open_file()
+            if file is None:
+                self.log_error(f'Static asset has changed on disk since it was loaded: {path}')
+                self.__do_404()
+                return
         try:
-            file_to_open = open(self.path, 'rb').read()
             self.send_response(200)
-        except Exception as e:
-            self.__logger.error(str(e))
-            self.log_error('Exception: {}'.format(traceback.format_exc()))
-            file_to_open = "File not found"
-            self.__do_404()
-            return
+            self.__send_static_asset_headers(asset, variant)
+            self.send_header("Content-Type", asset.content_type)
+            self.send_header("Content-Length", str(variant.size))
+            if variant.encoding != StaticAssetCache.ENCODING_IDENTITY:
+                self.send_header("Content-Encoding", variant.encoding)
+            self.end_headers()
 
-        if self.path.endswith('.js'):
-            self.send_header("Content-Type", "text/javascript")
-        elif self.path.endswith('.css'):
-            self.send_header("Content-Type", "text/css")
-        elif self.path.endswith('.svg') or self.path.endswith('.svgz'):
-            self.send_header("Content-Type", "image/svg+xml")
-        self.end_headers()
+            if file is None:
+                self.wfile.write(variant.body)
+            else:
+                # Zero-copy: the kernel sends the file straight from the page cache to the socket.
+                self.connection.sendfile(file)
+        finally:
+            if file is not None:
+                file.close()
 
-        if type(file_to_open) is bytes:
-            self.wfile.write(file_to_open)
-        else:
-            self.wfile.write(bytes(file_to_open, 'utf-8'))
-        return
+    def __send_static_asset_headers(self, asset, variant):
+        self.send_header("ETag", variant.etag)
+        self.send_header("Cache-Control", asset.cache_control)
+        if asset.is_compressed:
+            self.send_header("Vary", "Accept-Encoding")
 
     def log_request(self, code='-', size='-'):
         if isinstance(code, HTTPStatus):
@@ -66,6 +366,9 @@ class PccControllerServerRequestHandler(BaseHTTPRequestHandler):
         self.log_message('[REQUEST] "%s" %s %s', self.requestline, str(code), str(size))
 
     def log_error(self, format, *args):
+        # An idle connection timing out is expected with persistent connections, not an error.
+        if format.startswith('Request timed out'):
+            return self.log_message(format, *args)
         self.__logger.error("%s - - %s" % (self.client_address[0], format % args))
 
     def log_message(self, format, *args):
@@ -79,6 +382,14 @@ class PccControllerThreadingHTTPServer(ThreadingHTTPServer):
     #   [Sat Jan 29 00:44:36 2022] TCP: request_sock_TCP: Possible SYN flooding on port 80. Sending cookies.  Check SNMP counters.
     request_queue_size = 128
 
+    def __init__(self, server_address, RequestHandlerClass):
+        # Shared by all requests, so that connections to the receivers are pooled in one place.
+        self.controller_api = ControllerAPI()
+        self.static_asset_cache = StaticAssetCache(
+            DirectoryUtils().root_dir + "/app/build", watch = Config.get('controller.watch_static_assets', False)
+        )
+        super().__init__(server_address, RequestHandlerClass)
+
 class ControllerServer:
 
     def __init__(self):
@@ -1,16 +1,58 @@
+import contextlib
+import queue
 import re
 import subprocess
+import threading
+import time
+import types
+from pcc.config import Config
 from pcc.logger import Logger
+from pcc.metrics import Metrics
 
 # Explore available dbus commands via (for example):
 #   gdbus introspect --system --dest org.gnome.ShairportSync --object-path /org/gnome/ShairportSync
 #
 # See also: https://github.com/mikebrady/shairport-sync/blob/master/documents/sample%20dbus%20commands
+#
+# Two backends are supported, selected via the `dbus.backend` config setting:
+# * 'native': talk to the system bus in-process over one long-lived connection per process (requires the
+#   `jeepney` python module). This avoids forking bash + dbus-send for every call.
+# * 'subprocess': shell out to `dbus-send` and parse its output.
+#
+# The native backend falls back to the subprocess backend if jeepney is not installed or the bus connection
+# can't be established. Both backends honor the DBUS_SYSTEM_BUS_ADDRESS environment variable, so they may be
+# pointed at a private dbus-daemon instance, e.g. one started by ./utils/dbus_stub_services.py.
 class DbusClient():
 
+    BACKEND_NATIVE = 'native'
+    BACKEND_SUBPROCESS = 'subprocess'
+
     __SPS_DBUS_CMD   =  "dbus-send --system --print-reply=literal --type=method_call --dest=org.gnome.ShairportSync '/org/gnome/ShairportSync'"
     __BLUEZ_DBUS_CMD =  "dbus-send --system --print-reply=literal --type=method_call --dest=org.bluez '/org/bluez/hci0'"
 
+    SPS_BUS_NAME = 'org.gnome.ShairportSync'
+    SPS_OBJECT_PATH = '/org/gnome/ShairportSync'
+    SPS_INTERFACE = 'org.gnome.ShairportSync'
+    SPS_REMOTE_CONTROL_INTERFACE = 'org.gnome.ShairportSync.RemoteControl'
+    BLUEZ_BUS_NAME = 'org.bluez'
+    BLUEZ_ADAPTER_OBJECT_PATH = '/org/bluez/hci0'
+    BLUEZ_ADAPTER_INTERFACE = 'org.bluez.Adapter1'
+    BLUEZ_DEVICE_INTERFACE = 'org.bluez.Device1'
+
+    __NATIVE_CALL_TIMEOUT_S = 5
+
+    # If we fail to connect to the system bus, wait this long before trying to connect again. In the
+    # meantime, calls go through the subprocess backend.
+    __NATIVE_RECONNECT_INTERVAL_S = 30
+
+    # The parts of the jeepney module that we use, see __get_jeepney. False if jeepney is not installed.
+    __jeepney = None
+
+    # One system bus connection per process, shared by all DbusClient instances.
+    __router = None
+    __router_lock = threading.Lock()
+    __router_connect_failed_at = None
+
     def __init__(self):
         self.__logger = Logger().set_namespace(self.__class__.__name__)
 
@@ -43,7 +85,11 @@ class DbusClient():
         if return_cmd:
             return cmd
         try:
-            subprocess.check_output(cmd, shell = True, executable = '/bin/bash', stderr=subprocess.STDOUT).decode("utf-8")
+            if self.__call_native(
+                self.SPS_BUS_NAME, self.SPS_OBJECT_PATH, self.SPS_REMOTE_CONTROL_INTERFACE,
+                'SetAirplayVolume', 'd', (float(vol),)
+            ) is None:
+                self.__dbus_send(cmd, self.SPS_BUS_NAME, f'{self.SPS_REMOTE_CONTROL_INTERFACE}.SetAirplayVolume')
         except Exception as e:
             self.__logger.warning(f'Unable to set airplay client volume: {e}')
             if throw:
@@ -60,45 +106,229 @@ class DbusClient():
         if return_cmd:
             return cmd
         try:
-            subprocess.check_output(cmd, shell = True, executable = '/bin/bash', stderr=subprocess.STDOUT).decode("utf-8")
+            if self.__call_native(
+                self.BLUEZ_BUS_NAME, self.BLUEZ_ADAPTER_OBJECT_PATH, 'org.freedesktop.DBus.Properties',
+                'Set', 'ssv', (self.BLUEZ_ADAPTER_INTERFACE, 'Discoverable', ('b', bool(discoverable)))
+            ) is None:
+                self.__dbus_send(cmd, self.BLUEZ_BUS_NAME, 'org.freedesktop.DBus.Properties.Set')
         except Exception as e:
             self.__logger.warning(f'Unable to set bluetooth discoverable: {e}')
             if throw:
                 raise e
 
-    def get_shairport_sync_client_name(self, return_cmd = False, throw = False):
-        # dbus-send --print-reply --system --dest=org.gnome.ShairportSync /org/gnome/ShairportSync org.freedesktop.DBus.Properties.Get string:org.gnome.ShairportSync.RemoteControl string:ClientName
-        cmd = f"{self.__SPS_DBUS_CMD} org.freedesktop.DBus.Properties.Get string:org.gnome.ShairportSync.RemoteControl string:ClientName"
+    # Returns the value of a property of the bluez adapter, e.g. 'Powered', or None on failure, unless `throw`.
+    # Booleans are returned as bools, other values as returned by the backend.
+    def get_bluetooth_adapter_property(self, prop, return_cmd = False, throw = False):
+        # dbus-send --system --print-reply --type=method_call --dest=org.bluez /org/bluez/hci0 org.freedesktop.DBus.Properties.Get string:org.bluez.Adapter1 string:Powered
+        cmd = f'{self.__BLUEZ_DBUS_CMD} org.freedesktop.DBus.Properties.Get string:org.bluez.Adapter1 string:{prop}'
         if return_cmd:
             return cmd
         try:
-            res = subprocess.check_output(cmd, shell = True, executable = '/bin/bash').decode("utf-8")
+            res = self.__call_native(
+                self.BLUEZ_BUS_NAME, self.BLUEZ_ADAPTER_OBJECT_PATH, 'org.freedesktop.DBus.Properties',
+                'Get', 'ss', (self.BLUEZ_ADAPTER_INTERFACE, prop)
+            )
+            if res is not None:
+                return DbusClient.__unwrap_variant(res[0])
+
+            res = self.__dbus_send(cmd, self.BLUEZ_BUS_NAME, 'org.freedesktop.DBus.Properties.Get')
         except Exception as e:
-            self.__logger.warning(f'Unable to get shairport-sync client name: {e}')
             if throw:
                 raise e
-            else:
-                return None
+            self.__logger.warning(f'Unable to get bluetooth adapter property {prop}: {e}')
+            return None
 
-        m = re.search(r"^\s+variant\s+(.*)", res)
+        # e.g. "   variant       boolean true"
+        m = re.search(r"^\s+variant\s+(\S+)\s+(.*)", res)
         if m is None:
-            self.__logger.warning('Unable to parse shairport-sync client name')
             if throw:
-                raise Exception('Unable to parse shairport-sync client name')
-            else:
-                return None
-        else:
-            return m.group(1)
+                raise Exception(f'Unable to parse bluetooth adapter property {prop}')
+            self.__logger.warning(f'Unable to parse bluetooth adapter property {prop}')
+            return None
+        if m.group(1) == 'boolean':
+            return m.group(2).strip() == 'true'
+        return m.group(2).strip()
+
+    # Returns the bluetooth devices that are connected to us, as a list of dicts like:
+    #   {'path': '/org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF', 'name': "dasl's iPhone", 'address': 'AA:BB:CC:DD:EE:FF'}
+    #
+    # Enumerates bluez's objects via org.freedesktop.DBus.ObjectManager.GetManagedObjects. The subprocess backend
+    # can't cheaply parse its output, so this requires the native backend. Returns None on failure, unless `throw`.
+    def get_connected_bluetooth_devices(self, throw = False):
+        try:
+            res = self.__call_native(
+                self.BLUEZ_BUS_NAME, '/', 'org.freedesktop.DBus.ObjectManager', 'GetManagedObjects', '', ()
+            )
+            if res is None:
+                raise Exception('Listing bluetooth devices requires the native D-Bus backend.')
+        except Exception as e:
+            self.__logger.warning(f'Unable to get connected bluetooth devices: {e}')
+            if throw:
+                raise e
+            return None
+
+        devices = []
+        for path, interfaces in res[0].items():
+            if self.BLUEZ_DEVICE_INTERFACE not in interfaces:
+                continue
+            props = DbusClient.__unwrap_variant(('a{sv}', interfaces[self.BLUEZ_DEVICE_INTERFACE]))
+            if not props.get('Connected'):
+                continue
+            devices.append({
+                'path': path,
+                'name': props.get('Alias', props.get('Name')),
+                'address': props.get('Address'),
+            })
+        return devices
+
+    # path: the device's object path, see get_connected_bluetooth_devices
+    def disconnect_bluetooth_device(self, path, return_cmd = False, throw = False):
+        # dbus-send --system --print-reply --type=method_call --dest=org.bluez /org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF org.bluez.Device1.Disconnect
+        cmd = f"dbus-send --system --print-reply=literal --type=method_call --dest=org.bluez '{path}' org.bluez.Device1.Disconnect"
+        if return_cmd:
+            return cmd
+        try:
+            if self.__call_native(self.BLUEZ_BUS_NAME, path, self.BLUEZ_DEVICE_INTERFACE, 'Disconnect', '', ()) is None:
+                self.__dbus_send(cmd, self.BLUEZ_BUS_NAME, f'{self.BLUEZ_DEVICE_INTERFACE}.Disconnect')
+        except Exception as e:
+            self.__logger.warning(f'Unable to disconnect bluetooth device {path}: {e}')
+            if throw:
+                raise e
+
+    # End the current AirPlay session, disconnecting its client.
+    def drop_shairport_sync_session(self, return_cmd = False, throw = False):
+        # dbus-send --system --print-reply --type=method_call --dest=org.gnome.ShairportSync '/org/gnome/ShairportSync' org.gnome.ShairportSync.DropSession
+        cmd = f"{self.__SPS_DBUS_CMD} org.gnome.ShairportSync.DropSession"
+        if return_cmd:
+            return cmd
+        try:
+            if self.__call_native(self.SPS_BUS_NAME, self.SPS_OBJECT_PATH, self.SPS_INTERFACE, 'DropSession', '', ()) is None:
+                self.__dbus_send(cmd, self.SPS_BUS_NAME, f'{self.SPS_INTERFACE}.DropSession')
+        except Exception as e:
+            self.__logger.warning(f'Unable to drop shairport-sync session: {e}')
+            if throw:
+                raise e
+
+    def get_shairport_sync_client_name(self, return_cmd = False, throw = False):
+        # dbus-send --print-reply --system --dest=org.gnome.ShairportSync /org/gnome/ShairportSync org.freedesktop.DBus.Properties.Get string:org.gnome.ShairportSync.RemoteControl string:ClientName
+        cmd = f"{self.__SPS_DBUS_CMD} org.freedesktop.DBus.Properties.Get string:org.gnome.ShairportSync.RemoteControl string:ClientName"
+        if return_cmd:
+            return cmd
+        return self.__get_shairport_sync_remote_control_property('ClientName', 'client name', cmd, throw)
 
     def get_shairport_sync_player_state(self, return_cmd = False, throw = False):
         # dbus-send --print-reply --system --dest=org.gnome.ShairportSync /org/gnome/ShairportSync org.freedesktop.DBus.Properties.Get string:org.gnome.ShairportSync.RemoteControl string:PlayerState
         cmd = f"{self.__SPS_DBUS_CMD} org.freedesktop.DBus.Properties.Get string:org.gnome.ShairportSync.RemoteControl string:PlayerState"
         if return_cmd:
             return cmd
+        return self.__get_shairport_sync_remote_control_property('PlayerState', 'player state', cmd, throw)
+
+    # Fetch all properties of the shairport-sync RemoteControl interface in one round trip, via
+    # org.freedesktop.DBus.Properties.GetAll.
+    #
+    # Returns a dict keyed by property name, with values converted to plain python types, e.g.:
+    #   {'Available': True, 'ClientName': "dasl's iPhone", 'PlayerState': 'Playing', 'AirplayVolume': -15.0,
+    #    'Metadata': {'xesam:title': '...', ...}, ...}
+    #
+    # The subprocess backend can't cheaply parse the GetAll output of dbus-send, so it falls back to fetching just
+    # the ClientName and PlayerState properties individually. Returns an empty dict on failure, unless `throw`.
+    def get_shairport_sync_remote_control_properties(self, throw = False):
+        try:
+            res = self.__call_native(
+                self.SPS_BUS_NAME, self.SPS_OBJECT_PATH, 'org.freedesktop.DBus.Properties',
+                'GetAll', 's', (self.SPS_REMOTE_CONTROL_INTERFACE,)
+            )
+        except Exception as e:
+            self.__logger.warning(f'Unable to get shairport-sync remote control properties: {e}')
+            if throw:
+                raise e
+            else:
+                return {}
+
+        if res is not None:
+            return DbusClient.__unwrap_variant(('a{sv}', res[0]))
+
+        props = {
+            'ClientName': self.get_shairport_sync_client_name(throw = throw),
+            'PlayerState': self.get_shairport_sync_player_state(throw = throw),
+        }
+        return {key: value for key, value in props.items() if value is not None}
+
+    # Call `on_change(interface, changed_properties)` whenever a property of the shairport-sync RemoteControl
+    # interface or the bluez adapter changes, as reported by org.freedesktop.DBus.Properties.PropertiesChanged
+    # signals. `changed_properties` is a dict of the new property values. Watches in a background thread.
+    #
+    # Only the native backend can receive signals. Returns False if it is unavailable, else True.
+    def watch_properties_changed(self, on_change):
+        if Config.get('dbus.backend', self.BACKEND_NATIVE) != self.BACKEND_NATIVE or DbusClient.__get_jeepney() is None:
+            return False
+
+        threading.Thread(
+            target = self.__watch_properties_changed, args = (on_change,), name = 'DbusPropertiesWatcher', daemon = True
+        ).start()
+        return True
+
+    def __watch_properties_changed(self, on_change):
+        jeepney = DbusClient.__get_jeepney()
+        rules = [
+            jeepney.MatchRule(
+                type = 'signal', interface = 'org.freedesktop.DBus.Properties', member = 'PropertiesChanged',
+                path = path
+            ) for path in (self.SPS_OBJECT_PATH, self.BLUEZ_ADAPTER_OBJECT_PATH)
+        ]
+        while True:
+            router = self.__get_router()
+            if router is None:
+                time.sleep(self.__NATIVE_RECONNECT_INTERVAL_S)
+                continue
+
+            signals = queue.Queue(maxsize = 100)
+            try:
+                with contextlib.ExitStack() as stack:
+                    for rule in rules:
+                        stack.enter_context(router.filter(rule, queue = signals))
+                        router.send_and_get_reply(jeepney.message_bus.AddMatch(rule), timeout = self.__NATIVE_CALL_TIMEOUT_S)
+
+                    # If the connection is lost, the router will be replaced by the next method call. When that
+                    # happens, subscribe to the signals again on the new connection.
+                    while DbusClient.__router is router:
+                        try:
+                            msg = signals.get(timeout = 5)
+                        except queue.Empty:
+                            continue
+                        interface, changed_properties, invalidated_properties = msg.body
+                        on_change(interface, DbusClient.__unwrap_variant(('a{sv}', changed_properties)))
+            except Exception as e:
+                self.__logger.warning(f'Error while watching for D-Bus property changes: {e}')
+                time.sleep(1)
+
+    # Convert a variant, as returned by jeepney (a tuple of (signature, value)), to a plain python value.
+    @staticmethod
+    def __unwrap_variant(variant):
+        signature, value = variant
+        if signature == 'v':
+            return DbusClient.__unwrap_variant(value)
+        elif signature == 'a{sv}':
+            return {key: DbusClient.__unwrap_variant(nested_value) for key, nested_value in value.items()}
+        elif signature == 'av':
+            return [DbusClient.__unwrap_variant(nested_value) for nested_value in value]
+        elif signature == 'ay':
+            return value.decode('utf-8', errors = 'replace')
+        return value
+
+    def __get_shairport_sync_remote_control_property(self, prop, description, cmd, throw):
         try:
-            res = subprocess.check_output(cmd, shell = True, executable = '/bin/bash').decode("utf-8")
+            res = self.__call_native(
+                self.SPS_BUS_NAME, self.SPS_OBJECT_PATH, 'org.freedesktop.DBus.Properties',
+                'Get', 'ss', (self.SPS_REMOTE_CONTROL_INTERFACE, prop)
+            )
+            if res is not None:
+                # The reply body is a single variant: a tuple of (signature, value)
+                return res[0][1]
+
+            res = self.__dbus_send(cmd, self.SPS_BUS_NAME, 'org.freedesktop.DBus.Properties.Get', stderr = None)
         except Exception as e:
-            self.__logger.warning(f'Unable to get shairport-sync client name: {e}')
+            self.__logger.warning(f'Unable to get shairport-sync {description}: {e}')
             if throw:
                 raise e
             else:
@@ -106,10 +336,95 @@ class DbusClient():
 
         m = re.search(r"^\s+variant\s+(.*)", res)
         if m is None:
-            self.__logger.warning('Unable to parse shairport-sync player state')
+            self.__logger.warning(f'Unable to parse shairport-sync {description}')
             if throw:
-                raise Exception('Unable to parse shairport-sync player state')
+                raise Exception(f'Unable to parse shairport-sync {description}')
             else:
                 return None
         else:
             return m.group(1)
+
+    # Make a method call over the shared in-process bus connection.
+    #
+    # Returns the body of the reply (a tuple), or None if the native backend is unavailable, in which case the
+    # caller should fall back to the subprocess backend. Errors returned by the remote end (e.g. the service
+    # isn't running) are raised rather than falling back, because dbus-send would fail in the same way.
+    def __call_native(self, bus_name, object_path, interface, method, signature, body):
+        router = self.__get_router()
+        if router is None:
+            return None
+
+        jeepney = DbusClient.__get_jeepney()
+        msg = jeepney.new_method_call(
+            jeepney.DBusAddress(object_path, bus_name = bus_name, interface = interface),
+            method, signature, body
+        )
+        try:
+            with Metrics.time_command(f'dbus {bus_name} {interface}.{method}'):
+                reply = router.send_and_get_reply(msg, timeout = self.__NATIVE_CALL_TIMEOUT_S)
+        except (jeepney.RouterClosed, OSError) as e:
+            self.__logger.warning(f'Lost connection to the system bus, falling back to subprocess backend: {e}')
+            DbusClient.__reset_router(router)
+            return None
+        return jeepney.unwrap_msg(reply)
+
+    # Run a dbus-send command, recording it as e.g. "dbus-send org.bluez org.freedesktop.DBus.Properties.Get", like
+    # the native backend's "dbus org.bluez org.freedesktop.DBus.Properties.Get". See Metrics.time_command.
+    def __dbus_send(self, cmd, bus_name, method, stderr = subprocess.STDOUT):
+        with Metrics.time_command(f'dbus-send {bus_name} {method}'):
+            return subprocess.check_output(cmd, shell = True, executable = '/bin/bash', stderr = stderr).decode("utf-8")
+
+    def __get_router(self):
+        if Config.get('dbus.backend', self.BACKEND_NATIVE) != self.BACKEND_NATIVE:
+            return None
+        jeepney = DbusClient.__get_jeepney()
+        if jeepney is None:
+            return None
+
+        router = DbusClient.__router
+        if router is not None:
+            return router
+
+        with DbusClient.__router_lock:
+            if DbusClient.__router is None:
+                failed_at = DbusClient.__router_connect_failed_at
+                if failed_at is not None and (time.monotonic() - failed_at) < self.__NATIVE_RECONNECT_INTERVAL_S:
+                    return None
+                try:
+                    DbusClient.__router = jeepney.DBusRouter(jeepney.open_dbus_connection(bus = 'SYSTEM'))
+                    DbusClient.__router_connect_failed_at = None
+                except Exception as e:
+                    self.__logger.warning(f'Unable to connect to the system bus, falling back to subprocess backend: {e}')
+                    DbusClient.__router_connect_failed_at = time.monotonic()
+                    return None
+            return DbusClient.__router
+
+    # jeepney is imported on first use rather than at startup, because importing it takes a while on a pi, and some
+    # processes, e.g. the sweeper, rarely talk to D-Bus. Returns None if jeepney is not installed.
+    @staticmethod
+    def __get_jeepney():
+        if DbusClient.__jeepney is None:
+            try:
+                from jeepney import DBusAddress, MatchRule, message_bus, new_method_call
+                from jeepney.io.threading import DBusRouter, RouterClosed, open_dbus_connection
+                from jeepney.wrappers import unwrap_msg
+                DbusClient.__jeepney = types.SimpleNamespace(
+                    DBusAddress = DBusAddress, MatchRule = MatchRule, message_bus = message_bus,
+                    new_method_call = new_method_call, DBusRouter = DBusRouter, RouterClosed = RouterClosed,
+                    open_dbus_connection = open_dbus_connection, unwrap_msg = unwrap_msg,
+                )
+            except ImportError:
+                DbusClient.__jeepney = False
+        return DbusClient.__jeepney or None
+
+    @staticmethod
+    def __reset_router(router):
+        with DbusClient.__router_lock:
+            if DbusClient.__router is not router:
+                return
+            DbusClient.__router = None
+        try:
+            router.close()
+            router.conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,23 @@
+# Helpers for HTTP entity tags, which let clients make conditional requests: a client sends the ETag of the copy it
+# has in an If-None-Match header, and we reply 304 Not Modified if it is still current. See:
+# https://www.rfc-editor.org/rfc/rfc9110#name-etag
+class ETag:
+
+    # Returns a weak ETag, e.g. 'W/"1a2b-42"', for responses that are equivalent whenever their tag is the same, but
+    # not necessarily identical byte for byte.
+    @staticmethod
+    def weak(tag):
+        return f'W/"{tag}"'
+
+    # Whether a client's copy, identified by the If-None-Match header it sent, is still current, i.e. has the ETag
+    # `etag`. Uses weak comparison, as required for If-None-Match.
+    @staticmethod
+    def matches(if_none_match, etag):
+        if not if_none_match:
+            return False
+        etag = etag.removeprefix('W/')
+        for client_etag in if_none_match.split(','):
+            client_etag = client_etag.strip()
+            if client_etag == '*' or client_etag.removeprefix('W/') == etag:
+                return True
+        return False
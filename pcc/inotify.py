@@ -0,0 +1,104 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+# A minimal wrapper around the linux inotify API, loaded from libc with ctypes, for watching files and directories
+# for changes without polling them.
+# See: https://man7.org/linux/man-pages/man7/inotify.7.html
+class Inotify:
+
+    # Event masks, see: https://github.com/torvalds/linux/blob/master/include/uapi/linux/inotify.h
+    IN_ACCESS = 0x00000001
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_CLOSE_NOWRITE = 0x00000010
+    IN_OPEN = 0x00000020
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    # Any change to the contents of a directory, or to a file
+    IN_CHANGES = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_DELETE_SELF | IN_MOVE_SELF
+
+    __IN_CLOEXEC = 0o2000000
+    __IN_NONBLOCK = 0o4000
+
+    # struct inotify_event: int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[len];
+    __EVENT_HEADER = struct.Struct('iIII')
+
+    __libc = None
+
+    def __init__(self):
+        fd = self.__lib().inotify_init1(self.__IN_CLOEXEC | self.__IN_NONBLOCK)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f'inotify_init1 failed: {os.strerror(errno)}')
+        self.__fd = fd
+
+    # Returns the watch descriptor, which identifies the watch in events.
+    def add_watch(self, path, mask):
+        wd = self.__lib().inotify_add_watch(self.__fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f'inotify_add_watch failed for {path}: {os.strerror(errno)}')
+        return wd
+
+    def remove_watch(self, wd):
+        self.__lib().inotify_rm_watch(self.__fd, wd)
+
+    # Wait up to timeout_s seconds (forever if None) for events. Returns a list of events, each a tuple of
+    # (wd, mask, cookie, name), where name is the name of the file within a watched directory that the event is
+    # about, or '' if the event is about the watched path itself. Returns an empty list on timeout.
+    def read_events(self, timeout_s = None):
+        readable, _, _ = select.select([self.__fd], [], [], timeout_s)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = self.__EVENT_HEADER.unpack_from(data, offset)
+            offset += self.__EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0').decode('utf-8', errors = 'surrogateescape')
+            offset += name_len
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def fileno(self):
+        return self.__fd
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    @staticmethod
+    def __lib():
+        if Inotify.__libc is not None:
+            return Inotify.__libc
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_init1.argtypes = (ctypes.c_int,)
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        libc.inotify_rm_watch.restype = ctypes.c_int
+        libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        Inotify.__libc = libc
+        return libc
@@ -1,8 +1,9 @@
 import datetime
-import pytz
 import sys
 import random
 import string
+import time
+from pcc.bufferedlogwriter import BufferedLogWriter
 
 class Logger:
 
@@ -24,10 +25,22 @@ class Logger:
         "all": ALL,
     }
 
+    # Log modes, see set_mode
+    MODE_SYNC = 'sync'
+    MODE_BUFFERED = 'buffered'
+
     __level = INFO
 
     __uuid = ''
 
+    # A BufferedLogWriter, if the log mode is MODE_BUFFERED
+    __buffered_writer = None
+
+    # The formatted timestamp of the last second we logged in: a tuple of (second, formatted timestamp up to the
+    # second). Formatting the date and time is most of the cost of a timestamp, and they rarely change between
+    # consecutive log lines.
+    __timestamp_cache = (None, None)
+
     def __init__(self, dont_log_to_stdout = False):
         self.__namespace = ""
         self.__dont_log_to_stdout = dont_log_to_stdout
@@ -54,6 +67,34 @@ class Logger:
     def get_level():
         return Logger.__level
 
+    # How log lines are written. Either:
+    #   MODE_SYNC: every line is written and flushed as it is logged. This is the default.
+    #   MODE_BUFFERED: lines are written in batches from a background thread, see BufferedLogWriter. Warnings and
+    #     errors are flushed at once, along with any lines logged before them.
+    @staticmethod
+    def set_mode(mode):
+        if mode == Logger.MODE_SYNC:
+            writer = Logger.__buffered_writer
+            Logger.__buffered_writer = None
+            if writer is not None:
+                writer.close()
+        elif mode == Logger.MODE_BUFFERED:
+            if Logger.__buffered_writer is None:
+                Logger.__buffered_writer = BufferedLogWriter()
+        else:
+            raise Exception(f"Invalid log mode specified. Must be one of: {[Logger.MODE_SYNC, Logger.MODE_BUFFERED]}.")
+
+    @staticmethod
+    def get_mode():
+        return Logger.MODE_SYNC if Logger.__buffered_writer is None else Logger.MODE_BUFFERED
+
+    # Write any buffered log lines, see set_mode.
+    @staticmethod
+    def flush():
+        writer = Logger.__buffered_writer
+        if writer is not None:
+            writer.flush()
+
     @staticmethod
     def make_uuid():
         return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
@@ -93,20 +134,40 @@ class Logger:
             return
 
         msg = self.__format_msg(level = 'warning', msg = msg)
-        self.__print_msg(msg, sys.stderr)
+        self.__print_msg(msg, sys.stderr, is_urgent = True)
 
     def error(self, msg):
         if Logger.__level > Logger.ERROR:
             return
 
         msg = self.__format_msg(level = 'error', msg = msg)
-        self.__print_msg(msg, sys.stderr)
+        self.__print_msg(msg, sys.stderr, is_urgent = True)
 
     def __format_msg(self, level, msg):
-        return (datetime.datetime.now(pytz.timezone('UTC')).isoformat() +
+        return (Logger.__format_timestamp() +
             " [" + level + "] [" + self.__namespace + "] [" + Logger.__uuid + "] " + msg)
 
-    def __print_msg(self, msg, file):
+    # Returns the current UTC time in the same format as datetime.isoformat, e.g. 2023-07-09T16:08:52.123456+00:00
+    @staticmethod
+    def __format_timestamp():
+        now = time.time()
+        second = int(now)
+        microsecond = int((now - second) * 1000000)
+        cached_second, formatted_second = Logger.__timestamp_cache
+        if second != cached_second:
+            formatted_second = datetime.datetime.fromtimestamp(second, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+            Logger.__timestamp_cache = (second, formatted_second)
+        if microsecond == 0:
+            return formatted_second + '+00:00'
+        return f'{formatted_second}.{microsecond:06d}+00:00'
+
+    # is_urgent: in MODE_BUFFERED, whether to write the message (and any buffered messages) right away
+    def __print_msg(self, msg, file, is_urgent = False):
+        writer = Logger.__buffered_writer
+        if writer is not None:
+            writer.write(file, msg, flush = is_urgent)
+            return
+
         # Note: we could omit `flush = True` in our print function. This would result in a lot fewer
         # `write` syscalls, at the expense of having to wait longer for logs to show up. But this makes
         # things harder to reason about. There might be delays in between calling print and the log line
@@ -122,4 +183,6 @@ class Logger:
         #
         # See strace analysis of with and without `flush = True`
         # https://gist.github.com/dasl-/796031c305ac26da76cdc2887d9fa817
+        #
+        # MODE_BUFFERED trades this off the other way, see set_mode.
         print(msg, file = file, flush = True)
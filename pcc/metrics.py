@@ -0,0 +1,205 @@
+import bisect
+import threading
+import time
+
+# Process-wide instruments: counters and histograms, exposed in the Prometheus text format. See:
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+#
+# Instruments are cheap enough to leave on all the time, even on a pi zero: recording a value takes a lock and a few
+# additions, and memory is fixed per label combination. Keep the number of label combinations small, e.g. label
+# requests by route, not by URL.
+#
+# Usage:
+#   requests = Metrics.counter('pcc_http_requests_total', 'HTTP requests.', ('method', 'route'))
+#   requests.inc(('GET', '/receiver_data'))
+#
+#   with Metrics.time_command('amixer cset'):
+#       subprocess.check_output(...)
+#
+# Values that are cheaper to read when scraped than to keep up to date, e.g. the number of threads, may be registered
+# as callbacks, see Metrics.register_callback.
+class Metrics:
+
+    # In seconds. Spans requests served from memory (~1ms) up to restarting bluetooth (several seconds).
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    __instruments = {}
+    __lock = threading.Lock()
+
+    # Returns the counter with this name, creating it if it doesn't exist.
+    # label_names: a tuple of the names of the counter's labels. Values are recorded per combination of label values.
+    @staticmethod
+    def counter(name, help, label_names = ()):
+        return Metrics.__get_or_create(name, lambda: Counter(name, help, label_names))
+
+    # Returns the histogram with this name, creating it if it doesn't exist.
+    # buckets: the upper bounds of the histogram's buckets, in increasing order
+    @staticmethod
+    def histogram(name, help, label_names = (), buckets = DEFAULT_BUCKETS):
+        return Metrics.__get_or_create(name, lambda: Histogram(name, help, label_names, buckets))
+
+    # Expose a value that is read when the metrics are scraped.
+    # metric_type: 'gauge' or 'counter'
+    # get_value: a function that returns the current value, or None to omit the metric
+    @staticmethod
+    def register_callback(name, metric_type, help, get_value):
+        Metrics.__get_or_create(name, lambda: CallbackMetric(name, metric_type, help, get_value))
+
+    # Returns a context manager that records how long an external command (a process we spawn, a D-Bus call, etc)
+    # took, and whether it failed, i.e. raised:
+    # * pcc_command_duration_seconds{command="..."}: a histogram, whose _count is the number of calls
+    # * pcc_command_failures_total{command="..."}
+    @staticmethod
+    def time_command(command):
+        return CommandTimer(command)
+
+    # Returns all metrics, in the Prometheus text format.
+    @staticmethod
+    def render():
+        with Metrics.__lock:
+            instruments = list(Metrics.__instruments.values())
+        lines = []
+        for instrument in instruments:
+            instrument.render(lines)
+        return ''.join(line + '\n' for line in lines)
+
+    @staticmethod
+    def __get_or_create(name, make_instrument):
+        with Metrics.__lock:
+            instrument = Metrics.__instruments.get(name)
+            if instrument is None:
+                instrument = make_instrument()
+                Metrics.__instruments[name] = instrument
+            return instrument
+
+    # Returns e.g. '{method="GET",route="/receiver_data"}'
+    @staticmethod
+    def format_labels(label_names, label_values, extra = ''):
+        labels = [
+            f'{name}="{Metrics.__escape(str(value))}"' for name, value in zip(label_names, label_values)
+        ]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    @staticmethod
+    def format_value(value):
+        if value == float('inf'):
+            return '+Inf'
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    @staticmethod
+    def __escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Counter:
+
+    def __init__(self, name, help, label_names):
+        self.__name = name
+        self.__help = help
+        self.__label_names = label_names
+        self.__lock = threading.Lock()
+
+        # Tuple of label values -> count
+        self.__values = {}
+
+    # label_values: a tuple of values, one per label name
+    def inc(self, label_values = (), amount = 1):
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def render(self, lines):
+        with self.__lock:
+            values = sorted(self.__values.items())
+        lines.append(f'# HELP {self.__name} {self.__help}')
+        lines.append(f'# TYPE {self.__name} counter')
+        for label_values, value in values:
+            labels = Metrics.format_labels(self.__label_names, label_values)
+            lines.append(f'{self.__name}{labels} {Metrics.format_value(value)}')
+
+class Histogram:
+
+    def __init__(self, name, help, label_names, buckets):
+        self.__name = name
+        self.__help = help
+        self.__label_names = label_names
+        self.__buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+
+        # Tuple of label values -> [count per bucket (the last bucket being +Inf), sum of values, count of values].
+        # Counts per bucket are not cumulative: they are summed when rendered, so that recording a value only
+        # increments one bucket.
+        self.__values = {}
+
+    def observe(self, value, label_values = ()):
+        bucket = bisect.bisect_left(self.__buckets, value)
+        with self.__lock:
+            values = self.__values.get(label_values)
+            if values is None:
+                values = [[0] * (len(self.__buckets) + 1), 0, 0]
+                self.__values[label_values] = values
+            values[0][bucket] += 1
+            values[1] += value
+            values[2] += 1
+
+    def render(self, lines):
+        with self.__lock:
+            values = sorted(
+                (label_values, (list(counts), total, count))
+                for label_values, (counts, total, count) in self.__values.items()
+            )
+        lines.append(f'# HELP {self.__name} {self.__help}')
+        lines.append(f'# TYPE {self.__name} histogram')
+        for label_values, (counts, total, count) in values:
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.__buckets + (float('inf'),), counts):
+                cumulative_count += bucket_count
+                labels = Metrics.format_labels(
+                    self.__label_names, label_values, f'le="{Metrics.format_value(float(upper_bound))}"'
+                )
+                lines.append(f'{self.__name}_bucket{labels} {cumulative_count}')
+            labels = Metrics.format_labels(self.__label_names, label_values)
+            lines.append(f'{self.__name}_sum{labels} {round(total, 6)}')
+            lines.append(f'{self.__name}_count{labels} {count}')
+
+class CallbackMetric:
+
+    def __init__(self, name, metric_type, help, get_value):
+        self.__name = name
+        self.__metric_type = metric_type
+        self.__help = help
+        self.__get_value = get_value
+
+    def render(self, lines):
+        try:
+            value = self.__get_value()
+        except Exception:
+            value = None
+        if value is None:
+            return
+        lines.append(f'# HELP {self.__name} {self.__help}')
+        lines.append(f'# TYPE {self.__name} {self.__metric_type}')
+        lines.append(f'{self.__name} {Metrics.format_value(value)}')
+
+# See Metrics.time_command
+class CommandTimer:
+
+    __durations = Metrics.histogram(
+        'pcc_command_duration_seconds', 'How long external commands took, including failed ones.', ('command',)
+    )
+    __failures = Metrics.counter('pcc_command_failures_total', 'External commands that failed.', ('command',))
+
+    def __init__(self, command):
+        self.__label_values = (command,)
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        CommandTimer.__durations.observe(time.perf_counter() - self.__start, self.__label_values)
+        if exc_type is not None:
+            CommandTimer.__failures.inc(self.__label_values)
+        return False
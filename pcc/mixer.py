@@ -0,0 +1,433 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import select
+import subprocess
+import threading
+
+from pcc.config import Config
+from pcc.logger import Logger
+from pcc.metrics import Metrics
+
+# Gives access to the alsa mixer control that we adjust the volume with, i.e. control `sound.numid` of soundcard
+# `sound.card`. The control is accessed through a mixer engine, selected via the `sound.mixer_engine` config
+# setting:
+# * 'native': keep a control handle open in-process via libasound (see AlsaCtlMixerEngine). Reads and writes are
+#   ioctls on the open handle rather than a process spawn each.
+# * 'amixer': shell out to `amixer cget` / `amixer cset` for every read and write (see AmixerMixerEngine).
+#
+# The native engine falls back to the amixer engine if libasound can't be loaded or the control can't be opened.
+#
+# All engines implement:
+# * get_vol_val(): returns the control's current integer value, or None if it couldn't be determined.
+# * get_vol_range(): returns a tuple of the control's (min, max) integer values, or None if they couldn't be
+#   determined.
+# * set_vol_val(vol_val): sets the control's value, on all of its channels.
+# * wait_for_vol_changes(on_change): calls `on_change()` whenever the control's value changes, whether we changed
+#   it or something else did, e.g. shairport-sync or alsamixer. Blocks until watching fails, either by raising or
+#   returning, at which point the caller may call it again.
+# * close(): releases the engine's resources, and makes wait_for_vol_changes return. Called when the engine is
+#   replaced, see reload_engine_if_config_changed.
+class Mixer():
+
+    ENGINE_NATIVE = 'native'
+    ENGINE_AMIXER = 'amixer'
+
+    # One mixer engine per process, shared by all users of the mixer.
+    __engine = None
+    __engine_lock = threading.Lock()
+
+    # The values of __ENGINE_CONFIG_KEYS that the engine was made from
+    __engine_config = None
+    __is_subscribed_to_config = False
+
+    # Changing these settings requires a new engine
+    __ENGINE_CONFIG_KEYS = ('sound.card', 'sound.numid', 'sound.mixer_engine')
+
+    @staticmethod
+    def get_engine():
+        with Mixer.__engine_lock:
+            if Mixer.__engine is None:
+                Mixer.__engine_config = Mixer.__get_engine_config()
+                Mixer.__engine = Mixer.__make_engine(*Mixer.__engine_config)
+                if not Mixer.__is_subscribed_to_config:
+                    Mixer.__is_subscribed_to_config = True
+                    Config.subscribe(Mixer.__on_config_change)
+            return Mixer.__engine
+
+    # Replace the process's mixer engine, e.g. with a FakeMixerEngine for testing.
+    @staticmethod
+    def set_engine(engine):
+        with Mixer.__engine_lock:
+            Mixer.__engine = engine
+
+    # If the config the engine was made from changed, close the engine, and make a new one the next time it is used.
+    # Closing the engine makes users of the mixer that are watching for volume changes on it (see VolumeController)
+    # move to the new one.
+    #
+    # Called when the config changes. Users of the mixer that handle config changes themselves call it first, so that
+    # they see the new engine whichever of us is notified of the change first. Calling it again is harmless.
+    @staticmethod
+    def reload_engine_if_config_changed():
+        with Mixer.__engine_lock:
+            engine = Mixer.__engine
+            if (
+                engine is None or isinstance(engine, FakeMixerEngine) or
+                Mixer.__get_engine_config() == Mixer.__engine_config
+            ):
+                return
+            Mixer.__engine = None
+        Logger().set_namespace(Mixer.__name__).info('The mixer config changed. Using a new mixer engine.')
+        engine.close()
+
+    @staticmethod
+    def __on_config_change(changed_keys):
+        if changed_keys.intersection(Mixer.__ENGINE_CONFIG_KEYS):
+            Mixer.reload_engine_if_config_changed()
+
+    # Returns the arguments of __make_engine
+    @staticmethod
+    def __get_engine_config():
+        return (
+            Config.get('sound.card', 0),
+            Config.get('sound.numid', 1),
+            Config.get('sound.mixer_engine', Mixer.ENGINE_NATIVE),
+        )
+
+    @staticmethod
+    def __make_engine(card, numid, engine_name):
+        logger = Logger().set_namespace(Mixer.__name__)
+        if engine_name == Mixer.ENGINE_NATIVE:
+            try:
+                return AlsaCtlMixerEngine(card, numid)
+            except Exception as e:
+                logger.warning(f'Unable to use the native mixer engine, falling back to amixer: {e}')
+        elif engine_name != Mixer.ENGINE_AMIXER:
+            logger.warning(f'Unknown mixer engine: {engine_name}, using amixer.')
+        return AmixerMixerEngine(card, numid)
+
+# Keeps a control handle open via libasound, loaded with ctypes. This is the same interface `amixer` itself uses,
+# minus the process spawn and the text parsing.
+# See: https://www.alsa-project.org/alsa-doc/alsa-lib/group___control.html
+class AlsaCtlMixerEngine():
+
+    # See: https://github.com/alsa-project/alsa-lib/blob/master/include/control.h
+    __SND_CTL_NONBLOCK = 1
+    __SND_CTL_EVENT_ELEM = 0
+    __SND_CTL_EVENT_MASK_VALUE = 1 << 0
+    __SND_CTL_EVENT_MASK_REMOVE = 0xFFFFFFFF
+
+    __libasound = None
+
+    def __init__(self, card, numid):
+        self.__card = card
+        self.__numid = numid
+        self.__lock = threading.Lock()
+        self.__ctl = None
+        self.__value = None
+        self.__vol_range = None
+        self.__num_channels = None
+
+        self.__is_closed = False
+        with self.__lock:
+            self.__open()
+
+        # See close. Writing to __closed_writer wakes up wait_for_vol_changes.
+        self.__closed_reader, self.__closed_writer = os.pipe()
+
+    def get_vol_val(self):
+        with self.__lock:
+            self.__open()
+            with Metrics.time_command('snd_ctl_elem_read'):
+                self.__check(self.__lib().snd_ctl_elem_read(self.__ctl, self.__value), 'snd_ctl_elem_read')
+            return self.__lib().snd_ctl_elem_value_get_integer(self.__value, 0)
+
+    def get_vol_range(self):
+        with self.__lock:
+            self.__open()
+            return self.__vol_range
+
+    def set_vol_val(self, vol_val):
+        with self.__lock:
+            self.__open()
+            for channel in range(self.__num_channels):
+                self.__lib().snd_ctl_elem_value_set_integer(self.__value, channel, vol_val)
+            with Metrics.time_command('snd_ctl_elem_write'):
+                self.__check(self.__lib().snd_ctl_elem_write(self.__ctl, self.__value), 'snd_ctl_elem_write')
+
+    # Uses its own non-blocking control handle, subscribed to the card's events, so that waiting for events doesn't
+    # hold up other calls. We poll the handle along with a pipe that close writes to, so that closing the engine
+    # stops the wait. Returns once the engine is closed.
+    def wait_for_vol_changes(self, on_change):
+        lib = self.__lib()
+        ctl = ctypes.c_void_p()
+        self.__check_watch(
+            lib.snd_ctl_open(ctypes.byref(ctl), f'hw:{self.__card}'.encode('utf-8'), self.__SND_CTL_NONBLOCK),
+            'snd_ctl_open'
+        )
+        event = ctypes.c_void_p()
+        try:
+            self.__check_watch(lib.snd_ctl_subscribe_events(ctl, 1), 'snd_ctl_subscribe_events')
+            self.__check_watch(lib.snd_ctl_event_malloc(ctypes.byref(event)), 'snd_ctl_event_malloc')
+            num_fds = self.__check_watch(lib.snd_ctl_poll_descriptors_count(ctl), 'snd_ctl_poll_descriptors_count')
+            pollfds = (PollFd * num_fds)()
+            self.__check_watch(lib.snd_ctl_poll_descriptors(ctl, pollfds, num_fds), 'snd_ctl_poll_descriptors')
+            poller = select.poll()
+            for pollfd in pollfds:
+                poller.register(pollfd.fd, pollfd.events)
+            poller.register(self.__closed_reader, select.POLLIN)
+
+            while not self.__is_closed:
+                poller.poll()
+                # Read all the pending events
+                while not self.__is_closed:
+                    ret = lib.snd_ctl_read(ctl, event)
+                    if ret == 0 or ret == -errno.EAGAIN:
+                        break
+                    self.__check_watch(ret, 'snd_ctl_read')
+                    if (
+                        lib.snd_ctl_event_get_type(event) == self.__SND_CTL_EVENT_ELEM and
+                        lib.snd_ctl_event_elem_get_numid(event) == self.__numid
+                    ):
+                        mask = lib.snd_ctl_event_elem_get_mask(event)
+                        if mask != self.__SND_CTL_EVENT_MASK_REMOVE and mask & self.__SND_CTL_EVENT_MASK_VALUE:
+                            on_change()
+        finally:
+            if event:
+                lib.snd_ctl_event_free(event)
+            lib.snd_ctl_close(ctl)
+
+    def close(self):
+        with self.__lock:
+            if self.__is_closed:
+                return
+            self.__is_closed = True
+            self.__close()
+        # Leave the pipe open: wait_for_vol_changes may still be polling it. It only costs two file descriptors.
+        os.write(self.__closed_writer, b'\0')
+
+    # Open the control handle if it isn't open already. Must be called with the lock held.
+    def __open(self):
+        if self.__ctl is not None:
+            return
+        if self.__is_closed:
+            raise Exception(f'The mixer engine for card {self.__card}, numid {self.__numid} is closed.')
+
+        lib = self.__lib()
+        ctl = ctypes.c_void_p()
+        self.__check(lib.snd_ctl_open(ctypes.byref(ctl), f'hw:{self.__card}'.encode('utf-8'), 0), 'snd_ctl_open')
+        info = ctypes.c_void_p()
+        value = ctypes.c_void_p()
+        try:
+            self.__check(lib.snd_ctl_elem_info_malloc(ctypes.byref(info)), 'snd_ctl_elem_info_malloc')
+            lib.snd_ctl_elem_info_set_numid(info, self.__numid)
+            self.__check(lib.snd_ctl_elem_info(ctl, info), 'snd_ctl_elem_info')
+            vol_range = (lib.snd_ctl_elem_info_get_min(info), lib.snd_ctl_elem_info_get_max(info))
+            num_channels = lib.snd_ctl_elem_info_get_count(info)
+
+            self.__check(lib.snd_ctl_elem_value_malloc(ctypes.byref(value)), 'snd_ctl_elem_value_malloc')
+            lib.snd_ctl_elem_value_set_numid(value, self.__numid)
+        except Exception:
+            if value:
+                lib.snd_ctl_elem_value_free(value)
+            lib.snd_ctl_close(ctl)
+            raise
+        finally:
+            if info:
+                lib.snd_ctl_elem_info_free(info)
+
+        self.__ctl = ctl
+        self.__value = value
+        self.__vol_range = vol_range
+        self.__num_channels = num_channels
+
+    # Must be called with the lock held.
+    def __close(self):
+        if self.__ctl is None:
+            return
+        self.__lib().snd_ctl_elem_value_free(self.__value)
+        self.__lib().snd_ctl_close(self.__ctl)
+        self.__ctl = None
+        self.__value = None
+
+    # libasound functions return a negative errno on failure. If the handle is no longer usable, e.g. because the
+    # soundcard went away, close it so that it is reopened on the next call. Must be called with the lock held.
+    def __check(self, ret, func_name):
+        if ret < 0:
+            if self.__ctl is not None:
+                self.__close()
+            message = self.__lib().snd_strerror(ret).decode('utf-8', errors = 'replace')
+            raise OSError(-ret, f'{func_name} failed for card {self.__card}, numid {self.__numid}: {message}')
+        return ret
+
+    # Like __check, but for the event watching handle, which is separate from the handle that __check closes.
+    def __check_watch(self, ret, func_name):
+        if ret < 0:
+            message = self.__lib().snd_strerror(ret).decode('utf-8', errors = 'replace')
+            raise OSError(-ret, f'{func_name} failed for card {self.__card}: {message}')
+        return ret
+
+    @staticmethod
+    def __lib():
+        if AlsaCtlMixerEngine.__libasound is not None:
+            return AlsaCtlMixerEngine.__libasound
+
+        lib = ctypes.CDLL(ctypes.util.find_library('asound') or 'libasound.so.2')
+        for func_name, restype, argtypes in (
+            ('snd_ctl_open', ctypes.c_int, (ctypes.POINTER(ctypes.c_void_p), ctypes.c_char_p, ctypes.c_int)),
+            ('snd_ctl_close', ctypes.c_int, (ctypes.c_void_p,)),
+            ('snd_ctl_elem_info_malloc', ctypes.c_int, (ctypes.POINTER(ctypes.c_void_p),)),
+            ('snd_ctl_elem_info_free', None, (ctypes.c_void_p,)),
+            ('snd_ctl_elem_info_set_numid', None, (ctypes.c_void_p, ctypes.c_uint)),
+            ('snd_ctl_elem_info', ctypes.c_int, (ctypes.c_void_p, ctypes.c_void_p)),
+            ('snd_ctl_elem_info_get_min', ctypes.c_long, (ctypes.c_void_p,)),
+            ('snd_ctl_elem_info_get_max', ctypes.c_long, (ctypes.c_void_p,)),
+            ('snd_ctl_elem_info_get_count', ctypes.c_uint, (ctypes.c_void_p,)),
+            ('snd_ctl_elem_value_malloc', ctypes.c_int, (ctypes.POINTER(ctypes.c_void_p),)),
+            ('snd_ctl_elem_value_free', None, (ctypes.c_void_p,)),
+            ('snd_ctl_elem_value_set_numid', None, (ctypes.c_void_p, ctypes.c_uint)),
+            ('snd_ctl_elem_value_get_integer', ctypes.c_long, (ctypes.c_void_p, ctypes.c_uint)),
+            ('snd_ctl_elem_value_set_integer', None, (ctypes.c_void_p, ctypes.c_uint, ctypes.c_long)),
+            ('snd_ctl_elem_read', ctypes.c_int, (ctypes.c_void_p, ctypes.c_void_p)),
+            ('snd_ctl_elem_write', ctypes.c_int, (ctypes.c_void_p, ctypes.c_void_p)),
+            ('snd_ctl_subscribe_events', ctypes.c_int, (ctypes.c_void_p, ctypes.c_int)),
+            ('snd_ctl_read', ctypes.c_int, (ctypes.c_void_p, ctypes.c_void_p)),
+            ('snd_ctl_poll_descriptors_count', ctypes.c_int, (ctypes.c_void_p,)),
+            ('snd_ctl_poll_descriptors', ctypes.c_int, (ctypes.c_void_p, ctypes.POINTER(PollFd), ctypes.c_uint)),
+            ('snd_ctl_event_malloc', ctypes.c_int, (ctypes.POINTER(ctypes.c_void_p),)),
+            ('snd_ctl_event_free', None, (ctypes.c_void_p,)),
+            ('snd_ctl_event_get_type', ctypes.c_int, (ctypes.c_void_p,)),
+            ('snd_ctl_event_elem_get_numid', ctypes.c_uint, (ctypes.c_void_p,)),
+            ('snd_ctl_event_elem_get_mask', ctypes.c_uint, (ctypes.c_void_p,)),
+            ('snd_strerror', ctypes.c_char_p, (ctypes.c_int,)),
+        ):
+            func = getattr(lib, func_name)
+            func.restype = restype
+            func.argtypes = argtypes
+        AlsaCtlMixerEngine.__libasound = lib
+        return lib
+
+# `struct pollfd`, see poll(2)
+class PollFd(ctypes.Structure):
+    _fields_ = [('fd', ctypes.c_int), ('events', ctypes.c_short), ('revents', ctypes.c_short)]
+
+# Shells out to `amixer` for every read and write.
+class AmixerMixerEngine():
+
+    def __init__(self, card, numid):
+        self.__card = str(card)
+        self.__numid_arg = f'numid={numid}'
+
+        # The `amixer events` processes of wait_for_vol_changes, so that close can stop them
+        self.__lock = threading.Lock()
+        self.__is_closed = False
+        self.__event_procs = set()
+
+    def get_vol_val(self):
+        m = re.search(r" values=(-?\d+)", self.__cget(), re.MULTILINE)
+        if m is None:
+            return None
+        return int(m.group(1))
+
+    def get_vol_range(self):
+        # amixer output: ; type=INTEGER,access=rw---R--,values=1,min=-10239,max=400,step=0
+        m = re.search(r",min=(-?\d+),max=(-?\d+)", self.__cget(), re.MULTILINE)
+        if m is None:
+            return None
+        return int(m.group(1)), int(m.group(2))
+
+    def set_vol_val(self, vol_val):
+        with Metrics.time_command('amixer cset'):
+            subprocess.check_output(('amixer', '-c', self.__card, 'cset', self.__numid_arg, '--', str(vol_val)))
+
+    # Watches the output of `amixer events`. Returns once the engine is closed, and raises if amixer exits otherwise.
+    def wait_for_vol_changes(self, on_change):
+        # amixer prints e.g.: "event value: numid=1,iface=MIXER,name='PCM Playback Volume'"
+        numid_str = f'{self.__numid_arg},'
+
+        # Line buffer amixer's output, else we'd only see events after its stdout buffer fills up.
+        with subprocess.Popen(
+            ('stdbuf', '-oL', 'amixer', '-c', self.__card, 'events'), stdout = subprocess.PIPE, stderr = subprocess.DEVNULL
+        ) as proc:
+            with self.__lock:
+                if self.__is_closed:
+                    proc.terminate()
+                self.__event_procs.add(proc)
+            try:
+                for line in proc.stdout:
+                    if line.startswith(b'event value: ') and numid_str in line.decode('utf-8', errors = 'replace'):
+                        on_change()
+            finally:
+                with self.__lock:
+                    self.__event_procs.discard(proc)
+        if self.__is_closed:
+            return
+        raise Exception(f'amixer events exited with code: {proc.returncode}.')
+
+    def close(self):
+        with self.__lock:
+            self.__is_closed = True
+            procs = list(self.__event_procs)
+        for proc in procs:
+            proc.terminate()
+
+    def __cget(self):
+        with Metrics.time_command('amixer cget'):
+            return subprocess.check_output(('amixer', '-c', self.__card, 'cget', self.__numid_arg)).decode("utf-8")
+
+# An in-memory mixer control, for testing. Records the operations performed on it in `ops`, as tuples of
+# ('get_vol_val',), ('get_vol_range',), or ('set_vol_val', vol_val).
+#
+# Watchers are notified of changes synchronously, from the thread that made the change. Use `inject_vol_change`
+# to simulate the volume being changed outside of pcc.
+class FakeMixerEngine():
+
+    def __init__(self, vol_val = 0, min_vol_val = -10239, max_vol_val = 400):
+        self.__lock = threading.Lock()
+        self.__vol_val = vol_val
+        self.__vol_range = (min_vol_val, max_vol_val)
+        self.__watchers = []
+        self.__closed = threading.Event()
+        self.ops = []
+
+    def get_vol_val(self):
+        with self.__lock:
+            self.ops.append(('get_vol_val',))
+            return self.__vol_val
+
+    def get_vol_range(self):
+        with self.__lock:
+            self.ops.append(('get_vol_range',))
+            return self.__vol_range
+
+    # Like alsa, clamps the value to the control's range.
+    def set_vol_val(self, vol_val):
+        with self.__lock:
+            self.ops.append(('set_vol_val', vol_val))
+        self.__change_vol_val(vol_val)
+
+    def wait_for_vol_changes(self, on_change):
+        with self.__lock:
+            self.__watchers.append(on_change)
+        try:
+            self.__closed.wait()
+        finally:
+            with self.__lock:
+                self.__watchers.remove(on_change)
+
+    # Change the volume without recording an operation, as if something other than pcc changed it.
+    def inject_vol_change(self, vol_val):
+        self.__change_vol_val(vol_val)
+
+    # Make wait_for_vol_changes return.
+    def close(self):
+        self.__closed.set()
+
+    def __change_vol_val(self, vol_val):
+        with self.__lock:
+            self.__vol_val = max(self.__vol_range[0], min(self.__vol_range[1], vol_val))
+            watchers = list(self.__watchers)
+        for on_change in watchers:
+            on_change()
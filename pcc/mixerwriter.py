@@ -0,0 +1,121 @@
+import collections
+import threading
+
+from pcc.logger import Logger
+
+# Serializes writes of the alsa volume through a single worker thread with a latest-wins mailbox.
+#
+# When volume changes arrive faster than we can write them, e.g. while a volume slider is being dragged, the
+# pending volume is replaced by the newest one, so a burst of changes collapses into a single write. This also
+# guarantees that the last volume requested is the last one written, which isn't the case when concurrent requests
+# race their own writes. Writes of the current volume are skipped.
+class MixerWriter:
+
+    # How many failed writes to remember, see __failures
+    __MAX_FAILURES = 16
+
+    # vol_controller: the VolumeController to write the volume with
+    def __init__(self, vol_controller):
+        self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__vol_controller = vol_controller
+        self.__cond = threading.Condition()
+        self.__thread = None
+
+        # The mailbox: the volume value to write next, and the callback to call once it's written
+        self.__pending_vol_val = None
+        self.__pending_on_applied = None
+
+        self.__num_requests = 0
+        self.__num_requests_applied = 0
+
+        # The writes that failed, most recent last, as tuples of (first_request_num, last_request_num, error): a write
+        # applies all the requests coalesced into it. Callers waiting on a write look up its outcome as soon as it's
+        # done, so only the most recent failures are kept.
+        self.__failures = collections.deque(maxlen = self.__MAX_FAILURES)
+
+        self.__num_writes = 0
+        self.__num_failed_writes = 0
+        self.__num_coalesced = 0
+        self.__num_skipped = 0
+
+    # vol_pct: a perceptual loudness %, see VolumeController.set_vol_pct
+    # wait: if True, block until the volume has been written (or the request was superseded by a newer one that
+    #   has been written), and raise the error if writing it failed. Else return immediately.
+    # on_applied: optional function to call from the worker thread once this volume has been written, with the
+    #   error if writing it failed, else None. It is not called if the request is superseded by a newer one before it
+    #   is written.
+    def set_vol_pct(self, vol_pct, wait = True, on_applied = None):
+        vol_val = self.__vol_controller.vol_pct_to_vol_val(vol_pct)
+        with self.__cond:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target = self.__run, name = self.__class__.__name__, daemon = True)
+                self.__thread.start()
+
+            if self.__pending_vol_val is not None:
+                self.__num_coalesced += 1
+            self.__pending_vol_val = vol_val
+            self.__pending_on_applied = on_applied
+            self.__num_requests += 1
+            request_num = self.__num_requests
+            self.__cond.notify_all()
+
+            if wait:
+                self.__cond.wait_for(lambda: self.__num_requests_applied >= request_num)
+                for first_request_num, last_request_num, error in self.__failures:
+                    if first_request_num <= request_num <= last_request_num:
+                        raise error
+
+    def get_stats(self):
+        with self.__cond:
+            return {
+                'num_requests': self.__num_requests,
+                'num_writes': self.__num_writes,
+                'num_failed_writes': self.__num_failed_writes,
+                'num_coalesced': self.__num_coalesced,
+                'num_skipped': self.__num_skipped,
+            }
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: self.__pending_vol_val is not None)
+                vol_val = self.__pending_vol_val
+                on_applied = self.__pending_on_applied
+                first_request_num = self.__num_requests_applied + 1
+                request_num = self.__num_requests
+                self.__pending_vol_val = None
+                self.__pending_on_applied = None
+
+            # The current volume is served from memory when the VolumeController is watching for volume changes.
+            try:
+                should_write = vol_val != self.__vol_controller.get_vol_val()
+            except Exception as e:
+                self.__logger.warning(f'Unable to get current volume value: {e}')
+                should_write = True
+
+            error = None
+            if should_write:
+                try:
+                    self.__vol_controller.set_vol_val(vol_val)
+                except Exception as e:
+                    self.__logger.error(f'Unable to set volume value to {vol_val}: {e}')
+                    error = e
+                    with self.__cond:
+                        self.__num_failed_writes += 1
+                        self.__failures.append((first_request_num, request_num, error))
+                else:
+                    with self.__cond:
+                        self.__num_writes += 1
+            else:
+                with self.__cond:
+                    self.__num_skipped += 1
+
+            with self.__cond:
+                self.__num_requests_applied = request_num
+                self.__cond.notify_all()
+
+            if on_applied is not None:
+                try:
+                    on_applied(error)
+                except Exception as e:
+                    self.__logger.error(f'Error in on_applied callback: {e}')
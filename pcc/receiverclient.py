@@ -0,0 +1,105 @@
+import http.client
+import json
+import threading
+
+# Makes requests to the receivers' APIs (see ReceiverServer) on behalf of the controller.
+#
+# Connections to each receiver are kept alive and reused across requests, so that a request doesn't pay for a new
+# TCP handshake. Idle connections are pooled per receiver. A receiver may close an idle connection at any time: if
+# a request on a reused connection fails before we got a response, it is retried once on a new connection.
+class ReceiverClient():
+
+    PORT = 8080
+
+    # Keep at most this many idle connections open per receiver
+    __MAX_IDLE_CONNECTIONS_PER_RECEIVER = 4
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__idle_connections = {}
+
+    # Returns the response, parsed as JSON. Raises an exception if the request failed, took longer than
+    # `timeout_s` to connect or to receive data, or if the response status was not 200.
+    # data: optional dict to send as the JSON request body
+    def request(self, receiver, method, path, data = None, timeout_s = 2):
+        body = None
+        headers = {}
+        if data is not None:
+            body = bytes(json.dumps(data), 'utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        response_body, status, _ = self.__request_with_retry(receiver, method, path, body, headers, timeout_s)
+        if status != 200:
+            raise Exception(f'Got HTTP status {status} from {receiver} for {method} {path}.')
+        return json.loads(response_body)
+
+    # A conditional GET: if the receiver's response still has the ETag `etag`, i.e. the copy we have is current, the
+    # receiver replies 304 Not Modified without a body. See ReceiverAPI.get_conditional_receiver_data.
+    #
+    # Returns a tuple of (response, etag), where response is the response parsed as JSON, or None if it wasn't
+    # modified, and etag is the response's ETag, if any. Raises like `request`.
+    # etag: the ETag of the copy we have, or None
+    def get_if_modified(self, receiver, path, etag, timeout_s = 2):
+        headers = {} if etag is None else {'If-None-Match': etag}
+        response_body, status, response_etag = self.__request_with_retry(
+            receiver, 'GET', path, None, headers, timeout_s
+        )
+        if status == 304:
+            return None, response_etag or etag
+        if status != 200:
+            raise Exception(f'Got HTTP status {status} from {receiver} for GET {path}.')
+        return json.loads(response_body), response_etag
+
+    # Returns a tuple of (response_body, status, etag)
+    def __request_with_retry(self, receiver, method, path, body, headers, timeout_s):
+        conn, is_reused = self.__get_connection(receiver, timeout_s)
+        try:
+            return self.__request(conn, method, path, body, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not is_reused:
+                raise
+            # The receiver closed the idle connection before we used it. Retry on a new connection.
+            conn = self.__new_connection(receiver, timeout_s)
+            return self.__request(conn, method, path, body, headers)
+
+    # Returns a tuple of (response_body, status, etag), and returns the connection to the pool if it can be reused.
+    def __request(self, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body = body, headers = headers)
+            response = conn.getresponse()
+            response_body = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.__release_connection(conn)
+        return response_body, response.status, response.getheader('ETag')
+
+    # Returns a tuple of (connection, is_reused)
+    def __get_connection(self, receiver, timeout_s):
+        with self.__lock:
+            idle_connections = self.__idle_connections.get(receiver)
+            conn = idle_connections.pop() if idle_connections else None
+
+        if conn is None:
+            return self.__new_connection(receiver, timeout_s), False
+
+        conn.timeout = timeout_s
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout_s)
+        return conn, True
+
+    def __new_connection(self, receiver, timeout_s):
+        return http.client.HTTPConnection(receiver, self.PORT, timeout = timeout_s)
+
+    def __release_connection(self, conn):
+        with self.__lock:
+            idle_connections = self.__idle_connections.setdefault(conn.host, [])
+            if len(idle_connections) < self.__MAX_IDLE_CONNECTIONS_PER_RECEIVER:
+                idle_connections.append(conn)
+                return
+        conn.close()
@@ -1,15 +1,51 @@
-from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, HTTPStatus
-from io import BytesIO
+from http.server import HTTPServer, BaseHTTPRequestHandler, HTTPStatus
+import collections
+import fcntl
+import functools
 import json
 import os.path
 import socket
 import subprocess
+import threading
+import time
 import traceback
 import urllib
+import uuid
 
+from pcc.btdiscoverablejob import BtDiscoverableJob
+from pcc.config import Config
 from pcc.dbusclient import DbusClient
+from pcc.etag import ETag
 from pcc.logger import Logger
+from pcc.metrics import Metrics
+from pcc.mixerwriter import MixerWriter
+from pcc.receiverstate import ReceiverStateService
+from pcc.requestdispatcher import RequestDispatcher
+from pcc.samplingprofiler import SamplingProfiler
+from pcc.spans import Spans
 from pcc.volumecontroller import VolumeController
+from pcc.websocket import WebSocket
+
+# A response that isn't JSON, e.g. the metrics. See ReceiverAPI.handle_request.
+class PlainTextResponse:
+
+    def __init__(self, body, content_type = 'text/plain; charset=utf-8'):
+        self.body = body
+        self.content_type = content_type
+
+# A JSON response with an ETag, which clients may send back in an If-None-Match header to make a conditional request.
+# See ReceiverAPI.handle_request.
+class JsonResponse:
+
+    def __init__(self, data, etag):
+        self.data = data
+        self.etag = etag
+
+# A 304 Not Modified response to a conditional request: the client already has the latest version, `etag`.
+class NotModifiedResponse:
+
+    def __init__(self, etag):
+        self.etag = etag
 
 class ReceiverAPI():
 
@@ -17,20 +53,210 @@ class ReceiverAPI():
 
     __RESTART_BT_SERVICES_CMD = 'sudo systemctl restart bluetooth.service && sudo systemctl restart bt-speaker.service'
 
-    # Ensure only one process makes bluetooth (un)discoverable at a time
-    BT_DISCOVERABLE_LOCK_FILE = '/tmp/pcc_bt_discoverable_lock_file'
-
-    # The mtime of this file (if it exists) represents when we last made bluetooth discoverable
-    BT_DISCOVERABLE_SUCCESS_FILE = '/tmp/pcc_bt_discoverable_success_file'
+    # See BtDiscoverableJob
+    BT_DISCOVERABLE_LOCK_FILE = BtDiscoverableJob.LOCK_FILE
+    BT_DISCOVERABLE_SUCCESS_FILE = BtDiscoverableJob.SUCCESS_FILE
+
+    # How many finished bluetooth discoverable jobs to remember, for clients asking for their status
+    __MAX_BT_DISCOVERABLE_JOBS = 10
+
+    # While waiting for the bluetooth adapter to come back after restarting bluetooth, check on it this often.
+    __BT_ADAPTER_POLL_INTERVAL_S = 0.1
+
+    # The routes we serve, as recorded in the request metrics. Requests to any other path are recorded as 'other', so
+    # that clients can't create unbounded label values.
+    __ROUTES = frozenset((
+        '/receiver_data', '/mixer_writer_stats', '/bt_discoverable_job', '/receiver_events', '/vol_pct_ws', '/metrics',
+        '/profile', '/vol_pct', '/make_bt_discoverable', '/disconnect_clients',
+    ))
+
+    __requests = Metrics.counter(
+        'pcc_http_requests_total', 'HTTP requests, by the status of their response.', ('method', 'route', 'status')
+    )
+    __request_durations = Metrics.histogram(
+        'pcc_http_request_duration_seconds',
+        'Time from receiving a request to sending the head of its response. For streams (/receiver_events, '
+        '/vol_pct_ws), this is the time until the stream was opened.',
+        ('method', 'route')
+    )
 
     def __init__(self):
         self.__vol_controller = VolumeController()
         self.__logger = Logger().set_namespace(self.__class__.__name__)
+
+        # State versions restart from zero with the process. Make our ETags unique to this process, so that a client
+        # can't mistake the state after a restart for the state it has.
+        self.__etag_prefix = uuid.uuid4().hex[:8]
+        self.__bt_discoverable_jobs = collections.OrderedDict()
+        self.__bt_discoverable_jobs_lock = threading.Lock()
         self.__dbus_client = DbusClient()
+        self.__mixer_writer = MixerWriter(self.__vol_controller)
+        self.__state_service = ReceiverStateService(self.__fetch_receiver_data)
+
+        # Refresh the state as soon as we're notified that it changed
+        self.__dbus_client.watch_properties_changed(
+            lambda interface, changed_properties: self.__state_service.request_refresh()
+        )
+        self.__vol_controller.watch_vol_changes(self.__state_service.request_refresh)
+        self.__register_metrics()
+
+    # Returns the response to a request to one of the API routes, or None if there is no such route. Responses are
+    # dicts, to be sent as JSON, or a PlainTextResponse, JsonResponse or NotModifiedResponse. Send them with the help
+    # of encode_response. Shared by the server engines, see ReceiverServer. Streaming routes (/receiver_events,
+    # /vol_pct_ws) are served by the engines themselves.
+    #
+    # The time spent on the steps of a request is recorded as spans, if the caller is recording them. See Spans.
+    # data: the request's JSON data: the query string for GET requests, the body for POST requests
+    # if_none_match: the request's If-None-Match header, if any. See get_conditional_receiver_data.
+    def handle_request(self, method, path, data, if_none_match = None):
+        if method == 'GET':
+            if path == '/receiver_data':
+                return self.get_conditional_receiver_data(if_none_match)
+            elif path == '/metrics':
+                return self.get_metrics()
+            elif path == '/profile':
+                return self.profile(data)
+            elif path == '/mixer_writer_stats':
+                return self.get_mixer_writer_stats()
+            elif path == '/bt_discoverable_job':
+                return self.get_bt_discoverable_job(data)
+        elif method == 'POST':
+            if path == '/vol_pct':
+                return self.set_vol_pct(data)
+            elif path == '/make_bt_discoverable':
+                return self.make_bt_discoverable(data)
+            elif path == '/disconnect_clients':
+                return self.disconnect_clients(data)
+        return None
+
+    # Record a request in the metrics, see get_metrics. Called by the server engines once they send the head of the
+    # response.
+    # status: the response's status code
+    # duration_s: how long it took from receiving the request to sending the head of its response
+    def observe_request(self, method, path, status, duration_s):
+        route = path if path in self.__ROUTES else 'other'
+        self.__requests.inc((method, route, status))
+        self.__request_durations.observe(duration_s, (method, route))
+
+    # Returns a tuple of (status, headers, body) to send for a response returned by handle_request, where headers is a
+    # dict. Records the time spent serializing the response as a 'serialize' span of `spans`, a SpanRecorder.
+    @staticmethod
+    def encode_response(response, spans):
+        with spans.span('serialize'):
+            if isinstance(response, NotModifiedResponse):
+                return HTTPStatus.NOT_MODIFIED, ReceiverAPI.__get_etag_headers(response.etag), b''
+            if isinstance(response, JsonResponse):
+                return HTTPStatus.OK, {
+                    'Content-Type': 'application/json',
+                    **ReceiverAPI.__get_etag_headers(response.etag),
+                }, bytes(json.dumps(response.data), 'utf-8')
+            if isinstance(response, PlainTextResponse):
+                return HTTPStatus.OK, {'Content-Type': response.content_type}, bytes(response.body, 'utf-8')
+            return HTTPStatus.OK, {'Content-Type': 'application/json'}, bytes(json.dumps(response), 'utf-8')
+
+    @staticmethod
+    def __get_etag_headers(etag):
+        return {
+            'ETag': etag,
+
+            # Don't let browsers serve their cached copy without asking us first: the state changes all the time.
+            'Cache-Control': 'no-cache',
 
+            # The web app is served from another origin (the controller): let it read the ETag, to send it back.
+            'Access-Control-Expose-Headers': 'ETag',
+        }
+
+    # Returns the metrics in the Prometheus text format, see Metrics.
+    def get_metrics(self):
+        return PlainTextResponse(Metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+    # Profile this process for a while, see SamplingProfiler. Returns the profile in the folded format, for flame
+    # graph tools. data may contain:
+    #   `duration_s`: how long to profile for (default: 10, at most SamplingProfiler.MAX_DURATION_S)
+    #   `interval_s`: how often to sample the stacks of all threads (default: 0.01)
+    # e.g.:
+    #   curl 'http://receiver:8080/profile?{"duration_s":30}' > receiver.folded
+    def profile(self, data):
+        data = data or {}
+        duration_s = data.get('duration_s', 10)
+        self.__logger.info(f"Profiling for {duration_s}s...")
+        profile = SamplingProfiler.profile(duration_s, data.get('interval_s', 0.01))
+        if profile is None:
+            return {
+                'error': 'A profile is already running.',
+                'success': False,
+            }
+        return PlainTextResponse(profile)
+
+    def __register_metrics(self):
+        Metrics.register_callback('pcc_threads', 'gauge', 'Live threads.', threading.active_count)
+        Metrics.register_callback(
+            'pcc_bt_discoverable_seconds', 'gauge',
+            'Seconds since bluetooth was made discoverable. Absent if it is not discoverable.',
+            self.__get_bt_discoverable_age_s
+        )
+        Metrics.register_callback(
+            'pcc_receiver_state_age_seconds', 'gauge', 'Seconds since the receiver state was fetched.',
+            self.__state_service.get_age_s
+        )
+        for stat in ('num_requests', 'num_writes', 'num_failed_writes', 'num_coalesced', 'num_skipped'):
+            Metrics.register_callback(
+                f"pcc_mixer_writer_{stat.replace('num_', '')}_total", 'counter', f'See MixerWriter.get_stats: {stat}.',
+                functools.partial(lambda stat: self.__mixer_writer.get_stats()[stat], stat)
+            )
+
+    def __get_bt_discoverable_age_s(self):
+        try:
+            return round(time.time() - os.path.getmtime(self.BT_DISCOVERABLE_SUCCESS_FILE), 3)
+        except FileNotFoundError:
+            return None
+
+    # Returns the receiver state from memory. It is refreshed in the background, see ReceiverStateService.
+    #
+    # Records a 'state' span for reading the state, which may have to wait for it to be refreshed, and a span per step
+    # of the latest refresh, prefixed with 'refresh_'. See ReceiverStateService.get_refresh_spans.
     def get_receiver_data(self):
-        shairport_sync_client_name = self.__dbus_client.get_shairport_sync_client_name()
-        shairport_sync_player_state = self.__dbus_client.get_shairport_sync_player_state()
+        return self.__get_receiver_data()[0]
+
+    # Like get_receiver_data, but returns a JsonResponse with an ETag that identifies the version of the state. If
+    # the client already has that version, i.e. if_none_match matches the ETag, returns a NotModifiedResponse instead,
+    # which saves serializing and sending the state, and the client parsing it. Most polls find that nothing
+    # changed.
+    #
+    # The ETag is weak: responses with the same ETag have the same state, but may differ in `state_age_s`.
+    def get_conditional_receiver_data(self, if_none_match):
+        data, etag = self.__get_receiver_data()
+        if ETag.matches(if_none_match, etag):
+            return NotModifiedResponse(etag)
+        return JsonResponse(data, etag)
+
+    # Returns a tuple of (receiver data, ETag)
+    def __get_receiver_data(self):
+        with Spans.span('state'):
+            state, age_s, version = self.__state_service.get_state()
+        for name, duration_s in self.__state_service.get_refresh_spans():
+            Spans.add('refresh_' + name, duration_s)
+        return {
+            **state,
+
+            # How many seconds ago the state was fetched from the hardware
+            'state_age_s': round(age_s, 3),
+        }, ETag.weak(f'{self.__etag_prefix}-{version}')
+
+    # Returns a ReceiverStateSubscription: a stream of changes to the receiver data.
+    # on_publish: see ReceiverStateService.subscribe
+    def subscribe_to_receiver_data(self, on_publish = None):
+        return self.__state_service.subscribe(on_publish)
+
+    def unsubscribe_from_receiver_data(self, subscription):
+        self.__state_service.unsubscribe(subscription)
+
+    def __fetch_receiver_data(self):
+        # Fetch all remote control properties in a single D-Bus round trip
+        with Spans.span('shairport_sync_props'):
+            shairport_sync_props = self.__dbus_client.get_shairport_sync_remote_control_properties()
+        shairport_sync_client_name = shairport_sync_props.get('ClientName')
+        shairport_sync_player_state = shairport_sync_props.get('PlayerState')
         if (
             not shairport_sync_player_state or not shairport_sync_client_name or
 
@@ -42,79 +268,420 @@ class ReceiverAPI():
             shairport_sync_client_name = False
             shairport_sync_player_state = False
 
+        with Spans.span('get_vol_pct'):
+            vol_pct = self.__vol_controller.get_vol_pct()
         return {
-            'vol_pct': self.__vol_controller.get_vol_pct(),
+            'vol_pct': vol_pct,
             'hostname': self.__hostname,
             'bt_discoverable': os.path.isfile(self.BT_DISCOVERABLE_SUCCESS_FILE),
+
+            # The latest attempt to make bluetooth discoverable, e.g. {"job_id": "9f1c...", "phase": "done",
+            # "error": null}, or None. See make_bt_discoverable.
+            'bt_discoverable_job': self.__get_latest_bt_discoverable_job_summary(),
             'shairport_sync_client_name': shairport_sync_client_name,
             'shairport_sync_player_state': shairport_sync_player_state,
+            'shairport_sync_airplay_vol': shairport_sync_props.get('AirplayVolume'),
+
+            # All properties of the shairport-sync RemoteControl interface, e.g. Metadata about the current track.
+            'shairport_sync_remote_control': shairport_sync_props,
             'success': True,
         }
 
-    def set_vol_pct(self, post_data):
-        vol_pct = int(post_data['vol_pct'])
-        set_airplay_client_vol = bool(post_data['set_airplay_client_vol'])
-        self.__vol_controller.set_vol_pct(vol_pct)
+    # post_data must contain either:
+    #   `vol_pct`: the volume percent to set, or
+    #   `vol_pct_inc`: an amount to change the current volume percent by, e.g. -5. The result is limited to the
+    #     range [0, 100], as with VolumeController.increment_vol_pct.
+    # post_data may contain:
+    #   `set_airplay_client_vol`: whether to also set the volume of the AirPlay client, if any (default: false)
+    #   `wait`: whether to wait for the volume to be written before returning (default: true). Note that
+    #     volume changes are coalesced: if a newer volume is set before this one is written, only the newer one
+    #     is written.
+    #
+    # on_applied: optional function to call once the volume has been written, with the error if writing it failed,
+    #   see MixerWriter.set_vol_pct. If we wait for the write, a failed write is reported in the response instead.
+    def set_vol_pct(self, post_data, on_applied = None):
+        if 'vol_pct_inc' in post_data:
+            vol_pct = round(self.__vol_controller.get_vol_pct() + float(post_data['vol_pct_inc']))
+            vol_pct = max(0, vol_pct)
+            vol_pct = min(100, vol_pct)
+        else:
+            vol_pct = int(post_data['vol_pct'])
+        set_airplay_client_vol = bool(post_data.get('set_airplay_client_vol', False))
+        wait = bool(post_data.get('wait', True))
+        try:
+            with Spans.span('set_vol_pct'):
+                self.__mixer_writer.set_vol_pct(vol_pct, wait = wait, on_applied = on_applied)
+        except Exception as e:
+            return {
+                'vol_pct': vol_pct,
+                'error': f'Unable to set volume: {e}',
+                'success': False,
+            }
         if set_airplay_client_vol:
             self.__logger.info(f"setting airplay client volume: {vol_pct}.")
             self.__vol_controller.set_airplay_vol_pct(vol_pct)
+        self.__state_service.request_refresh()
 
         return {
             'vol_pct': vol_pct,
             'success': True
         }
 
-    def make_bt_discoverable(self, post_data):
-        success = True
-        self.__logger.info("Making bluetooth discoverable...")
-        dbus_discoverable_cmd = self.__dbus_client.set_bluetooth_discoverable(True, return_cmd = True)
+    # Returns counters of how volume writes were handled, see MixerWriter.
+    def get_mixer_writer_stats(self):
+        return {
+            **self.__mixer_writer.get_stats(),
+            'success': True,
+        }
 
-        # We tried using 1s sleep previously, and it was too short - about half the time, on the study pi,
-        # it would not properly make BT discoverable. Clients would not find it.
-        sleep_s = 3
+    # A persistent, ordered channel for setting the volume, e.g. while dragging the volume slider. This avoids
+    # opening a new connection (and sending a CORS preflight) for every volume change. Returns when the channel is
+    # closed.
+    #
+    # The client sends JSON messages like: {"seq": 1, "vol_pct": 50, "set_airplay_client_vol": false}
+    # where `seq` increases with every message. We reply to the messages we apply with an ack like:
+    #   {"seq": 1, "vol_pct": 50, "success": true}
+    # Messages with a `seq` no greater than that of the last message received are stale, and are ignored. Acks are
+    # sent in order, but not every message is acked: see set_vol_pct. Malformed messages, e.g. without a `seq`, are
+    # acked with "success": false, and the seq if there was one.
+    #
+    # websocket: a WebSocket, after the opening handshake has been completed
+    def serve_vol_pct_channel(self, websocket):
+        last_seq = None
         try:
-            subprocess.check_output(
-                (f"flock --exclusive --nonblock {self.BT_DISCOVERABLE_LOCK_FILE} --command '" +
-                    # Restart bluetooth and bt-speaker because they can get flakey and won't accept connections after a day or so.
-                    f"{self.__RESTART_BT_SERVICES_CMD} && sleep {sleep_s} && {dbus_discoverable_cmd} && " +
-                    f"touch {self.BT_DISCOVERABLE_SUCCESS_FILE}'"),
-                shell = True, executable = '/bin/bash', stderr=subprocess.STDOUT
-            ).decode("utf-8")
-        except Exception:
-            success = False
-
+            while True:
+                message = websocket.receive()
+                if message is None:
+                    return
+
+                seq = None
+                try:
+                    data = json.loads(message)
+                    seq = data.get('seq') if isinstance(data, dict) else None
+                    if not isinstance(seq, (int, float)) or isinstance(seq, bool):
+                        raise ValueError('Expected an object with a numeric "seq".')
+                except Exception as e:
+                    # Reject the message, but keep the channel open for the next ones
+                    self.__logger.warning(f'Invalid volume channel message: {e}')
+                    self.__send_vol_pct_ack(
+                        websocket, {'error': f'Invalid message: {e}', 'success': False, 'seq': seq}
+                    )
+                    continue
+
+                if last_seq is not None and seq <= last_seq:
+                    continue
+                last_seq = seq
+                try:
+                    # Don't wait for the volume to be written, so that a burst of volume changes is coalesced into
+                    # fewer writes. We ack the volume once it is written. Volumes that are superseded before being
+                    # written are never acked.
+                    self.set_vol_pct(
+                        {**data, 'wait': False},
+                        on_applied = functools.partial(self.__on_vol_pct_applied, websocket, data['vol_pct'], seq)
+                    )
+                except Exception:
+                    self.__logger.error('Exception: {}'.format(traceback.format_exc()))
+                    self.__send_vol_pct_ack(websocket, {'success': False, 'seq': seq})
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            pass
+
+    def __on_vol_pct_applied(self, websocket, vol_pct, seq, error):
+        self.__send_vol_pct_ack(websocket, {'vol_pct': vol_pct, 'success': error is None, 'seq': seq})
+
+    def __send_vol_pct_ack(self, websocket, ack):
+        try:
+            websocket.send(json.dumps(ack))
+        except (OSError, ValueError):
+            # The client went away
+            pass
+
+    # Start making bluetooth discoverable in the background. This takes a few seconds: we restart the bluetooth
+    # services, wait for the adapter to come back, and then make it discoverable. Returns at once, e.g.:
+    #   {"job_id": "9f1c...", "job": {...see BtDiscoverableJob.to_dict}, "success": true}
+    #
+    # Follow the job's progress via get_bt_discoverable_job, or the `bt_discoverable_job` field of the receiver
+    # data, which is updated as the job enters each phase. If a job is already running, returns that job rather
+    # than starting another.
+    def make_bt_discoverable(self, post_data):
+        with self.__bt_discoverable_jobs_lock:
+            for job in self.__bt_discoverable_jobs.values():
+                if not job.is_finished():
+                    return self.__make_bt_discoverable_job_response(job)
+
+            job = BtDiscoverableJob(on_phase_change = self.__state_service.request_refresh)
+            self.__bt_discoverable_jobs[job.job_id] = job
+            while len(self.__bt_discoverable_jobs) > self.__MAX_BT_DISCOVERABLE_JOBS:
+                self.__bt_discoverable_jobs.popitem(last = False)
+
+        threading.Thread(
+            target = self.__run_bt_discoverable_job, args = (job,), name = 'BtDiscoverableJob', daemon = True
+        ).start()
+        return self.__make_bt_discoverable_job_response(job)
+
+    # data may contain `job_id`, as returned by make_bt_discoverable. Defaults to the latest job. Returns e.g.:
+    #   {"job_id": "9f1c...", "job": {...see BtDiscoverableJob.to_dict}, "success": true}
+    def get_bt_discoverable_job(self, data):
+        job_id = (data or {}).get('job_id')
+        with self.__bt_discoverable_jobs_lock:
+            if job_id is None:
+                job = next(reversed(self.__bt_discoverable_jobs.values()), None)
+            else:
+                job = self.__bt_discoverable_jobs.get(job_id)
+        if job is None:
+            return {
+                'job_id': job_id,
+                'job': None,
+                'success': False,
+            }
+        return self.__make_bt_discoverable_job_response(job)
+
+    def __make_bt_discoverable_job_response(self, job):
         return {
-            'success': success,
+            'job_id': job.job_id,
+            'job': job.to_dict(),
+            'success': True,
         }
 
+    def __get_latest_bt_discoverable_job_summary(self):
+        with self.__bt_discoverable_jobs_lock:
+            job = next(reversed(self.__bt_discoverable_jobs.values()), None)
+        if job is None:
+            return None
+        job = job.to_dict()
+        return {key: job[key] for key in ('job_id', 'phase', 'error')}
+
+    def __run_bt_discoverable_job(self, job):
+        self.__logger.info(f"Making bluetooth discoverable (job {job.job_id})...")
+        lock_fd = os.open(self.BT_DISCOVERABLE_LOCK_FILE, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # The sweeper is making bluetooth undiscoverable
+                raise Exception('Bluetooth is being made undiscoverable. Try again.')
+
+            # Restart bluetooth and bt-speaker because they can get flakey and won't accept connections after a day or so.
+            job.set_phase(BtDiscoverableJob.PHASE_RESTARTING_SERVICES)
+            with Metrics.time_command('systemctl restart bluetooth bt-speaker'):
+                subprocess.check_output(
+                    self.__RESTART_BT_SERVICES_CMD, shell = True, executable = '/bin/bash', stderr = subprocess.STDOUT
+                )
+
+            # We used to sleep for a fixed 3s here: 1s was too short about half the time on the study pi, and clients
+            # would not find the receiver. Instead, wait until the adapter reports that it is powered on.
+            job.set_phase(BtDiscoverableJob.PHASE_WAITING_FOR_ADAPTER)
+            timeout_s = Config.get('receiver.bt_adapter_ready_timeout_s', 10)
+            if not self.__wait_for_bt_adapter_property('Powered', True, timeout_s):
+                raise Exception(f'The bluetooth adapter was not powered on within {timeout_s}s.')
+
+            # Check that the change took: if bluetooth isn't fully up yet, it may not.
+            job.set_phase(BtDiscoverableJob.PHASE_MAKING_DISCOVERABLE)
+            deadline = time.monotonic() + timeout_s
+            while True:
+                self.__dbus_client.set_bluetooth_discoverable(True, throw = True)
+                if self.__wait_for_bt_adapter_property('Discoverable', True, 1):
+                    break
+                if time.monotonic() >= deadline:
+                    raise Exception(f'The bluetooth adapter did not become discoverable within {timeout_s}s.')
+
+            with open(self.BT_DISCOVERABLE_SUCCESS_FILE, 'a'):
+                os.utime(self.BT_DISCOVERABLE_SUCCESS_FILE)
+            job.set_phase(BtDiscoverableJob.PHASE_DONE)
+            self.__logger.info(f"Made bluetooth discoverable (job {job.job_id}).")
+        except Exception as e:
+            self.__logger.error(f"Unable to make bluetooth discoverable (job {job.job_id}): {e}")
+            job.fail(str(e))
+        finally:
+            os.close(lock_fd)
+
+    # Returns whether the bluez adapter's property reached the value within timeout_s seconds. The adapter may not
+    # exist for a moment after restarting bluetooth, so failures to get the property are retried.
+    def __wait_for_bt_adapter_property(self, prop, value, timeout_s):
+        deadline = time.monotonic() + timeout_s
+        while True:
+            try:
+                if self.__dbus_client.get_bluetooth_adapter_property(prop, throw = True) == value:
+                    return True
+            except Exception:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.__BT_ADAPTER_POLL_INTERVAL_S)
+
+    # Disconnect the receiver's bluetooth and AirPlay clients. post_data may contain:
+    #   `client_name`: only disconnect the client with this name: a bluetooth device's name, or the AirPlay client's
+    #     name (see `shairport_sync_client_name` in the receiver data). By default, all clients are disconnected.
+    #
+    # We disconnect clients over D-Bus: each connected bluetooth device is told to disconnect, and shairport-sync
+    # is told to drop its AirPlay session. This takes a fraction of a second, and leaves the services running. If
+    # that fails, and we were asked to disconnect all clients, we escalate to restarting the bluetooth and
+    # shairport-sync services, which takes several seconds. Returns e.g.:
+    #   {
+    #       "method": "dbus",
+    #       "disconnected": [{"type": "bluetooth", "name": "dasl's iPhone"}, {"type": "airplay", "name": "Living Room"}],
+    #       "success": true
+    #   }
+    # where method is "dbus" or "restart".
     def disconnect_clients(self, post_data):
-        success = True
+        client_name = (post_data or {}).get('client_name')
+        response = {
+            'method': 'dbus',
+            'disconnected': [],
+            'success': True,
+        }
+        try:
+            response['disconnected'] = self.__disconnect_clients_via_dbus(client_name)
+            if client_name is not None and not response['disconnected']:
+                response['success'] = False
+                response['error'] = f'No connected client named {client_name}.'
+        except Exception as e:
+            if client_name is not None:
+                # Restarting the services would disconnect every client, not just the one we were asked to.
+                self.__logger.error(f"Unable to disconnect client {client_name}: {e}")
+                response['success'] = False
+                response['error'] = str(e)
+            else:
+                self.__logger.warning(f"Unable to disconnect clients via D-Bus: {e}. Restarting services instead...")
+                response['method'] = 'restart'
+                response['success'] = self.__disconnect_clients_via_restart()
+        self.__state_service.request_refresh()
+        return response
+
+    # Returns the clients that were disconnected. Raises if any client could not be disconnected.
+    def __disconnect_clients_via_dbus(self, client_name):
+        disconnected = []
+        for device in self.__dbus_client.get_connected_bluetooth_devices(throw = True):
+            if client_name is not None and device['name'] != client_name:
+                continue
+            self.__logger.info(f"Disconnecting bluetooth device {device['name']} ({device['address']})...")
+            self.__dbus_client.disconnect_bluetooth_device(device['path'], throw = True)
+            disconnected.append({'type': 'bluetooth', 'name': device['name']})
+
+        shairport_sync_props = self.__dbus_client.get_shairport_sync_remote_control_properties(throw = True)
+        airplay_client_name = shairport_sync_props.get('ClientName')
+        if airplay_client_name and (client_name is None or airplay_client_name == client_name):
+            self.__logger.info(f"Dropping AirPlay session of {airplay_client_name}...")
+            self.__dbus_client.drop_shairport_sync_session(throw = True)
+            disconnected.append({'type': 'airplay', 'name': airplay_client_name})
+        return disconnected
+
+    # Returns whether the services were restarted.
+    def __disconnect_clients_via_restart(self):
         self.__logger.info("Disconnecting clients by restarting bluetooth and shairport-sync services...")
         try:
-            subprocess.check_output(
-                f"{self.__RESTART_BT_SERVICES_CMD} && sudo systemctl restart shairport-sync.service",
-                shell = True, executable = '/bin/bash', stderr=subprocess.STDOUT
-            ).decode("utf-8")
+            with Metrics.time_command('systemctl restart bluetooth bt-speaker shairport-sync'):
+                subprocess.check_output(
+                    f"{self.__RESTART_BT_SERVICES_CMD} && sudo systemctl restart shairport-sync.service",
+                    shell = True, executable = '/bin/bash', stderr=subprocess.STDOUT
+                ).decode("utf-8")
         except Exception:
-            success = False
-
-        return {
-            'success': success,
-        }
+            return False
+        return True
 
 class PccReceiverServerRequestHandler(BaseHTTPRequestHandler):
 
+    # Keep connections open between requests, so that clients polling us don't open a new TCP connection for
+    # every request. This requires every response to have a Content-Length, unless the connection is closed after
+    # it.
+    protocol_version = 'HTTP/1.1'
+
+    # Close connections that have been idle for this long. This also bounds how long we wait for a request to
+    # arrive in full.
+    timeout = 60
+
+    # Let browsers cache the result of a CORS preflight request for this long, rather than send one before every
+    # POST. Browsers may cap this, e.g. chrome caps it at 2 hours.
+    CORS_MAX_AGE_S = 86400
+
+    # How often to send a comment on idle event streams, so that proxies and clients don't time them out.
+    __EVENT_STREAM_KEEPALIVE_INTERVAL_S = 15
+
     def __init__(self, request, client_address, server):
-        self.__api = ReceiverAPI()
+        self.__api = server.receiver_api
         self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__request_received_at = None
+
+        # The Server-Timing of the response being sent, for log_request
+        self.__server_timing = None
+
+        # Whether the connection is being streamed to from its own thread, see __run_stream
+        self.__is_detached = False
+
+        # Serves the first request of the connection, see handle
         BaseHTTPRequestHandler.__init__(self, request, client_address, server)
 
+    # Override: serve a single request, rather than all the requests of the connection. Between requests, the
+    # connection waits for the next one without holding a thread, see PccReceiverThreadingHTTPServer.
+    def handle(self):
+        self.close_connection = True
+        self.__handle_one_request()
+
+        # Requests that were pipelined behind this one may already be buffered in rfile, where the server won't
+        # see them arrive: serve them now.
+        while not self.close_connection and not self.__is_detached and self.__has_buffered_request():
+            self.__handle_one_request()
+
+    # Serve the next request of the connection, once it has started to arrive.
+    def handle_next_request(self):
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    # Override: keep the connection's files open while the connection is kept alive, or streamed to from another
+    # thread. See close.
+    def finish(self):
+        if self.close_connection and not self.__is_detached:
+            super().finish()
+
+    def close(self):
+        super().finish()
+
+    # Whether the connection is being streamed to from its own thread, in which case that thread closes it when it's
+    # done. See __run_stream.
+    def is_detached(self):
+        return self.__is_detached
+
+    # The server only hands us connections whose request has arrived in full, but a request pipelined behind it may
+    # have only partially arrived: don't let a slow client hold this thread for long while we read its head.
+    def __handle_one_request(self):
+        self.connection.settimeout(self.server.request_head_timeout_s)
+        self.handle_one_request()
+
+    def __has_buffered_request(self):
+        timeout = self.connection.gettimeout()
+        self.connection.setblocking(False)
+        try:
+            # Doesn't block: returns what is buffered, or what has arrived on the connection, if anything.
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+    # Override: called once the request line has been read, so this excludes the time the connection sat idle
+    # waiting for the request. See log_request.
+    #
+    # Once the head of the request has been read, restore the usual timeout, rather than the short one we read the
+    # head with, see __handle_one_request.
+    def parse_request(self):
+        self.__request_received_at = time.perf_counter()
+        try:
+            return super().parse_request()
+        finally:
+            self.connection.settimeout(self.timeout)
+
     def do_OPTIONS(self):
         self.send_response(200, "ok")
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header("Access-Control-Allow-Headers", "X-Requested-With")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        # For conditional requests, see ReceiverAPI.get_conditional_receiver_data
+        self.send_header("Access-Control-Allow-Headers", "If-None-Match")
+        self.send_header("Access-Control-Max-Age", str(self.CORS_MAX_AGE_S))
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
@@ -124,20 +691,25 @@ class PccReceiverServerRequestHandler(BaseHTTPRequestHandler):
             if get_data:
                 get_data = json.loads(get_data)
 
-            if parsed_path.path == '/receiver_data':
-                response = self.__api.get_receiver_data()
-            else:
+            if parsed_path.path == '/receiver_events':
+                self.__run_stream(self.__stream_receiver_events)
+                return
+            elif parsed_path.path == '/vol_pct_ws':
+                self.__run_stream(self.__serve_vol_pct_websocket)
+                return
+
+            with Spans.record() as spans:
+                response = self.__api.handle_request(
+                    'GET', parsed_path.path, get_data, if_none_match = self.headers.get('If-None-Match')
+                )
+            if response is None:
                 self.__do_404()
                 return
 
-            self.send_response(200)
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            resp = BytesIO()
-            resp.write(bytes(json.dumps(response), 'utf-8'))
-            self.wfile.write(resp.getvalue())
+            self.__send_response(response, spans)
         except Exception:
+            # We may not have sent a complete response: close the connection, so the client doesn't wait for one.
+            self.close_connection = True
             self.log_error('Exception: {}'.format(traceback.format_exc()))
 
     def do_POST(self):
@@ -149,42 +721,161 @@ class PccReceiverServerRequestHandler(BaseHTTPRequestHandler):
                 body = self.rfile.read(content_length)
                 post_data = json.loads(body.decode("utf-8"))
 
-            if self.path == '/vol_pct':
-                response = self.__api.set_vol_pct(post_data)
-            elif self.path == '/make_bt_discoverable':
-                response = self.__api.make_bt_discoverable(post_data)
-            elif self.path == '/disconnect_clients':
-                response = self.__api.disconnect_clients(post_data)
-            else:
+            with Spans.record() as spans:
+                response = self.__api.handle_request('POST', self.path, post_data)
+            if response is None:
                 self.__do_404()
                 return
 
+            self.__send_response(response, spans)
+        except Exception:
+            # We may not have sent a complete response: close the connection, so the client doesn't wait for one.
+            self.close_connection = True
+            self.log_error('Exception: {}'.format(traceback.format_exc()))
+
+    # Run `stream`, a function that serves a long-lived response, e.g. an event stream, in its own thread, so that it
+    # doesn't hold one of the server's workers for as long as the client stays connected. The thread closes the
+    # connection once the stream ends. The number of streams is capped, see PccReceiverThreadingHTTPServer.
+    def __run_stream(self, stream):
+        if not self.server.stream_slots.acquire(blocking = False):
+            self.__do_503()
+            return
+        self.__is_detached = True
+        threading.Thread(target = self.__serve_stream, args = (stream,), name = 'ReceiverStream', daemon = True).start()
+
+    def __serve_stream(self, stream):
+        try:
+            stream()
+        except Exception:
+            self.log_error('Exception: {}'.format(traceback.format_exc()))
+        finally:
+            self.server.stream_slots.release()
+            try:
+                self.close()
+            finally:
+                self.server.shutdown_request(self.connection)
+
+    # Stream the receiver data via Server-Sent Events: a 'state' event with the full receiver data on connect,
+    # followed by a 'delta' event with only the keys that changed whenever the receiver data changes.
+    # See: https://html.spec.whatwg.org/multipage/server-sent-events.html
+    def __stream_receiver_events(self):
+        self.close_connection = True
+        subscription = self.__api.subscribe_to_receiver_data()
+        try:
+            state = self.__api.get_receiver_data()
             self.send_response(200)
             self.send_header("Access-Control-Allow-Origin", "*")
-            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            # The stream has no Content-Length: it ends when the connection is closed
+            self.send_header("Connection", "close")
             self.end_headers()
-            resp = BytesIO()
-            resp.write(bytes(json.dumps(response), 'utf-8'))
-            self.wfile.write(resp.getvalue())
-        except Exception:
-            self.log_error('Exception: {}'.format(traceback.format_exc()))
+            self.__write_event('state', state)
+
+            while True:
+                changes = subscription.get_changes(timeout = self.__EVENT_STREAM_KEEPALIVE_INTERVAL_S)
+                if changes:
+                    self.__write_event('delta', changes)
+                else:
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            pass
+        finally:
+            self.__api.unsubscribe_from_receiver_data(subscription)
+
+    def __write_event(self, event, data):
+        self.wfile.write(bytes(f'event: {event}\ndata: {json.dumps(data)}\n\n', 'utf-8'))
+        self.wfile.flush()
+
+    # See ReceiverAPI.serve_vol_pct_channel
+    def __serve_vol_pct_websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_response(400)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.close_connection = True
+        self.send_response(HTTPStatus.SWITCHING_PROTOCOLS)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', WebSocket.make_accept_key(key))
+        self.end_headers()
+
+        # The channel may be idle for a long time between volume changes, e.g. until the next slider drag.
+        self.connection.settimeout(None)
+        self.__api.serve_vol_pct_channel(WebSocket(self.rfile, self.wfile))
+
+    # Send a response returned by ReceiverAPI.handle_request, along with a Server-Timing header of the spans recorded
+    # while handling the request, and a 'total' span for the time since the request was received.
+    def __send_response(self, response, spans):
+        status, headers, body = ReceiverAPI.encode_response(response, spans)
+        spans.add('total', time.perf_counter() - self.__request_received_at)
+        server_timing = spans.to_server_timing()
+        self.__server_timing = server_timing
+        self.send_response(status)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        # A 304 response has no body, and its Content-Length would be taken as that of the client's copy.
+        if status != HTTPStatus.NOT_MODIFIED:
+            self.send_header("Content-Length", str(len(body)))
+        self.send_header("Server-Timing", server_timing)
+        # The web app is served from another origin (the controller): let it see the Server-Timing header too.
+        self.send_header("Timing-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
 
     def __do_404(self):
         self.send_response(404)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
+    def __do_503(self):
+        self.close_connection = True
+        self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Retry-After", str(self.server.retry_after_s))
+        self.send_header("Content-Length", "0")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    # Called by send_response, i.e. as we send the head of the response.
     def log_request(self, code='-', size='-'):
         if isinstance(code, HTTPStatus):
             code = code.value
-        self.log_message('[REQUEST] "%s" %s %s', self.requestline, str(code), str(size))
+        if self.__request_received_at is not None and self.command:
+            self.__api.observe_request(
+                self.command, self.path.partition('?')[0], code, time.perf_counter() - self.__request_received_at
+            )
+            self.__request_received_at = None
+        server_timing = self.__server_timing
+        self.__server_timing = None
+        if server_timing and Config.get('receiver.log_server_timing', False):
+            self.log_message('[REQUEST] "%s" %s %s timing="%s"', self.requestline, str(code), str(size), server_timing)
+        else:
+            self.log_message('[REQUEST] "%s" %s %s', self.requestline, str(code), str(size))
 
     def log_error(self, format, *args):
+        # An idle connection timing out is expected with persistent connections, not an error.
+        if format.startswith('Request timed out'):
+            return self.log_message(format, *args)
         self.__logger.error("%s - - %s" % (self.client_address[0], format % args))
 
     def log_message(self, format, *args):
         self.__logger.info("%s - - %s" % (self.client_address[0], format % args))
 
-class PccReceiverThreadingHTTPServer(ThreadingHTTPServer):
+# Serves requests on a bounded pool of worker threads, see RequestDispatcher, rather than a thread per connection as
+# ThreadingHTTPServer does. With a thread per connection, if amixer or D-Bus hangs, every poll that comes in starts
+# another thread that hangs too, until we run out of memory. Instead, once the workers are busy, requests queue up
+# to a limit, past which they are rejected with a 503. Requests the user is waiting on, e.g. setting the volume,
+# have workers of their own, so they aren't stuck behind the polls.
+#
+# Long-lived responses (/receiver_events, /vol_pct_ws) each run in their own thread, up to `receiver.max_streams`.
+class PccReceiverThreadingHTTPServer(HTTPServer):
 
     # Override: https://github.com/python/cpython/blob/18cb2ef46c9998480f7182048435bc58265c88f2/Lib/socketserver.py#L421-L443
     # See: https://docs.python.org/3/library/socketserver.html#socketserver.BaseServer.request_queue_size
@@ -192,10 +883,77 @@ class PccReceiverThreadingHTTPServer(ThreadingHTTPServer):
     #   [Sat Jan 29 00:44:36 2022] TCP: request_sock_TCP: Possible SYN flooding on port 80. Sending cookies.  Check SNMP counters.
     request_queue_size = 128
 
+    def __init__(self, server_address, RequestHandlerClass):
+        # Shared by all requests, so that the receiver state is fetched from the hardware in one place.
+        self.receiver_api = ReceiverAPI()
+        self.retry_after_s = Config.get('receiver.retry_after_s', 1)
+        self.request_head_timeout_s = Config.get('receiver.request_head_timeout_s', 2)
+        self.stream_slots = threading.BoundedSemaphore(Config.get('receiver.max_streams', 32))
+        self.__dispatcher = RequestDispatcher(
+            self.__serve_request, self.__close_connection,
+            num_workers = Config.get('receiver.worker_threads', 8),
+            num_priority_workers = Config.get('receiver.priority_worker_threads', 2),
+            num_slow_workers = Config.get('receiver.slow_worker_threads', 1),
+            max_queued_requests = Config.get('receiver.max_queued_requests', 32),
+            idle_timeout_s = RequestHandlerClass.timeout,
+            head_timeout_s = self.request_head_timeout_s,
+            retry_after_s = self.retry_after_s,
+        )
+        super().__init__(server_address, RequestHandlerClass)
+
+    # Override: rather than serve the connection right away, hand it to the dispatcher, which serves its requests as
+    # they arrive.
+    def process_request(self, request, client_address):
+        self.__dispatcher.add_connection(PooledConnection(request, client_address))
+
+    # Called by the dispatcher, from a worker thread. See RequestDispatcher.
+    def __serve_request(self, conn):
+        if conn.handler is None:
+            # Serves the first request
+            conn.handler = self.RequestHandlerClass(conn.sock, conn.client_address, self)
+        else:
+            conn.handler.handle_next_request()
+
+        if conn.handler.is_detached():
+            return None
+        return not conn.handler.close_connection
+
+    def __close_connection(self, conn):
+        try:
+            if conn.handler is not None:
+                conn.handler.close()
+        finally:
+            self.shutdown_request(conn.sock)
+
+# A connection of PccReceiverThreadingHTTPServer, and the handler serving its requests, once the first one arrives.
+class PooledConnection:
+
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.client_address = client_address
+        self.handler = None
+
 class ReceiverServer:
 
-    def __init__(self):
-        self.__server = PccReceiverThreadingHTTPServer(('0.0.0.0', 8080), PccReceiverServerRequestHandler)
+    # Server engines, selected via the `receiver.server_engine` config setting
+    ENGINE_THREADING = 'threading'
+    ENGINE_ASYNCIO = 'asyncio'
+
+    DEFAULT_PORT = 8080
+
+    def __init__(self, port = DEFAULT_PORT):
+        server_address = ('0.0.0.0', port)
+        engine = Config.get('receiver.server_engine', self.ENGINE_THREADING)
+        if engine == self.ENGINE_ASYNCIO:
+            # Imported here because it imports this module
+            from pcc.asyncreceiverserver import AsyncReceiverServer
+            self.__server = AsyncReceiverServer(ReceiverAPI(), server_address)
+        else:
+            if engine != self.ENGINE_THREADING:
+                Logger().set_namespace(self.__class__.__name__).warning(
+                    f'Unknown server engine: {engine}, using {self.ENGINE_THREADING}.'
+                )
+            self.__server = PccReceiverThreadingHTTPServer(server_address, PccReceiverServerRequestHandler)
 
     def serve_forever(self):
         self.__server.serve_forever()
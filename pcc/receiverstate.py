@@ -0,0 +1,165 @@
+import threading
+import time
+
+from pcc.config import Config
+from pcc.logger import Logger
+from pcc.spans import Spans
+
+# Keeps an in-memory snapshot of the receiver's state (volume, shairport-sync client, bluetooth discoverability,
+# etc), refreshed in a background thread. Reads are served from memory, so the cost of fetching the state from
+# the hardware doesn't grow with the number of clients polling us.
+#
+# The snapshot is refreshed every `receiver.state_refresh_interval_s` seconds, and immediately when
+# `request_refresh` is called, e.g. after a request that changes the state, or when we are notified that the
+# state changed. If nobody has read the state in a while and there are no subscribers, we stop refreshing it
+# until the next read.
+#
+# Subscribers (see `subscribe`) are sent the keys of the state that changed whenever a refresh changes it.
+class ReceiverStateService:
+
+    # Stop refreshing if nobody has read the state in this long.
+    __IDLE_TIMEOUT_S = 30
+
+    # How long a reader will wait for a fresh snapshot when the current one is too stale to serve.
+    __MAX_WAIT_S = 5
+
+    # `fetch_state`: a function that fetches the state from the hardware and returns it as a dict
+    def __init__(self, fetch_state):
+        self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__fetch_state = fetch_state
+        self.__refresh_interval_s = Config.get('receiver.state_refresh_interval_s', 1)
+
+        self.__cond = threading.Condition()
+        self.__state = None
+        self.__refreshed_at = None
+        self.__num_refreshes = 0
+        self.__version = 0
+        self.__is_refresh_requested = False
+        self.__last_read_at = time.monotonic()
+        self.__subscriptions = set()
+        self.__thread = None
+
+        # The spans recorded while fetching the current state, see Spans
+        self.__refresh_spans = []
+
+    # Returns a tuple of (state, age_s, version), where age_s is the number of seconds since the state was fetched, and
+    # version is a number that increases whenever the state changes. Refreshes that don't change the state keep its
+    # version, so that clients can tell that they already have the latest state, see ReceiverAPI.get_receiver_data.
+    def get_state(self):
+        with self.__cond:
+            self.__start_if_not_started()
+            now = time.monotonic()
+            self.__last_read_at = now
+
+            # The snapshot may be very stale if we stopped refreshing it because nobody was reading it. In that
+            # case, wait for a fresh one rather than serve it.
+            if self.__state is None or (now - self.__refreshed_at) > (2 * self.__refresh_interval_s):
+                num_refreshes = self.__num_refreshes
+                self.__is_refresh_requested = True
+                self.__cond.notify_all()
+                self.__cond.wait_for(lambda: self.__num_refreshes > num_refreshes, timeout = self.__MAX_WAIT_S)
+
+            if self.__state is None:
+                raise Exception('Unable to fetch receiver state.')
+            return self.__state, time.monotonic() - self.__refreshed_at, self.__version
+
+    # Returns the number of seconds since the state was fetched, or None if it hasn't been yet. Unlike get_state, this
+    # doesn't count as a read, so it doesn't keep the state refreshing.
+    def get_age_s(self):
+        with self.__cond:
+            if self.__refreshed_at is None:
+                return None
+            return round(time.monotonic() - self.__refreshed_at, 3)
+
+    # Returns the spans recorded while fetching the current state, as a list of (name, duration_s) tuples. The state
+    # is fetched in the background, so these aren't part of the time it takes to read the state, but they show
+    # which part of fetching it is slow.
+    def get_refresh_spans(self):
+        with self.__cond:
+            return self.__refresh_spans
+
+    # Refresh the state as soon as possible, rather than waiting for the next scheduled refresh.
+    def request_refresh(self):
+        with self.__cond:
+            self.__start_if_not_started()
+            self.__is_refresh_requested = True
+            self.__cond.notify_all()
+
+    # Returns a ReceiverStateSubscription, which receives the changes to the state from now on. Callers must
+    # call `unsubscribe` when they are done with it.
+    # on_publish: optional function to call, with no arguments, whenever changes are published to the subscription,
+    #   for subscribers that can't block in `get_changes`. It is called from the refresh thread, so it should be
+    #   quick, e.g. to wake up an event loop.
+    def subscribe(self, on_publish = None):
+        subscription = ReceiverStateSubscription(on_publish)
+        with self.__cond:
+            self.__subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__cond:
+            self.__subscriptions.discard(subscription)
+
+    def __start_if_not_started(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target = self.__run, name = self.__class__.__name__, daemon = True)
+            self.__thread.start()
+
+    def __is_idle(self):
+        return not self.__subscriptions and (time.monotonic() - self.__last_read_at) > self.__IDLE_TIMEOUT_S
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: self.__is_refresh_requested, timeout = self.__refresh_interval_s)
+                if self.__is_idle():
+                    self.__cond.wait_for(lambda: self.__is_refresh_requested)
+                self.__is_refresh_requested = False
+
+            try:
+                with Spans.record() as spans:
+                    state = self.__fetch_state()
+            except Exception as e:
+                self.__logger.error(f'Unable to fetch receiver state: {e}')
+                state = None
+
+            with self.__cond:
+                if state is not None:
+                    if self.__state is not None and self.__subscriptions:
+                        changes = {key: value for key, value in state.items() if self.__state.get(key) != value}
+                        if changes:
+                            for subscription in self.__subscriptions:
+                                subscription.publish(changes)
+                    if state != self.__state:
+                        self.__version += 1
+                    self.__state = state
+                    self.__refreshed_at = time.monotonic()
+                    self.__refresh_spans = spans.get_spans()
+                self.__num_refreshes += 1
+                self.__cond.notify_all()
+
+# A subscriber's view of the changes to the receiver state. Changes that the subscriber hasn't consumed yet are
+# merged together, latest value wins, so a slow subscriber never has more than one state's worth of changes
+# pending.
+class ReceiverStateSubscription:
+
+    def __init__(self, on_publish = None):
+        self.__cond = threading.Condition()
+        self.__pending_changes = {}
+        self.__on_publish = on_publish
+
+    def publish(self, changes):
+        with self.__cond:
+            self.__pending_changes.update(changes)
+            self.__cond.notify_all()
+        if self.__on_publish is not None:
+            self.__on_publish()
+
+    # Wait up to `timeout` seconds for changes. Returns a dict of the keys that changed and their new values,
+    # or an empty dict if nothing changed before the timeout.
+    def get_changes(self, timeout = None):
+        with self.__cond:
+            self.__cond.wait_for(lambda: self.__pending_changes, timeout = timeout)
+            changes = self.__pending_changes
+            self.__pending_changes = {}
+            return changes
@@ -0,0 +1,273 @@
+import collections
+import re
+import selectors
+import socket
+import threading
+import time
+
+from pcc.logger import Logger
+from pcc.metrics import Metrics
+
+# Serves the requests of many keep-alive connections with a fixed number of worker threads, rather than a thread per
+# connection. See PccReceiverThreadingHTTPServer.
+#
+# Idle connections wait in a selector, which costs no thread. When a request arrives on one, the connection is
+# queued for a worker, which serves that one request and hands the connection back to the selector. Connections
+# that stay idle for longer than idle_timeout_s are closed.
+#
+# A connection is only queued once its request has arrived in full: its head, and its body if that is small, so that
+# a worker never waits on a slow or stalled client. Until then, the connection is polled every
+# __PARTIAL_POLL_INTERVAL_S, and it is closed if the request hasn't arrived within head_timeout_s of its first byte.
+#
+# There are three lanes, each with its own queue and workers (see get_lane):
+# * priority: requests the user is waiting on, e.g. setting the volume
+# * slow: requests that take seconds by design, e.g. profiling, or restarting services
+# * normal: everything else, mostly polls
+# so that a pile of polls stuck behind a hung amixer or D-Bus call can't delay the volume slider, and slow requests
+# can't hold up either.
+#
+# When a lane's queue is full, new requests in that lane are rejected right away with a 503 and a Retry-After
+# header, rather than queued without bound.
+class RequestDispatcher:
+
+    LANE_NORMAL = 'normal'
+    LANE_PRIORITY = 'priority'
+    LANE_SLOW = 'slow'
+
+    # Requests starting with these bytes go in the slow or priority lanes, checked in that order. This is decided by
+    # peeking at the start of the request, before it is read.
+    __SLOW_REQUEST_PREFIXES = (b'GET /profile', b'POST /disconnect_clients')
+    __PRIORITY_REQUEST_PREFIXES = (b'POST ', b'OPTIONS ', b'GET /vol_pct_ws')
+
+    # How much of a request to peek at, to tell whether it has arrived in full. Requests larger than this are queued
+    # once this much has arrived.
+    __PEEK_SIZE = 65536
+    # Like http.server, accept bare LFs as line endings
+    __HEAD_END_RE = re.compile(rb'\r?\n\r?\n')
+    __CONTENT_LENGTH_RE = re.compile(rb'\ncontent-length:[ \t]*(\d+)', re.IGNORECASE)
+
+    # How often to check whether the rest of a partially received request has arrived. The selector can't tell us:
+    # the part that has arrived is only peeked at, so the connection stays readable.
+    __PARTIAL_POLL_INTERVAL_S = 0.05
+
+    __shed_requests = Metrics.counter(
+        'pcc_http_requests_shed_total', 'Requests rejected with a 503 because their lane was full.', ('lane',)
+    )
+    __timed_out_requests = Metrics.counter(
+        'pcc_http_requests_timed_out_total', 'Connections closed because their request did not arrive in time.'
+    )
+
+    # serve_request: function to call, from a worker thread, with a connection whose request has started to arrive.
+    #   Returns whether to keep the connection open for another request. If the function has taken over the
+    #   connection, e.g. to stream to it from another thread, it returns None, and the dispatcher forgets about it.
+    # close_connection: function to call with a connection to close it
+    # num_workers, num_priority_workers, num_slow_workers: the number of worker threads of each lane
+    # max_queued_requests: the number of requests each lane may queue before shedding load
+    # head_timeout_s: how long a request may take to arrive, from its first byte
+    def __init__(
+        self, serve_request, close_connection, num_workers, num_priority_workers, num_slow_workers,
+        max_queued_requests, idle_timeout_s, head_timeout_s, retry_after_s
+    ):
+        self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__serve_request = serve_request
+        self.__close_connection = close_connection
+        self.__max_queued_requests = max_queued_requests
+        self.__idle_timeout_s = idle_timeout_s
+        self.__head_timeout_s = head_timeout_s
+        self.__shed_response = bytes(
+            'HTTP/1.1 503 Service Unavailable\r\n' +
+            f'Retry-After: {retry_after_s}\r\n' +
+            'Access-Control-Allow-Origin: *\r\n' +
+            'Content-Length: 0\r\n' +
+            'Connection: close\r\n\r\n',
+            'latin-1'
+        )
+
+        self.__lock = threading.Lock()
+        num_workers_by_lane = {
+            self.LANE_NORMAL: num_workers,
+            self.LANE_PRIORITY: num_priority_workers,
+            self.LANE_SLOW: num_slow_workers,
+        }
+        self.__queues = {lane: collections.deque() for lane in num_workers_by_lane}
+        self.__has_requests = {lane: threading.Condition(self.__lock) for lane in num_workers_by_lane}
+
+        # Connections to add to the selector, handed over by other threads. Only the selector's thread touches the
+        # selector. Writing to __wakeup_writer wakes it up.
+        self.__selector = selectors.DefaultSelector()
+        self.__connections_to_select = []
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__selector.register(self.__wakeup_reader, selectors.EVENT_READ)
+
+        for lane, num_lane_workers in num_workers_by_lane.items():
+            for i in range(max(1, num_lane_workers)):
+                threading.Thread(
+                    target = self.__work, args = (lane,), name = f'RequestWorker-{lane}-{i}', daemon = True
+                ).start()
+        threading.Thread(target = self.__select, name = 'RequestSelector', daemon = True).start()
+
+        Metrics.register_callback(
+            'pcc_http_queued_requests', 'gauge', 'Requests waiting for a worker, in all lanes.',
+            lambda: sum(len(queue) for queue in self.__queues.values())
+        )
+
+    # Serve the requests of a connection, once they arrive.
+    # conn: an object with a `sock` attribute, the connection's socket, along with whatever state serve_request and
+    #   close_connection need about it
+    def add_connection(self, conn):
+        with self.__lock:
+            self.__connections_to_select.append(conn)
+        self.__wake_up_selector()
+
+    # Returns the lane to serve a request that starts with these bytes in, e.g. b'GET /receiver_data HTTP/1.1'
+    @staticmethod
+    def get_lane(start):
+        if start.startswith(RequestDispatcher.__SLOW_REQUEST_PREFIXES):
+            return RequestDispatcher.LANE_SLOW
+        if start.startswith(RequestDispatcher.__PRIORITY_REQUEST_PREFIXES):
+            return RequestDispatcher.LANE_PRIORITY
+        return RequestDispatcher.LANE_NORMAL
+
+    def __work(self, lane):
+        queue = self.__queues[lane]
+        has_requests = self.__has_requests[lane]
+        while True:
+            with self.__lock:
+                while not queue:
+                    has_requests.wait()
+                conn = queue.popleft()
+
+            try:
+                keep_alive = self.__serve_request(conn)
+            except Exception as e:
+                self.__logger.error(f'Unable to serve request: {e}')
+                keep_alive = False
+
+            if keep_alive is None:
+                continue
+            if keep_alive:
+                self.add_connection(conn)
+            else:
+                self.__close(conn)
+
+    def __select(self):
+        # conn -> when it went idle, as a monotonic time
+        idle_since = {}
+
+        # Connections whose request has started to arrive, but not in full. conn -> when its first byte arrived
+        partial_since = {}
+        while True:
+            try:
+                events = self.__selector.select(timeout = self.__PARTIAL_POLL_INTERVAL_S if partial_since else 1)
+                now = time.monotonic()
+                for key, mask in events:
+                    if key.fileobj is self.__wakeup_reader:
+                        self.__drain_wakeups()
+                        continue
+                    conn = key.data
+                    self.__selector.unregister(conn.sock)
+                    del idle_since[conn]
+                    if not self.__dispatch(conn):
+                        partial_since[conn] = now
+
+                for conn, since in list(partial_since.items()):
+                    if self.__dispatch(conn):
+                        del partial_since[conn]
+                    elif now - since > self.__head_timeout_s:
+                        del partial_since[conn]
+                        self.__timed_out_requests.inc()
+                        self.__close(conn)
+
+                with self.__lock:
+                    conns = self.__connections_to_select
+                    self.__connections_to_select = []
+                for conn in conns:
+                    try:
+                        self.__selector.register(conn.sock, selectors.EVENT_READ, conn)
+                    except (ValueError, OSError):
+                        # The connection was closed
+                        self.__close(conn)
+                        continue
+                    idle_since[conn] = now
+
+                for conn, since in list(idle_since.items()):
+                    if now - since > self.__idle_timeout_s:
+                        self.__selector.unregister(conn.sock)
+                        del idle_since[conn]
+                        self.__close(conn)
+            except Exception as e:
+                self.__logger.error(f'Error in selector: {e}')
+
+    # Queue a connection whose request has arrived in full, or shed it if its lane is full. Returns False, and
+    # does nothing, if the request has only partially arrived. Called once the connection is readable, so peeking
+    # at it doesn't block.
+    def __dispatch(self, conn):
+        try:
+            request = conn.sock.recv(self.__PEEK_SIZE, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return False
+        except OSError:
+            request = b''
+        if not request:
+            # The client closed the connection, or it failed
+            self.__close(conn)
+            return True
+        if not self.__has_arrived(request):
+            return False
+
+        lane = self.get_lane(request)
+        with self.__lock:
+            queue = self.__queues[lane]
+            if len(queue) < self.__max_queued_requests:
+                queue.append(conn)
+                self.__has_requests[lane].notify()
+                return True
+        self.__shed(conn, lane)
+        return True
+
+    # Whether the request, as far as it has been peeked, has arrived in full: its head, and its body, if any
+    def __has_arrived(self, request):
+        if len(request) >= self.__PEEK_SIZE:
+            return True
+        head_end = self.__HEAD_END_RE.search(request)
+        if head_end is None:
+            return False
+        body_start = head_end.end()
+        match = self.__CONTENT_LENGTH_RE.search(request, 0, body_start)
+        content_length = int(match.group(1)) if match else 0
+        return len(request) >= min(body_start + content_length, self.__PEEK_SIZE)
+
+    # Reject the request with a 503. This must not block the selector's thread, so we only send what the socket
+    # will take right away, which a 503 always fits in.
+    def __shed(self, conn, lane):
+        self.__shed_requests.inc((lane,))
+        try:
+            # Read what has arrived of the request, so that closing the connection doesn't reset it before the client
+            # reads our response.
+            conn.sock.recv(65536, socket.MSG_DONTWAIT)
+            conn.sock.send(self.__shed_response, socket.MSG_DONTWAIT)
+        except OSError:
+            pass
+        self.__close(conn)
+
+    def __close(self, conn):
+        try:
+            self.__close_connection(conn)
+        except Exception as e:
+            self.__logger.warning(f'Unable to close connection: {e}')
+
+    def __wake_up_selector(self):
+        try:
+            self.__wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # The selector has plenty of wakeups pending already
+            pass
+
+    def __drain_wakeups(self):
+        try:
+            while self.__wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
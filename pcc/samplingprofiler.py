@@ -0,0 +1,68 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+# Profiles a running process by sampling the stacks of all of its threads at a fixed interval, so that a slow
+# receiver or controller can be profiled without restarting it. Sampling costs nothing while no profile is running.
+#
+# Profiles are returned in the "folded" format used by flame graph tools, one line per distinct stack with the
+# number of samples it was seen in:
+#   ReceiverStateService;threading.py:_bootstrap;...;receiverserver.py:__fetch_receiver_data;mixer.py:__cget 42
+# Each stack starts with the name of its thread. Render with e.g. https://github.com/brendangregg/FlameGraph:
+#   flamegraph.pl profile.folded > profile.svg
+# or load it into https://www.speedscope.app.
+#
+# Threads that are waiting, e.g. for a request or a lock, are sampled too: a profile shows where threads spend
+# their time, not only where they use the CPU.
+class SamplingProfiler:
+
+    MAX_DURATION_S = 60
+    MIN_INTERVAL_S = 0.001
+
+    # Only one profile runs at a time, per process
+    __lock = threading.Lock()
+
+    # Sample for duration_s seconds, every interval_s seconds. Blocks until done. Returns the profile in the folded
+    # format, or None if another profile is already running.
+    @staticmethod
+    def profile(duration_s = 10, interval_s = 0.01):
+        duration_s = min(float(duration_s), SamplingProfiler.MAX_DURATION_S)
+        interval_s = max(float(interval_s), SamplingProfiler.MIN_INTERVAL_S)
+        if not SamplingProfiler.__lock.acquire(blocking = False):
+            return None
+        try:
+            return SamplingProfiler.__sample(duration_s, interval_s)
+        finally:
+            SamplingProfiler.__lock.release()
+
+    @staticmethod
+    def __sample(duration_s, interval_s):
+        my_thread_id = threading.get_ident()
+        counts = collections.Counter()
+        frame_names = {}
+        deadline = time.monotonic() + duration_s
+        next_sample_at = time.monotonic()
+        while next_sample_at < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == my_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = frame_names.get(code)
+                    if name is None:
+                        name = f'{os.path.basename(code.co_filename)}:{code.co_name}'.replace(' ', '_').replace(';', ':')
+                        frame_names[code] = name
+                    stack.append(name)
+                    frame = frame.f_back
+                thread_name = thread_names.get(thread_id, str(thread_id)).replace(' ', '_').replace(';', ':')
+                stack.append(thread_name)
+                counts[';'.join(reversed(stack))] += 1
+
+            next_sample_at += interval_s
+            time.sleep(max(0, next_sample_at - time.monotonic()))
+
+        return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
@@ -0,0 +1,97 @@
+import threading
+import time
+
+# Lightweight timing of the steps of a request, e.g. reading the volume or serializing the response, reported to
+# clients in a Server-Timing header. See: https://www.w3.org/TR/server-timing/
+#
+# Spans are recorded by the thread that handles the request:
+#   with Spans.record() as spans:
+#       ...
+#       with Spans.span('get_vol_pct'):
+#           ...
+#   spans.to_server_timing()  # e.g. 'get_vol_pct;dur=3.1'
+#
+# Outside of Spans.record(), Spans.span() does nothing, so code may be instrumented without knowing whether
+# anyone is recording.
+class Spans:
+
+    __thread_local = threading.local()
+
+    # Returns a context manager that records the spans of the current thread into a new SpanRecorder, until it exits.
+    @staticmethod
+    def record():
+        return SpanRecordingContext(Spans.__thread_local)
+
+    # Returns a context manager that records a span named `name` if the current thread is recording.
+    # name: a token, as allowed in a Server-Timing header, e.g. 'get_vol_pct'
+    @staticmethod
+    def span(name):
+        recorder = getattr(Spans.__thread_local, 'recorder', None)
+        if recorder is None:
+            return NoopSpan()
+        return recorder.span(name)
+
+    # Add a span that was timed elsewhere, e.g. in another thread, if the current thread is recording.
+    @staticmethod
+    def add(name, duration_s):
+        recorder = getattr(Spans.__thread_local, 'recorder', None)
+        if recorder is not None:
+            recorder.add(name, duration_s)
+
+class SpanRecorder:
+
+    def __init__(self):
+        # A list of (name, duration_s) tuples, in the order the spans ended
+        self.__spans = []
+
+    def span(self, name):
+        return Span(self, name)
+
+    def add(self, name, duration_s):
+        self.__spans.append((name, duration_s))
+
+    def get_spans(self):
+        return list(self.__spans)
+
+    # Returns e.g. 'state;dur=0.1, json;dur=0.2', with durations in milliseconds.
+    def to_server_timing(self):
+        return ', '.join(f'{name};dur={round(duration_s * 1000, 1)}' for name, duration_s in self.__spans)
+
+# See Spans.record
+class SpanRecordingContext:
+
+    def __init__(self, thread_local):
+        self.__thread_local = thread_local
+
+    def __enter__(self):
+        self.__previous_recorder = getattr(self.__thread_local, 'recorder', None)
+        recorder = SpanRecorder()
+        self.__thread_local.recorder = recorder
+        return recorder
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__thread_local.recorder = self.__previous_recorder
+        return False
+
+class Span:
+
+    def __init__(self, recorder, name):
+        self.__recorder = recorder
+        self.__name = name
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__recorder.add(self.__name, time.perf_counter() - self.__start)
+        return False
+
+# Records nothing, see Spans.span
+class NoopSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
@@ -0,0 +1,239 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+
+from pcc.etag import ETag
+from pcc.inotify import Inotify
+from pcc.logger import Logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Holds the web app's static assets (the `app/build` directory) in memory, so that serving them doesn't touch the
+# disk. Each asset is precompressed with gzip, and with brotli if the `brotli` python module is installed, and has a
+# strong ETag per encoding, so that clients can revalidate their cached copy with If-None-Match.
+#
+# Files larger than __MAX_IN_MEMORY_SIZE are not held in memory uncompressed: they are sent from disk with
+# sendfile. Their compressed variants, if any, are still held in memory.
+#
+# The cache is loaded once at startup. If `watch` is True, it is reloaded whenever the directory changes, e.g.
+# after `npm run build`.
+class StaticAssetCache:
+
+    ENCODING_BROTLI = 'br'
+    ENCODING_GZIP = 'gzip'
+    ENCODING_IDENTITY = 'identity'
+
+    # create-react-app puts the bundles, css and media, whose file names contain a hash of their contents, in
+    # the `static` directory. Their contents never change, so clients may cache them forever. Other files, e.g.
+    # index.html, must be revalidated on every use.
+    __HASHED_ASSETS_PREFIX = '/static/'
+    __HASHED_ASSETS_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    __CACHE_CONTROL = 'no-cache'
+
+    __MAX_IN_MEMORY_SIZE = 256 * 1024
+
+    # Only bother compressing text based formats: images and fonts like woff2 are already compressed.
+    __COMPRESSIBLE_CONTENT_TYPES = (
+        'text/', 'application/javascript', 'application/json', 'application/manifest+json', 'image/svg+xml',
+        'application/vnd.ms-fontobject', 'font/ttf', 'font/otf', 'application/x-font-ttf',
+    )
+    __CONTENT_TYPES = {
+        '.js': 'text/javascript',
+        '.mjs': 'text/javascript',
+        '.css': 'text/css',
+        '.html': 'text/html',
+        '.json': 'application/json',
+        '.map': 'application/json',
+        '.svg': 'image/svg+xml',
+        '.svgz': 'image/svg+xml',
+        '.woff': 'font/woff',
+        '.woff2': 'font/woff2',
+        '.ttf': 'font/ttf',
+        '.eot': 'application/vnd.ms-fontobject',
+        '.ico': 'image/x-icon',
+    }
+
+    # After a change to the directory, wait until it has been quiet for this long before reloading, so that we
+    # reload once per build rather than once per file.
+    __WATCH_DEBOUNCE_S = 1
+
+    # If the directory can't be watched (e.g. because it doesn't exist yet), try again after this long.
+    __WATCH_RETRY_INTERVAL_S = 10
+
+    def __init__(self, root_dir, watch = False):
+        self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__root_dir = root_dir
+        self.__assets = {}
+        self.reload()
+        if watch:
+            threading.Thread(target = self.__watch, name = 'StaticAssetWatcher', daemon = True).start()
+
+    # Returns the StaticAsset for the URL path, or None if there is no such asset.
+    def get(self, path):
+        if path == '/':
+            path = '/index.html'
+        return self.__assets.get(path)
+
+    # (Re)load all assets from disk. Requests are served from the old assets until the new ones are loaded.
+    def reload(self):
+        start = time.monotonic()
+        assets = {}
+        for dir_path, dir_names, file_names in os.walk(self.__root_dir):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                path = '/' + os.path.relpath(file_path, self.__root_dir).replace(os.sep, '/')
+                try:
+                    assets[path] = self.__load_asset(path, file_path)
+                except OSError as e:
+                    # The file may have been deleted while we were loading it, e.g. by a build in progress. We'll
+                    # reload again once the build is done if we're watching the directory.
+                    self.__logger.warning(f'Unable to load static asset {file_path}: {e}')
+
+        self.__assets = assets
+        self.__logger.info(
+            f'Loaded {len(assets)} static assets from {self.__root_dir} in {round(time.monotonic() - start, 3)}s.'
+        )
+
+    def __load_asset(self, path, file_path):
+        with open(file_path, 'rb') as file:
+            content = file.read()
+            mtime_ns = os.fstat(file.fileno()).st_mtime_ns
+
+        content_type = self.__get_content_type(path)
+        etag = hashlib.sha256(content).hexdigest()[:32]
+        variants = {}
+        if content_type.startswith(self.__COMPRESSIBLE_CONTENT_TYPES):
+            compressed = {self.ENCODING_GZIP: gzip.compress(content, compresslevel = 9, mtime = 0)}
+            if brotli is not None:
+                compressed[self.ENCODING_BROTLI] = brotli.compress(content)
+            for encoding, body in compressed.items():
+                if len(body) < len(content):
+                    # Each encoding of the asset is a different representation, so it needs its own ETag.
+                    variants[encoding] = StaticAssetVariant(encoding, f'"{etag}-{encoding}"', body = body)
+
+        if len(content) > self.__MAX_IN_MEMORY_SIZE:
+            variants[self.ENCODING_IDENTITY] = StaticAssetVariant(
+                self.ENCODING_IDENTITY, f'"{etag}"', file_path = file_path, size = len(content),
+                mtime_ns = mtime_ns
+            )
+        else:
+            variants[self.ENCODING_IDENTITY] = StaticAssetVariant(self.ENCODING_IDENTITY, f'"{etag}"', body = content)
+
+        if path.startswith(self.__HASHED_ASSETS_PREFIX):
+            cache_control = self.__HASHED_ASSETS_CACHE_CONTROL
+        else:
+            cache_control = self.__CACHE_CONTROL
+        return StaticAsset(content_type, cache_control, variants)
+
+    def __get_content_type(self, path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension in self.__CONTENT_TYPES:
+            return self.__CONTENT_TYPES[extension]
+        content_type, encoding = mimetypes.guess_type(path)
+        return content_type or 'application/octet-stream'
+
+    def __watch(self):
+        is_first_watch = True
+        while True:
+            inotify = None
+            try:
+                inotify = Inotify()
+                self.__watch_dirs(inotify)
+                if not is_first_watch:
+                    # We may have missed changes while we weren't watching
+                    self.reload()
+                while True:
+                    events = inotify.read_events()
+
+                    # Wait for the changes to settle
+                    while events:
+                        events = inotify.read_events(timeout_s = self.__WATCH_DEBOUNCE_S)
+
+                    # Directories may have been created or deleted: start over with fresh watches
+                    inotify.close()
+                    inotify = Inotify()
+                    self.__watch_dirs(inotify)
+                    self.reload()
+            except Exception as e:
+                self.__logger.warning(f'Error while watching {self.__root_dir} for changes: {e}')
+            finally:
+                is_first_watch = False
+                if inotify is not None:
+                    inotify.close()
+            time.sleep(self.__WATCH_RETRY_INTERVAL_S)
+
+    def __watch_dirs(self, inotify):
+        for dir_path, dir_names, file_names in os.walk(self.__root_dir):
+            inotify.add_watch(dir_path, Inotify.IN_CHANGES | Inotify.IN_ONLYDIR)
+        if not os.path.isdir(self.__root_dir):
+            raise Exception(f'{self.__root_dir} is not a directory.')
+
+# A static asset, see StaticAssetCache
+class StaticAsset:
+
+    def __init__(self, content_type, cache_control, variants):
+        self.content_type = content_type
+        self.cache_control = cache_control
+
+        # Whether the asset has compressed variants, in which case the response depends on Accept-Encoding
+        self.is_compressed = len(variants) > 1
+        self.__variants = variants
+
+    # Returns the StaticAssetVariant to send to a client that sent the given Accept-Encoding header. Prefers
+    # brotli, then gzip.
+    def get_variant(self, accept_encoding):
+        accepted_encodings = set()
+        for coding in (accept_encoding or '').split(','):
+            name, _, params = coding.strip().partition(';')
+            q = params.strip()
+            try:
+                if q.startswith('q=') and float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+            accepted_encodings.add(name.strip().lower())
+
+        for encoding in (StaticAssetCache.ENCODING_BROTLI, StaticAssetCache.ENCODING_GZIP):
+            if encoding in self.__variants and (encoding in accepted_encodings or '*' in accepted_encodings):
+                return self.__variants[encoding]
+        return self.__variants[StaticAssetCache.ENCODING_IDENTITY]
+
+# One encoding of a static asset. Its content is either held in memory (`body`), or is to be sent from disk
+# (`file_path`).
+class StaticAssetVariant:
+
+    def __init__(self, encoding, etag, body = None, file_path = None, size = None, mtime_ns = None):
+        self.encoding = encoding
+        self.etag = etag
+        self.body = body
+        self.file_path = file_path
+        self.size = len(body) if body is not None else size
+        self.__mtime_ns = mtime_ns
+
+    # For a variant sent from disk: opens its file. Returns None if the file has been deleted or changed since it
+    # was loaded, since its size and ETag would no longer match what it contains.
+    def open_file(self):
+        try:
+            file = open(self.file_path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            stat = os.fstat(file.fileno())
+        except OSError:
+            file.close()
+            raise
+        if stat.st_size != self.size or stat.st_mtime_ns != self.__mtime_ns:
+            file.close()
+            return None
+        return file
+
+    # Whether a client's cached copy, identified by the If-None-Match header it sent, is still current. Uses weak
+    # comparison, as required for If-None-Match.
+    def matches(self, if_none_match):
+        return ETag.matches(if_none_match, self.etag)
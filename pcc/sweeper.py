@@ -1,9 +1,11 @@
-import os.path
-import subprocess
+import errno
+import fcntl
+import os
 import time
-from pcc.directoryutils import DirectoryUtils
+from pcc.btdiscoverablejob import BtDiscoverableJob
+from pcc.dbusclient import DbusClient
+from pcc.inotify import Inotify
 from pcc.logger import Logger
-from pcc.receiverserver import ReceiverAPI
 
 # If bluetooth has been discoverable for over __BT_DISCOVERABLE_TIMEOUT_S seconds, make it undiscoverable
 # to prevent neighbors from accidentally connecting.
@@ -15,29 +17,108 @@ from pcc.receiverserver import ReceiverAPI
 # When we tried using DiscoverableTimeout, the bluetooth server remained discoverable forever, despite
 # dbus returning "False" for the Discoverable setting. However, when we explicitly set the server
 # to undiscoverable, the server goes undiscoverable as intended.
+#
+# The sweeper watches the directory of the success file with inotify, so that it sleeps until bluetooth is made
+# discoverable, and then until exactly when the timeout expires.
 class Sweeper():
 
     # How long to leave bluetooth as discoverable.
     BT_DISCOVERABLE_TIMEOUT_S = 60
 
+    # If the lock is held, e.g. because the ReceiverAPI is making bluetooth discoverable again, try again after
+    # this long.
+    __LOCK_RETRY_INTERVAL_S = 1
+
+    # If inotify can't be set up, fall back to checking the success file this often.
+    __POLL_INTERVAL_S = 5
+
+    __SUCCESS_FILE_EVENTS = (Inotify.IN_CREATE | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO |
+        Inotify.IN_MOVED_FROM | Inotify.IN_DELETE)
+
     def __init__(self):
         self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__dbus_client = DbusClient()
 
     def run(self):
         while True:
-            if not os.path.isfile(ReceiverAPI.BT_DISCOVERABLE_SUCCESS_FILE):
-                time.sleep(5)
-                continue
-
-            cmd = DirectoryUtils().root_dir + '/utils/sweeper_bt_cleanup.py'
-            proc = subprocess.Popen(
-                (f"flock --exclusive --nonblock {ReceiverAPI.BT_DISCOVERABLE_LOCK_FILE} --command '{cmd}'"),
-                shell = True, executable = '/bin/bash'
-            )
-
-            while proc.poll() is None:
-                time.sleep(0.1)
-            if proc.returncode != 0:
-                self.__logger.error(f'The sweeper_bt_cleanup script exited non-zero: {proc.returncode}.')
-
-            time.sleep(5)
+            inotify = None
+            try:
+                inotify = Inotify()
+                inotify.add_watch(
+                    os.path.dirname(BtDiscoverableJob.SUCCESS_FILE),
+                    self.__SUCCESS_FILE_EVENTS | Inotify.IN_ONLYDIR
+                )
+                success_file_name = os.path.basename(BtDiscoverableJob.SUCCESS_FILE)
+                while True:
+                    timeout_s = self.__sweep()
+                    deadline = None if timeout_s is None else time.monotonic() + timeout_s
+                    # Other files in the directory may change too, e.g. the lock file whenever we close it. Waking up
+                    # for them is harmless: we just wait for whatever is left until the deadline.
+                    while True:
+                        if deadline is not None:
+                            timeout_s = max(0, deadline - time.monotonic())
+                        events = inotify.read_events(timeout_s = timeout_s)
+                        if not events or any(name == success_file_name for wd, mask, cookie, name in events):
+                            break
+                        if deadline is not None and time.monotonic() >= deadline:
+                            break
+            except Exception as e:
+                self.__logger.error(f'Error while watching {BtDiscoverableJob.SUCCESS_FILE}: {e}. ' +
+                    f'Checking it every {self.__POLL_INTERVAL_S} seconds instead.')
+                if inotify is not None:
+                    inotify.close()
+                    inotify = None
+                self.__poll()
+
+    # Make bluetooth undiscoverable if it has been discoverable for over BT_DISCOVERABLE_TIMEOUT_S seconds. Returns
+    # how long to wait before checking again, or None if bluetooth is not discoverable.
+    def make_bt_undiscoverable_if_expired(self):
+        lock_fd = os.open(BtDiscoverableJob.LOCK_FILE, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                self.__logger.info('The bluetooth discoverable lock is held. Trying again later...')
+                return self.__LOCK_RETRY_INTERVAL_S
+
+            # Now that we hold the lock, the success file can't change under us
+            remaining_s = self.__get_remaining_discoverable_s()
+            if remaining_s is None or remaining_s > 0:
+                return remaining_s
+
+            self.__logger.info(f"Bluetooth has been discoverable for over {self.BT_DISCOVERABLE_TIMEOUT_S} " +
+                "seconds. Setting it to undiscoverable...")
+            self.__dbus_client.set_bluetooth_discoverable(False, throw = True)
+            os.remove(BtDiscoverableJob.SUCCESS_FILE)
+            self.__logger.info("Successfully completed making bluetooth undiscoverable.")
+            return None
+        finally:
+            # Closing the file releases the lock
+            os.close(lock_fd)
+
+    # Returns how many seconds bluetooth has left to be discoverable, or None if it isn't discoverable.
+    def __get_remaining_discoverable_s(self):
+        try:
+            mtime = os.path.getmtime(BtDiscoverableJob.SUCCESS_FILE)
+        except FileNotFoundError:
+            return None
+        return max(0, mtime + self.BT_DISCOVERABLE_TIMEOUT_S - time.time())
+
+    # Returns how long to wait before sweeping again, or None to wait until the success file changes.
+    def __sweep(self):
+        remaining_s = self.__get_remaining_discoverable_s()
+        if remaining_s is None or remaining_s > 0:
+            return remaining_s
+        try:
+            return self.make_bt_undiscoverable_if_expired()
+        except Exception as e:
+            self.__logger.error(f'Unable to make bluetooth undiscoverable: {e}')
+            return self.__POLL_INTERVAL_S
+
+    def __poll(self):
+        timeout_s = self.__sweep()
+        if timeout_s is None:
+            timeout_s = self.__POLL_INTERVAL_S
+        time.sleep(min(timeout_s, self.__POLL_INTERVAL_S))
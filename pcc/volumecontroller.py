@@ -1,21 +1,41 @@
-import subprocess
-import re
 import math
+import threading
+import time
 
 from pcc.config import Config
 from pcc.dbusclient import DbusClient
 from pcc.logger import Logger
+from pcc.mixer import Mixer
 
-# Gets and sets alsa volume
+# Gets and sets alsa volume, via the process's mixer engine (see Mixer)
 class VolumeController:
 
     __GLOBAL_MIN_VOL_VAL = None
     __GLOBAL_MAX_VOL_VAL = None
 
+    # These are read several times per volume read and write, so bind them once, see Config.bind
+    __ADJUST_VOLUME_LOGARITHMICALLY = Config.bind('sound.adjust_volume_logarithmically')
+    __LIMITED_MAX_VOL_VAL = Config.bind('sound.limited_max_vol_val')
+    __SOUND_CARD = Config.bind('sound.card', 0)
+    __SOUND_NUMID = Config.bind('sound.numid', 1)
+    __VOL_RESYNC_INTERVAL_S = Config.bind('sound.vol_resync_interval_s', 10, float)
+
+    # If watching for mixer events fails, wait this long before trying again.
+    __WATCH_VOL_CHANGES_RETRY_INTERVAL_S = 5
+
     def __init__(self):
         self.__logger = Logger().set_namespace(self.__class__.__name__)
         self.__dbus_client = DbusClient()
 
+        # See watch_vol_changes. The cached volume value is only used while we are watching for changes, and is
+        # None if it hasn't been read yet.
+        self.__lock = threading.Lock()
+        self.__is_watch_started = False
+        self.__is_watching = False
+        self.__cached_vol_val = None
+        self.__on_change_callbacks = []
+        Config.subscribe(self.__on_config_change)
+
     # gets a perceptual loudness %
     # returns a float in the range [0, 100]
     def get_vol_pct(self):
@@ -42,6 +62,12 @@ class VolumeController:
     # takes a perceptual loudness %.
     # vol_pct should be a float in the range [0, 100]
     def set_vol_pct(self, vol_pct):
+        self.set_vol_val(self.vol_pct_to_vol_val(vol_pct))
+
+    # takes a perceptual loudness %.
+    # vol_pct should be a float in the range [0, 100]
+    # Returns the integer volume value that set_vol_pct would set for it.
+    def vol_pct_to_vol_val(self, vol_pct):
         vol_pct = max(0, vol_pct)
         vol_pct = min(100, vol_pct)
 
@@ -53,10 +79,16 @@ class VolumeController:
         else:
             vol_val = vol_pct * VolumeController.__get_limited_max_vol_val() / 100
 
-        vol_val = round(vol_val)
-        subprocess.check_output(
-            ('amixer', '-c', str(Config.get('sound.card', 0)), 'cset', f'numid={Config.get("sound.numid", 1)}', '--', str(vol_val))
-        )
+        return round(vol_val)
+
+    # Set the volume value, as returned by vol_pct_to_vol_val.
+    def set_vol_val(self, vol_val):
+        Mixer.get_engine().set_vol_val(vol_val)
+
+        # Alsa may round the value we set. If it does, the mixer event for our write will correct the cache.
+        with self.__lock:
+            if self.__is_watching:
+                self.__cached_vol_val = vol_val
 
     # Send new volume value from airplay server to airplay client.
     # See: https://github.com/mikebrady/shairport-sync/blob/12ad72c47fe7bb04e7250892c324ac5f5faa4071/documents/sample%20dbus%20commands#L86C1-L87
@@ -78,6 +110,80 @@ class VolumeController:
         self.set_vol_pct(new_vol_pct)
         return new_vol_pct
 
+    # Keep the current volume in memory, kept up to date by watching the mixer control for changes, including
+    # changes made outside of pcc, e.g. by shairport-sync or alsamixer. Reads of the volume are then served from
+    # memory. As a safety net in case an event is missed, the volume is also re-read every
+    # `sound.vol_resync_interval_s` seconds.
+    #
+    # on_change: optional function to call, with no arguments, whenever the volume changes.
+    def watch_vol_changes(self, on_change = None):
+        with self.__lock:
+            if on_change is not None:
+                self.__on_change_callbacks.append(on_change)
+            if self.__is_watch_started:
+                return
+            self.__is_watch_started = True
+
+        threading.Thread(target = self.__watch_vol_changes, name = 'MixerEventsWatcher', daemon = True).start()
+        threading.Thread(target = self.__resync_vol_val, name = 'MixerResync', daemon = True).start()
+
+    def __watch_vol_changes(self):
+        while True:
+            # Re-read the volume on the next read: we may have missed changes while we weren't watching
+            self.__set_is_watching(True)
+            engine = Mixer.get_engine()
+            try:
+                engine.wait_for_vol_changes(self.__on_mixer_event)
+            except Exception as e:
+                self.__logger.warning(f'Error while watching for mixer events: {e}')
+            self.__set_is_watching(False)
+
+            # If the engine was replaced, e.g. because the sound card changed, watch the new one right away.
+            if Mixer.get_engine() is engine:
+                time.sleep(self.__WATCH_VOL_CHANGES_RETRY_INTERVAL_S)
+
+    def __resync_vol_val(self):
+        while True:
+            time.sleep(VolumeController.__VOL_RESYNC_INTERVAL_S())
+            self.__on_mixer_event()
+
+    # Re-read the volume and notify our callbacks if it changed.
+    def __on_mixer_event(self):
+        try:
+            vol_val = Mixer.get_engine().get_vol_val()
+        except Exception as e:
+            self.__logger.warning(f'Unable to read volume after mixer event: {e}')
+            return
+
+        with self.__lock:
+            if not self.__is_watching:
+                return
+            old_vol_val = self.__cached_vol_val
+            self.__cached_vol_val = vol_val
+            callbacks = list(self.__on_change_callbacks)
+
+        if vol_val != old_vol_val:
+            for on_change in callbacks:
+                on_change()
+
+    # If the sound config changed, e.g. we were pointed at a different soundcard, the volume range and the volume
+    # may be different now. We may be notified of the change before the Mixer is: make sure we read them from the
+    # new mixer engine.
+    def __on_config_change(self, changed_keys):
+        if 'sound' not in changed_keys:
+            return
+        Mixer.reload_engine_if_config_changed()
+        VolumeController.__GLOBAL_MIN_VOL_VAL = None
+        VolumeController.__GLOBAL_MAX_VOL_VAL = None
+        with self.__lock:
+            self.__cached_vol_val = None
+        self.__on_mixer_event()
+
+    def __set_is_watching(self, is_watching):
+        with self.__lock:
+            self.__is_watching = is_watching
+            self.__cached_vol_val = None
+
     @staticmethod
     def __get_global_min_vol_val():
         if VolumeController.__GLOBAL_MIN_VOL_VAL is not None:
@@ -96,25 +202,22 @@ class VolumeController:
 
     @staticmethod
     def __init_global_min_and_max_vol_vals():
-        res = subprocess.check_output(
-            ('amixer', '-c', str(Config.get('sound.card', 0)), 'cget', f'numid={Config.get("sound.numid", 1)}'),
-        ).decode("utf-8")
-        m = re.search(r",min=(-?\d+),max=(-?\d+)", res, re.MULTILINE)
+        vol_range = Mixer.get_engine().get_vol_range()
 
-        if m is None:
+        if vol_range is None:
             # use the defaults for the raspberry pi built in headphone jack:
             # amixer output: ; type=INTEGER,access=rw---R--,values=1,min=-10239,max=400,step=0
             # These values are in millibels.
             VolumeController.__GLOBAL_MIN_VOL_VAL = -10239
             VolumeController.__GLOBAL_MAX_VOL_VAL = 400
         else:
-            VolumeController.__GLOBAL_MIN_VOL_VAL = int(m.group(1))
-            VolumeController.__GLOBAL_MAX_VOL_VAL = int(m.group(2))
+            VolumeController.__GLOBAL_MIN_VOL_VAL, VolumeController.__GLOBAL_MAX_VOL_VAL = vol_range
 
     @staticmethod
     def __should_adjust_volume_logarithmically():
-        if Config.get('sound.adjust_volume_logarithmically') is not None:
-            return Config.get('sound.adjust_volume_logarithmically')
+        adjust_volume_logarithmically = VolumeController.__ADJUST_VOLUME_LOGARITHMICALLY()
+        if adjust_volume_logarithmically is not None:
+            return adjust_volume_logarithmically
 
         if VolumeController.__is_internal_soundcard_being_used():
             # Assume we're using the raspberry pi internal soundcard's headphone jack
@@ -124,8 +227,9 @@ class VolumeController:
 
     @staticmethod
     def __get_limited_max_vol_val():
-        if Config.get('sound.limited_max_vol_val') is not None:
-            return Config.get('sound.limited_max_vol_val')
+        limited_max_vol_val = VolumeController.__LIMITED_MAX_VOL_VAL()
+        if limited_max_vol_val is not None:
+            return limited_max_vol_val
 
         if VolumeController.__is_internal_soundcard_being_used():
             # Assume we're using the raspberry pi internal soundcard's headphone jack
@@ -137,19 +241,23 @@ class VolumeController:
     # Attempt to autodetect if the default soundcard is being used, based on config.json values.
     @staticmethod
     def __is_internal_soundcard_being_used():
-        return Config.get('sound.card', 0) == 0 and Config.get('sound.numid', 1) == 1
+        return VolumeController.__SOUND_CARD() == 0 and VolumeController.__SOUND_NUMID() == 1
 
     # Return volume value. Returns an integer in the range
     # [VolumeController.__get_global_min_vol_val(), VolumeController.__get_limited_max_vol_val()]
+    # Served from memory if we are watching for volume changes, see watch_vol_changes.
     def get_vol_val(self):
-        res = subprocess.check_output(
-            ('amixer', '-c', str(Config.get('sound.card', 0)), 'cget', f'numid={Config.get("sound.numid", 1)}')
-        ).decode("utf-8")
-        m = re.search(r" values=(-?\d+)", res, re.MULTILINE)
-        if m is None:
+        with self.__lock:
+            vol_val = self.__cached_vol_val
+        if vol_val is None:
+            vol_val = Mixer.get_engine().get_vol_val()
+            with self.__lock:
+                if self.__is_watching and self.__cached_vol_val is None:
+                    self.__cached_vol_val = vol_val
+
+        if vol_val is None:
             return VolumeController.__get_global_min_vol_val()
 
-        vol_val = int(m.group(1))
         vol_val = max(VolumeController.__get_global_min_vol_val(), vol_val)
         vol_val = min(VolumeController.__get_limited_max_vol_val(), vol_val)
         return vol_val
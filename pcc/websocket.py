@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import struct
+import threading
+
+# A minimal server side implementation of the WebSocket protocol: enough to exchange small text messages with the
+# web app over a persistent, ordered connection. Messages may be sent from any thread.
+# See: https://datatracker.ietf.org/doc/html/rfc6455
+class WebSocket:
+
+    OPCODE_CONTINUATION = 0x0
+    OPCODE_TEXT = 0x1
+    OPCODE_BINARY = 0x2
+    OPCODE_CLOSE = 0x8
+    OPCODE_PING = 0x9
+    OPCODE_PONG = 0xA
+
+    CLOSE_NORMAL = 1000
+    CLOSE_MESSAGE_TOO_BIG = 1009
+
+    # Larger messages are rejected. Our messages are tiny.
+    MAX_MESSAGE_SIZE = 64 * 1024
+
+    __GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+    # rfile, wfile: file-like objects to read from and write to the connection, after the opening handshake has
+    # been completed.
+    def __init__(self, rfile, wfile):
+        self.__rfile = rfile
+        self.__wfile = wfile
+        self.__write_lock = threading.Lock()
+
+    # Returns the value of the Sec-WebSocket-Accept header to send in response to the client's handshake, given
+    # the value of its Sec-WebSocket-Key header.
+    @staticmethod
+    def make_accept_key(key):
+        return base64.b64encode(hashlib.sha1((key + WebSocket.__GUID).encode('utf-8')).digest()).decode('utf-8')
+
+    # Returns the next message from the client as a string, or None if the connection was closed.
+    def receive(self):
+        message = b''
+        while True:
+            frame = self.__read_frame()
+            if frame is None:
+                return None
+
+            is_final, opcode, payload = frame
+            if opcode == self.OPCODE_PING:
+                self.__write_frame(self.OPCODE_PONG, payload)
+                continue
+            elif opcode == self.OPCODE_PONG:
+                continue
+            elif opcode == self.OPCODE_CLOSE:
+                # Echo the status code back, completing the closing handshake
+                self.__write_frame(self.OPCODE_CLOSE, payload[:2])
+                return None
+
+            message += payload
+            if len(message) > self.MAX_MESSAGE_SIZE:
+                self.close(self.CLOSE_MESSAGE_TOO_BIG)
+                return None
+            if is_final:
+                return message.decode('utf-8')
+
+    def send(self, message):
+        self.__write_frame(self.OPCODE_TEXT, message.encode('utf-8'))
+
+    def close(self, code = CLOSE_NORMAL):
+        self.__write_frame(self.OPCODE_CLOSE, struct.pack('!H', code))
+
+    # Returns a tuple of (is_final, opcode, payload), or None if the connection was closed.
+    def __read_frame(self):
+        header = self.__read_exactly(2)
+        if header is None:
+            return None
+
+        is_final = bool(header[0] & 0x80)
+        opcode = header[0] & 0x0F
+        is_masked = bool(header[1] & 0x80)
+        length = header[1] & 0x7F
+        if length == 126:
+            length, = struct.unpack('!H', self.__read_exactly(2) or b'\0\0')
+        elif length == 127:
+            length, = struct.unpack('!Q', self.__read_exactly(8) or b'\0' * 8)
+        if length > self.MAX_MESSAGE_SIZE:
+            self.close(self.CLOSE_MESSAGE_TOO_BIG)
+            return None
+
+        mask = self.__read_exactly(4) if is_masked else None
+        payload = self.__read_exactly(length)
+        if payload is None or (is_masked and mask is None):
+            return None
+
+        # Frames from the client are masked: XOR the payload with the repeated 4 byte mask.
+        if is_masked and length:
+            repeated_mask = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated_mask, 'big')).to_bytes(length, 'big')
+        return is_final, opcode, payload
+
+    def __read_exactly(self, num_bytes):
+        data = self.__rfile.read(num_bytes)
+        if len(data) < num_bytes:
+            return None
+        return data
+
+    # Frames from the server are not masked.
+    def __write_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < (1 << 16):
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.__write_lock:
+            self.__wfile.write(header + payload)
+            self.__wfile.flush()
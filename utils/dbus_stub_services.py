@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Stand-ins for the shairport-sync and BlueZ D-Bus services, for exercising DbusClient without a real pi.
+#
+# Usage:
+#   ./utils/dbus_stub_services.py --launch-daemon
+#
+# This starts a private dbus-daemon, prints its address, and serves stub org.gnome.ShairportSync and org.bluez
+# objects on it. Point pcc at it by exporting the printed address before starting e.g. the receiver:
+#   DBUS_SYSTEM_BUS_ADDRESS=unix:path=/tmp/... ./bin/receiver
+#
+# Properties may be changed from outside to simulate e.g. a new AirPlay client connecting, which emits a
+# PropertiesChanged signal like the real services do:
+#   dbus-send --system --print-reply --dest=org.gnome.ShairportSync /org/gnome/ShairportSync \
+#       org.freedesktop.DBus.Properties.Set string:org.gnome.ShairportSync.RemoteControl string:PlayerState \
+#       variant:string:Paused
+#
+# A connected bluetooth device is served too, which may be disconnected via org.bluez.Device1.Disconnect, and
+# listed via org.freedesktop.DBus.ObjectManager.GetManagedObjects.
+#
+# Requires the `jeepney` python module.
+import argparse
+import os
+import subprocess
+import sys
+
+from jeepney import DBusAddress, HeaderFields, MessageType, new_error, new_method_return, new_signal
+from jeepney.bus_messages import message_bus
+from jeepney.io.blocking import open_dbus_connection
+
+# This is necessary for the import below to work
+root_dir = os.path.abspath(os.path.dirname(__file__) + '/..')
+sys.path.append(root_dir)
+
+from pcc.dbusclient import DbusClient
+from pcc.logger import Logger
+
+class DbusStubServices:
+
+    __PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+    __OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
+    __BT_DEVICE_OBJECT_PATH = DbusClient.BLUEZ_ADAPTER_OBJECT_PATH + '/dev_AA_BB_CC_DD_EE_FF'
+
+    def __init__(self, bus_address, client_name, player_state, bt_device_name):
+        self.__logger = Logger().set_namespace(self.__class__.__name__)
+        self.__conn = open_dbus_connection(bus = bus_address)
+
+        # object path -> interface -> property name -> (signature, value)
+        self.__objects = {
+            DbusClient.SPS_OBJECT_PATH: {
+                DbusClient.SPS_REMOTE_CONTROL_INTERFACE: {
+                    'Available': ('b', True),
+                    'ClientName': ('s', client_name),
+                    'PlayerState': ('s', player_state),
+                    'AirplayVolume': ('d', -15.0),
+                    'Server': ('s', '192.168.1.2'),
+                    'Metadata': ('a{sv}', {
+                        'xesam:title': ('s', 'Strawberry Letter 23'),
+                        'xesam:artist': ('as', ['The Brothers Johnson']),
+                    }),
+                },
+            },
+            DbusClient.BLUEZ_ADAPTER_OBJECT_PATH: {
+                DbusClient.BLUEZ_ADAPTER_INTERFACE: {
+                    'Address': ('s', '00:00:00:00:00:00'),
+                    'Alias': ('s', 'pcc-stub'),
+                    'Powered': ('b', True),
+                    'Discoverable': ('b', False),
+                },
+            },
+            self.__BT_DEVICE_OBJECT_PATH: {
+                DbusClient.BLUEZ_DEVICE_INTERFACE: {
+                    'Address': ('s', 'AA:BB:CC:DD:EE:FF'),
+                    'Name': ('s', bt_device_name),
+                    'Alias': ('s', bt_device_name),
+                    'Connected': ('b', True),
+                },
+            },
+        }
+
+        # (object path, interface, method) -> handler. Handlers take the message and return a reply message.
+        self.__methods = {
+            (DbusClient.SPS_OBJECT_PATH, DbusClient.SPS_REMOTE_CONTROL_INTERFACE, 'SetAirplayVolume'):
+                self.__set_airplay_volume,
+            (DbusClient.SPS_OBJECT_PATH, DbusClient.SPS_INTERFACE, 'DropSession'): self.__drop_session,
+            (self.__BT_DEVICE_OBJECT_PATH, DbusClient.BLUEZ_DEVICE_INTERFACE, 'Disconnect'): self.__disconnect_device,
+            ('/', self.__OBJECT_MANAGER_INTERFACE, 'GetManagedObjects'): self.__get_managed_objects,
+        }
+        for path in self.__objects:
+            self.__methods[(path, self.__PROPERTIES_INTERFACE, 'Get')] = self.__get_property
+            self.__methods[(path, self.__PROPERTIES_INTERFACE, 'GetAll')] = self.__get_all_properties
+            self.__methods[(path, self.__PROPERTIES_INTERFACE, 'Set')] = self.__set_property
+
+    def serve_forever(self):
+        for name in (DbusClient.SPS_BUS_NAME, DbusClient.BLUEZ_BUS_NAME):
+            self.__conn.send_and_get_reply(message_bus.RequestName(name))
+        self.__logger.info(f'Serving stub {DbusClient.SPS_BUS_NAME} and {DbusClient.BLUEZ_BUS_NAME} services...')
+
+        while True:
+            msg = self.__conn.receive()
+            if msg.header.message_type != MessageType.method_call:
+                continue
+
+            fields = msg.header.fields
+            key = (fields.get(HeaderFields.path), fields.get(HeaderFields.interface), fields.get(HeaderFields.member))
+            handler = self.__methods.get(key)
+            if handler is None:
+                reply = new_error(msg, 'org.freedesktop.DBus.Error.UnknownMethod', 's', (f'Unknown method: {key}',))
+            else:
+                try:
+                    reply = handler(msg)
+                except KeyError as e:
+                    reply = new_error(msg, 'org.freedesktop.DBus.Error.InvalidArgs', 's', (f'Unknown property: {e}',))
+            self.__conn.send(reply)
+
+    def __get_property(self, msg):
+        interface, prop = msg.body
+        return new_method_return(msg, 'v', (self.__get_interface(msg, interface)[prop],))
+
+    def __get_all_properties(self, msg):
+        interface, = msg.body
+        return new_method_return(msg, 'a{sv}', (dict(self.__get_interface(msg, interface)),))
+
+    def __set_property(self, msg):
+        interface, prop, value = msg.body
+        self.__logger.info(f'Setting {interface}.{prop}: {value[1]}.')
+        self.__get_interface(msg, interface)[prop] = value
+        self.__emit_properties_changed(msg.header.fields[HeaderFields.path], interface, {prop: value})
+        return new_method_return(msg)
+
+    def __set_airplay_volume(self, msg):
+        vol, = msg.body
+        self.__logger.info(f'Setting airplay volume: {vol}.')
+        self.__objects[DbusClient.SPS_OBJECT_PATH][DbusClient.SPS_REMOTE_CONTROL_INTERFACE]['AirplayVolume'] = ('d', vol)
+        self.__emit_properties_changed(
+            DbusClient.SPS_OBJECT_PATH, DbusClient.SPS_REMOTE_CONTROL_INTERFACE, {'AirplayVolume': ('d', vol)}
+        )
+        return new_method_return(msg)
+
+    def __drop_session(self, msg):
+        self.__logger.info('Dropping AirPlay session.')
+        changed_properties = {'ClientName': ('s', ''), 'PlayerState': ('s', 'Stopped')}
+        self.__objects[DbusClient.SPS_OBJECT_PATH][DbusClient.SPS_REMOTE_CONTROL_INTERFACE].update(changed_properties)
+        self.__emit_properties_changed(
+            DbusClient.SPS_OBJECT_PATH, DbusClient.SPS_REMOTE_CONTROL_INTERFACE, changed_properties
+        )
+        return new_method_return(msg)
+
+    def __disconnect_device(self, msg):
+        path = msg.header.fields[HeaderFields.path]
+        self.__logger.info(f'Disconnecting bluetooth device {path}.')
+        self.__objects[path][DbusClient.BLUEZ_DEVICE_INTERFACE]['Connected'] = ('b', False)
+        self.__emit_properties_changed(path, DbusClient.BLUEZ_DEVICE_INTERFACE, {'Connected': ('b', False)})
+        return new_method_return(msg)
+
+    def __get_managed_objects(self, msg):
+        bluez_objects = {
+            path: interfaces for path, interfaces in self.__objects.items()
+            if path.startswith(DbusClient.BLUEZ_ADAPTER_OBJECT_PATH)
+        }
+        return new_method_return(msg, 'a{oa{sa{sv}}}', (bluez_objects,))
+
+    def __emit_properties_changed(self, path, interface, changed_properties):
+        emitter = DBusAddress(path, interface = self.__PROPERTIES_INTERFACE)
+        self.__conn.send(new_signal(emitter, 'PropertiesChanged', 'sa{sv}as', (interface, changed_properties, [])))
+
+    def __get_interface(self, msg, interface):
+        return self.__objects[msg.header.fields[HeaderFields.path]][interface]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = 'Serve stub shairport-sync and BlueZ D-Bus services.')
+    parser.add_argument('--bus-address', dest = 'bus_address', default = None,
+        help = 'Address of the bus to serve on. Defaults to $DBUS_SYSTEM_BUS_ADDRESS.')
+    parser.add_argument('--launch-daemon', dest = 'launch_daemon', action = 'store_true',
+        help = 'Launch a private dbus-daemon to serve on, and print its address.')
+    parser.add_argument('--client-name', dest = 'client_name', default = "dasl's iPhone",
+        help = 'shairport-sync ClientName property.')
+    parser.add_argument('--player-state', dest = 'player_state', default = 'Playing',
+        help = 'shairport-sync PlayerState property.')
+    parser.add_argument('--bt-device-name', dest = 'bt_device_name', default = "dasl's Pixel",
+        help = 'Name of the connected bluetooth device.')
+    return parser.parse_args()
+
+args = parse_args()
+bus_address = args.bus_address or os.environ.get('DBUS_SYSTEM_BUS_ADDRESS') or 'SYSTEM'
+if args.launch_daemon:
+    daemon = subprocess.Popen(
+        ('dbus-daemon', '--session', '--nofork', '--print-address'), stdout = subprocess.PIPE
+    )
+    bus_address = daemon.stdout.readline().decode('utf-8').strip()
+    print(f'DBUS_SYSTEM_BUS_ADDRESS={bus_address}', flush = True)
+
+try:
+    DbusStubServices(bus_address, args.client_name, args.player_state, args.bt_device_name).serve_forever()
+finally:
+    if args.launch_daemon:
+        daemon.terminate()